@@ -38,6 +38,7 @@ import musicdns.ofa
 
 # etc imports
 from optparse import OptionParser
+import multiprocessing
 import os
 
 
@@ -79,18 +80,23 @@ parser.add_option('-W', help=('WRITETAG mode. (step 4). requires MERGEDIR mode r
                             dest='WRITETAG', default=False) 
                             
 
-(options, args) = parser.parse_args()
+# FindMusic reads tags in a process pool. the workers import this module too, so
+# don't start the gui unless we're the real main
+if __name__ == '__main__':
+    multiprocessing.freeze_support()
 
+    (options, args) = parser.parse_args()
 
-flagSet = 0
 
+    flagSet = 0
 
-# int cast hack to make sure just one flag was used
-for flag in (options.GENTAG, options.WRITETAG, options.MERGEDIR, options.FINDDIR): 
-    flagSet += int(flag is (None or False))
 
-if flagSet != 1:
-    guiMain.guiMain()   
+    # int cast hack to make sure just one flag was used
+    for flag in (options.GENTAG, options.WRITETAG, options.MERGEDIR, options.FINDDIR): 
+        flagSet += int(flag is (None or False))
+
+    if flagSet != 1:
+        guiMain.guiMain()   
 
 # disable cli for now
 '''
@@ -0,0 +1,210 @@
+'''checkpoint journal so a multi-hour IdentifyMusic run can be resumed after a crash,
+a network drop, or a cancel from the gui.
+
+The journal is an append-only file of pickled batches. Every CHECKPOINT_EVERY files
+(and at the end of each pass) a batch is written with:
+
+    1. the pass state of every MP3File finished since the last batch
+       (result, method1, method2, fields_changed, clean_track)
+    2. the artist/google lookups that were added to the guess caches since the
+       last batch, so a resumed run doesn't have to hit the web for them again
+    3. which passes are completely finished
+
+The first thing in the file is a header with a fingerprint of the mp3 list the
+run was started on (paths + original tags), so a journal is only ever resumed
+against the same list.
+
+A crash in the middle of a write only loses the last (truncated) batch.
+'''
+
+import os
+import pickle
+import hashlib
+from mp3scrub import globalz
+from mp3scrub.util import mylog
+from mp3scrub.netquery import tagGuessCache
+
+
+JOURNAL_VERSION = 1
+
+
+def fingerprint(mp3_list):
+    ''' returns -> hex digest of the paths and original tags in mp3_list '''
+
+    sha = hashlib.sha1()
+
+    for mp3_obj in mp3_list:
+        track = mp3_obj.orig_track
+
+        for val in (track.path, track.artist, track.album, track.name, track.track_num):
+            sha.update(unicode(val).encode('utf-8'))
+            sha.update('\0')
+
+        sha.update('\n')
+
+    return sha.hexdigest()
+
+
+class RunJournal(object):
+    '''journal for one IdentifyMusic run.
+
+       file_name -> journal file
+       resume -> if True, load the existing journal and keep appending to it.
+                 if False, start a fresh one. a journal written for some other
+                 list than mp3_list is ignored (and started over)
+       mp3_list -> the list being identified
+    '''
+
+    def __init__(self, file_name, resume=False, mp3_list=()):
+        self.file_name = file_name
+        self.print_str = fingerprint(mp3_list)
+
+        # pass_n => { path => state }
+        self.states = {}
+        self.done_passes = set()
+
+        self.pending = []
+        self.pending_done = []
+        self.saved_artists = set()
+        self.saved_goog = set()
+
+        if resume and os.path.exists(file_name) and self._load():
+            self.fl = open(file_name, 'ab')
+        else:
+            self.fl = open(file_name, 'wb')
+
+            pickle.dump({'version' : JOURNAL_VERSION, 'print' : self.print_str}, self.fl, -1)
+            self.fl.flush()
+
+    def _load(self):
+        ''' read back every complete batch and prime the guess caches
+
+            returns -> False if the journal can't be used for this list
+        '''
+
+        batches = 0
+
+        with open(self.file_name, 'rb') as fl:
+            try:
+                header = pickle.load(fl)
+            except Exception, e:
+                mylog.ERR('can\'t read journal header in %s, starting over: %s' %
+                          (self.file_name, str(e)))
+                return False
+
+            if not isinstance(header, dict) or header.get('version') != JOURNAL_VERSION:
+                mylog.ERR('%s is not a journal this version can resume, starting over' %
+                          self.file_name)
+                return False
+
+            if header.get('print') != self.print_str:
+                mylog.ERR('%s was written for a different list of files, starting over' %
+                          self.file_name)
+                return False
+
+            while True:
+                try:
+                    batch = pickle.load(fl)
+                except EOFError:
+                    break
+                except Exception, e:
+                    mylog.ERR('truncated journal batch in %s, ignoring the rest: %s' %
+                              (self.file_name, str(e)))
+                    break
+
+                batches += 1
+
+                for (pass_n, path, state) in batch['files']:
+                    self.states.setdefault(pass_n, {})[path] = state
+
+                for artist_str, artist_obj in batch['artists'].items():
+                    tagGuessCache.ARTIST_META_CACHE[artist_str] = artist_obj
+                    self.saved_artists.add(artist_str)
+
+                for artist_str, goog_pack in batch['goog'].items():
+                    tagGuessCache.GOOG_META_CACHE[artist_str] = goog_pack
+                    self.saved_goog.add(artist_str)
+
+                self.done_passes.update(batch['done'])
+
+        mylog.INFO('resuming from %s: %d batches, %d files, passes done: %s' %
+                   (self.file_name, batches, len(self.states.get(1, {})),
+                    unicode(sorted(self.done_passes))))
+
+        return True
+
+    def isPassDone(self, pass_n):
+        return pass_n in self.done_passes
+
+    def restore(self, pass_n, mp3_obj):
+        ''' if mp3_obj was already finished in pass_n, put its state back.
+
+            returns -> True if restored (i.e. skip it), False if it needs doing
+        '''
+
+        state = self.states.get(pass_n, {}).get(mp3_obj.orig_track.path)
+
+        if not state: return False
+
+        (mp3_obj.result, mp3_obj.method1, mp3_obj.method2,
+         mp3_obj.fields_changed, clean_track) = state
+
+        mp3_obj.clean_track = clean_track.copy()
+
+        return True
+
+    def record(self, pass_n, mp3_obj):
+        ''' mp3_obj is done with pass_n '''
+
+        state = (mp3_obj.result, mp3_obj.method1, mp3_obj.method2,
+                 mp3_obj.fields_changed, mp3_obj.clean_track.copy())
+
+        self.pending.append((pass_n, mp3_obj.orig_track.path, state))
+
+        if len(self.pending) >= globalz.CHECKPOINT_EVERY:
+            self.checkpoint()
+
+    def passDone(self, pass_n):
+        ''' every file is done with pass_n '''
+
+        self.pending_done.append(pass_n)
+        self.checkpoint()
+
+    def checkpoint(self):
+        ''' write out everything that's happened since the last checkpoint '''
+
+        new_artists = {}
+        for artist_str, artist_obj in tagGuessCache.ARTIST_META_CACHE.items():
+            if artist_str not in self.saved_artists:
+                new_artists[artist_str] = artist_obj
+
+        new_goog = {}
+        for artist_str, goog_pack in tagGuessCache.GOOG_META_CACHE.items():
+            # network errors are worth retrying
+            if artist_str not in self.saved_goog and not goog_pack[0]:
+                new_goog[artist_str] = goog_pack
+
+        if not (self.pending or self.pending_done or new_artists or new_goog): return
+
+        batch = {'files'   : self.pending,
+                 'artists' : new_artists,
+                 'goog'    : new_goog,
+                 'done'    : self.pending_done}
+
+        pickle.dump(batch, self.fl, -1)
+        self.fl.flush()
+        os.fsync(self.fl.fileno())
+
+        mylog.DBG1(4, 'checkpoint: %d files %d artists' % (len(self.pending), len(new_artists)))
+
+        self.saved_artists.update(new_artists)
+        self.saved_goog.update(new_goog)
+        self.done_passes.update(self.pending_done)
+        self.pending = []
+        self.pending_done = []
+
+    def close(self):
+        if self.fl.closed: return
+
+        self.checkpoint()
+        self.fl.close()
@@ -0,0 +1,412 @@
+'''the moves behind scrubCmds.MakeDirTree, done as a plan so they can be run in
+parallel, resumed, or undone.
+
+    1. planMoves works out every (src, dst) up front. each artist's dir name is
+       worked out once, and every dir gets created once before anything moves.
+    2. the plan goes in a MoveJournal (an append-only file of pickled records, like
+       checkpoint.RunJournal) before the first move, and every finished move is
+       added as it goes.
+    3. the moves run on a few threads. a move is an os.rename if src and dst are
+       on the same filesystem, otherwise a copy to a temp file next to dst, a
+       rename into place, then the unlink of src.
+
+an interrupted (crashed, cancelled) reorganization can then be resumed, which does
+the moves that haven't been done, or rolled back, which moves the files back and
+removes the dirs we made. the plan keeps each file's size and mtime (see _stamp)
+from when it was planned, so a move that happened but didn't make the journal is
+spotted by src being gone and a file with the same stamp at dst. a file at dst
+that doesn't match is somebody else's, and is never counted as moved (or moved
+back). leftover PART_EXT files from an interrupted copy are removed, so both
+are safe to run anytime.
+'''
+
+import os
+import re
+import errno
+import shutil
+import filecmp
+import pickle
+from mp3scrub import globalz
+from mp3scrub.util import strtool, mylog, progress
+from mp3scrub.netquery import fetchpool
+
+# suffix of the temp file a cross filesystem copy goes to before it's complete
+PART_EXT = '.mp3scrub-part'
+
+_BLANK_RE = re.compile(r'^\s+$')
+
+
+def artistDir(clean_artist, orig_artist):
+    ''' returns -> name of the dir an artist's files go in '''
+
+    sub_dir = strtool.safeUni(clean_artist)
+
+    if not sub_dir or _BLANK_RE.search(sub_dir):
+        sub_dir = strtool.safeUni(orig_artist)
+
+        if not sub_dir or _BLANK_RE.search(sub_dir):
+            sub_dir = 'UNKNOWN'
+
+    return sub_dir
+
+
+def planMoves(mp3_list, dir_path):
+    ''' mp3_list -> list of MP3File
+        dir_path -> where the artist dirs go
+
+        returns -> [(src, dst)]
+    '''
+
+    # (clean artist, orig artist) => dir
+    artist_dirs = {}
+
+    moves = []
+    dsts = set()
+
+    for mp3 in mp3_list:
+        if mp3.is_dup:
+            mylog.INFO('skipping dup track \'%s\'...' % (mp3.orig_track.path))
+            continue
+
+        artist_key = (mp3.clean_track.artist, mp3.orig_track.artist)
+        new_dir = artist_dirs.get(artist_key)
+
+        if new_dir is None:
+            new_dir = os.path.join(dir_path, artistDir(*artist_key))
+            artist_dirs[artist_key] = new_dir
+
+        src = mp3.orig_track.path
+        dst = os.path.join(new_dir, os.path.basename(src))
+
+        if os.path.abspath(src) == os.path.abspath(dst):
+            mylog.DBG('\'%s\' is already in \'%s\'' % (src, new_dir))
+            continue
+
+        if dst in dsts:
+            mylog.ERR('error moving \'%s\' to \'%s\', another file has that name...' %
+                      (src, new_dir))
+            continue
+
+        dsts.add(dst)
+        moves.append((src, dst))
+
+    return moves
+
+
+def _stamp(path):
+    ''' returns -> (size, mtime) of path, which a move (or copy2) keeps. None if
+        it isn't there '''
+
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+
+    return (st.st_size, int(st.st_mtime))
+
+
+def removePart(path):
+    ''' remove what an interrupted copy to path left behind, if anything '''
+
+    part_path = path + PART_EXT
+
+    if not os.path.lexists(part_path): return
+
+    mylog.INFO('removing unfinished copy \'%s\'' % part_path)
+    os.unlink(part_path)
+
+
+def moveFile(src, dst, stamp=None):
+    ''' move src to dst, never over the top of something else. allow throw.
+
+        stamp -> _stamp() of the file from when the move was planned, to tell it
+                 from some other file at dst. without it, a file at dst is never
+                 taken to be this one
+
+        returns -> True if it moved, False if it already had (src gone, dst there
+                   and it's the same file)
+    '''
+
+    removePart(dst)
+
+    is_ours = stamp is not None and _stamp(dst) == stamp
+
+    if not os.path.lexists(src):
+        if is_ours: return False
+
+        if os.path.lexists(dst):
+            raise IOError(errno.EEXIST, 'no existe, and a different file is in the way', dst)
+
+        raise IOError(errno.ENOENT, 'no existe', src)
+
+    if os.path.lexists(dst):
+        # an interrupted copy that got as far as dst, but not the unlink of src
+        if not is_ours or not filecmp.cmp(src, dst, shallow=False):
+            raise IOError(errno.EEXIST, 'already exists', dst)
+
+        mylog.INFO('\'%s\' was already copied to \'%s\', removing it' % (src, dst))
+        os.unlink(src)
+        return True
+
+    try:
+        os.rename(src, dst)
+        return True
+
+    except OSError, e:
+        if e.errno != errno.EXDEV: raise
+
+    # another filesystem. copy next to dst first, so dst only ever shows up whole
+    part_path = dst + PART_EXT
+
+    shutil.copy2(src, part_path)
+    os.rename(part_path, dst)
+    os.unlink(src)
+
+    return True
+
+
+def _moveEntry(entry):
+    ''' entry -> (i, src, dst, stamp). returns -> (i, src, dst, moved, error_str or None) '''
+
+    (i, src, dst, stamp) = entry
+
+    try:
+        moved = moveFile(src, dst, stamp)
+    except (IOError, OSError, shutil.Error), e:
+        return (i, src, dst, False, str(e))
+
+    return (i, src, dst, moved, None)
+
+
+class MoveJournal(object):
+    '''journal for one reorganization.
+
+       file_name -> journal file
+       resume -> if True, load the plan and finished moves from the existing
+                 journal and keep appending to it. if False, start a fresh one
+                 (call setPlan next).
+    '''
+
+    def __init__(self, file_name, resume=False):
+        self.file_name = file_name
+
+        self.moves = []
+        self.dirs = []
+        self.done = set()
+
+        # _stamp() of each src in moves, when it was planned
+        self.stamps = []
+
+        self.pending = []
+
+        if resume:
+            self._load()
+            self.fl = open(file_name, 'ab')
+        else:
+            self.fl = open(file_name, 'wb')
+
+    def _load(self):
+        with open(self.file_name, 'rb') as fl:
+            while True:
+                try:
+                    (kind, val) = pickle.load(fl)
+                except EOFError:
+                    break
+                except Exception, e:
+                    mylog.ERR('truncated move journal record in %s, ignoring the rest: %s' %
+                              (self.file_name, str(e)))
+                    break
+
+                if kind == 'plan':
+                    self.moves = val
+                elif kind == 'stamps':
+                    self.stamps = val
+                elif kind == 'dirs':
+                    self.dirs.extend(val)
+                elif kind == 'done':
+                    self.done.update(val)
+
+        mylog.INFO('move journal %s: %d moves, %d done' %
+                   (self.file_name, len(self.moves), len(self.done)))
+
+    def _write(self, kind, val):
+        pickle.dump((kind, val), self.fl, -1)
+        self.fl.flush()
+        os.fsync(self.fl.fileno())
+
+    def setPlan(self, moves):
+        self.moves = moves
+        self.stamps = [ _stamp(src) for (src, dst) in moves ]
+
+        self._write('plan', moves)
+        self._write('stamps', self.stamps)
+
+    def stamp(self, i):
+        ''' returns -> the planned stamp of move i, None if the journal has none '''
+
+        return self.stamps[i] if i < len(self.stamps) else None
+
+    def addDirs(self, dirs):
+        ''' dirs we made, so a rollback can take them away again '''
+
+        if not dirs: return
+
+        self.dirs.extend(dirs)
+        self._write('dirs', dirs)
+
+    def moved(self, i):
+        self.done.add(i)
+        self.pending.append(i)
+
+        if len(self.pending) >= globalz.CHECKPOINT_EVERY:
+            self.checkpoint()
+
+    def checkpoint(self):
+        if not self.pending: return
+
+        self._write('done', self.pending)
+        self.pending = []
+
+    def close(self):
+        if self.fl.closed: return
+
+        self.checkpoint()
+        self.fl.close()
+
+
+def _runMoves(entries, callback, workers, journal=None):
+    ''' moveFile every (i, src, dst, stamp) in entries on workers threads, 
+        reporting each one to callback. returns -> number that failed
+    '''
+
+    failed = 0
+
+    results = fetchpool.imapUnordered(_moveEntry, entries, workers)
+
+    try:
+        for (i, src, dst, moved, error_str) in results:
+
+            if error_str:
+                mylog.ERR('error moving \'%s\' to \'%s\': %s' % (src, dst, error_str))
+                callback('failed to move %s: %s' % (src, error_str))
+                failed += 1
+                continue
+
+            if moved:
+                mylog.DBG('moved \'%s\' to \'%s\'' % (src, dst))
+                callback('moved %s' % src)
+            else:
+                callback('already moved %s' % src)
+
+            if journal:
+                journal.moved(i)
+
+    finally:
+        results.close()
+
+    return failed
+
+
+def _noStatus(msg):
+    pass
+
+
+def runPlan(journal, callback=None, workers=None):
+    ''' do every move in the journal's plan that isn't done yet, making the dirs
+        first. returns -> number of moves that failed
+    '''
+
+    if callback is None:
+        callback = _noStatus
+
+    if workers is None:
+        workers = globalz.MOVE_WORKERS
+
+    made_dirs = []
+    seen_dirs = set()
+    bad_dirs = set()
+
+    for (src, dst) in journal.moves:
+        new_dir = os.path.dirname(dst)
+
+        if new_dir in seen_dirs: continue
+
+        seen_dirs.add(new_dir)
+
+        if os.path.isdir(new_dir): continue
+
+        try:
+            os.mkdir(new_dir)
+            made_dirs.append(new_dir)
+        except OSError, e:
+            mylog.ERR('error creating \'%s\': %s' % (new_dir, str(e)))
+            bad_dirs.add(new_dir)
+
+    journal.addDirs(made_dirs)
+
+    entries = []
+    failed = 0
+
+    for (i, (src, dst)) in enumerate(journal.moves):
+        if i in journal.done: continue
+
+        if os.path.dirname(dst) in bad_dirs:
+            failed += 1
+        else:
+            entries.append((i, src, dst, journal.stamp(i)))
+
+    mylog.INFO('moving %d files, %d already done' % (len(entries), len(journal.done)))
+
+    progress.newPass(callback, 'moving', len(entries))
+
+    try:
+        failed += _runMoves(entries, callback, workers, journal)
+    finally:
+        journal.checkpoint()
+
+    return failed
+
+
+def rollbackPlan(journal, callback=None, workers=None):
+    ''' move everything in the journal's plan that was moved back where it came
+        from, and remove the dirs that were made for it (if they're empty).
+        returns -> number of moves that failed
+    '''
+
+    if callback is None:
+        callback = _noStatus
+
+    if workers is None:
+        workers = globalz.MOVE_WORKERS
+
+    entries = []
+
+    for (i, (src, dst)) in enumerate(journal.moves):
+        stamp = journal.stamp(i)
+
+        # whatever an interrupted move, or move back, was in the middle of copying
+        try:
+            removePart(dst)
+            removePart(src)
+        except OSError, e:
+            mylog.ERR('error removing unfinished copy of \'%s\': %s' % (src, str(e)))
+
+        # the journaled moves, and the ones that happened but didn't make the
+        # journal (src gone, our file at dst). moveFile skips the ones already back
+        if i in journal.done or (not os.path.lexists(src) and stamp is not None and
+                                 _stamp(dst) == stamp):
+            entries.append((i, dst, src, stamp))
+
+    mylog.INFO('moving %d files back' % len(entries))
+
+    progress.newPass(callback, 'moving back', len(entries))
+
+    failed = _runMoves(entries, callback, workers)
+
+    for new_dir in reversed(journal.dirs):
+        try:
+            os.rmdir(new_dir)
+        except OSError, e:
+            mylog.INFO('not removing \'%s\': %s' % (new_dir, str(e)))
+
+    return failed
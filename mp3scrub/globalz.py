@@ -11,16 +11,64 @@ LOG_DEBUG = 2
 MAX_STR_DIST = 5
 DIV_STR_DIST = 5
 
+###### SCANNING
+
+# processes reading tags in FindMusic, and how many files to hand each at a time
+SCAN_WORKERS = 4
+SCAN_CHUNK = 16
+
+# remembers size/mtime/tags of every file scanned, so a rescan only opens the
+# new/changed ones (see util.scanindex). '' to turn it off
+SCAN_INDEX_FILE = 'scanindex.db'
+
+# dup detection, see util.dupfind. the size stage reads far fewer files, but
+# misses dups that differ in size (i.e. one has a trailing ID3v1/APE tag)
+DUP_SIZE_STAGE = False
+DUP_FULL_CONFIRM = False
+
+###### WRITING
+
+# threads writing tags in WriteMusic. mostly waiting on the disk, so more than
+# there are cpus is fine
+WRITE_WORKERS = 4
+
+# threads moving files in MakeDirTree, and its journal (see dirtree) so an
+# interrupted reorganization can be resumed or undone
+MOVE_WORKERS = 4
+MOVE_JOURNAL_FILE = 'mp3scrub.moves'
+
+###### SESSIONS
+
+# exported sessions with this extension are saved in the binary format (see 
+# util.binsession), anything else is xml
+BIN_SESSION_EXT = '.msb'
+
+###### PROGRESS
+
+# most progress updates a second a job sends the GUI/console (see util.progress)
+PROGRESS_HZ = 10
+
 ###### GUI
-MAX_EVT = 22 
 MAXROWS = 25000
 
 MP3_MUTEX = None
 CANCEL_EVENT = None
 
-SUBJECT_LIST = {}
 MP3_OBJ_LIST = []
 
+# guiThreads.ChangeLog of MP3Files a job has changed, and how often (ms) the grid
+# repaints them
+MP3_CHANGES = None
+GRID_REFRESH_MS = 250
+
+# guiThreads.LookupService behind RefineTrackDialog: lookup threads, how many
+# artists it remembers, and how many rows around the one being refined get 
+# looked up ahead of time
+LOOKUP_SERVICE = None
+LOOKUP_WORKERS = 2
+LOOKUP_CACHE_MAX = 500
+LOOKUP_PREFETCH_ROWS = 10
+
 EVT_WORK_DONE = None
 EVT_STATUS_UPDATE = None
 StatusUpdateEvent = None
@@ -34,11 +82,61 @@ MUSICDNS_KEY = '03a1344bad8caaea06299360c9530c8f'
 MAX_POTENTIAL_ALBUM_MATCH = 1
 MAX_ALBUM_MATCH = 20 
 
+# if set, every last.fm response is saved here (fixtures for 'lastfmquery.py BENCH')
+LASTFM_RECORD_DIR = ''
+
+LASTFM_THREADS = 4
+LASTFM_ARTIST_THREADS = 2
+
+# shared http client (see netquery.httpclient). requests/sec and burst per service.
+# last.fm allows ~5 requests/sec, musicbrainz wants no more than 1
+HTTP_SERVICE_RATES = {'lastfm'      : (5, 5),
+                      'google'      : (2, 1),
+                      'musicbrainz' : (1, 1),
+                      'musicdns'    : (2, 2)}
+
+HTTP_MAX_IDLE = 4
+HTTP_TIMEOUT = 30
+HTTP_MAX_ATTEMPTS = 3
+HTTP_BACKOFF_BASE = 2
+HTTP_BACKOFF_MAX = 30
+
+# PASS 2 hashing (see puidquery.lookupMany). processes making fingerprints (None
+# for one per cpu) and threads looking them up
+PUID_PROCS = None
+PUID_LOOKUP_THREADS = 2
+
+# hashing results by file contents, so files are only fingerprinted once (see 
+# netquery.puidstore). '' to turn it off. misses get retried after PUID_MISS_TTL secs
+PUID_STORE_FILE = 'puids.db'
+PUID_MISS_TTL = 7 * 24 * 60 * 60
+
+# how many mp3s to resolve artist names for before fanning out the last.fm lookups
+PREFETCH_CHUNK = 200
+
 ###### CACHING
 
 CACHE_DEBUG_ON = False
 PERSIST_CACHE_ON = False
 
+# if set, the guess caches get pickled here before every refine, to check the
+# refine against later (see netquery.refinecheck)
+GUESS_RECORD_DIR = ''
+
+# old style whole cache pickle. imported into META_CACHE_FILE if found
 PICKLE_FILE = 'artists.pkl'
+
+META_CACHE_FILE = 'artists.db'
+
+# secs before a cached lookup is considered stale. 0 = never
+ARTIST_CACHE_TTL = 30 * 24 * 60 * 60
+GOOG_CACHE_TTL = 90 * 24 * 60 * 60
+
 ALBUM_GUESS_LIMIT = 20
 
+###### CHECKPOINTING
+
+# IdentifyMusic journal, used to resume an interrupted run
+JOURNAL_FILE = 'mp3scrub.journal'
+CHECKPOINT_EVERY = 50
+
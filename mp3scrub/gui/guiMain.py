@@ -9,30 +9,47 @@ import threading
 from collections import defaultdict
 
 from mp3scrub import globalz
-from mp3scrub.util import mylog
-from mp3scrub.netquery import tagGuessCache
+from mp3scrub.util import mylog, progress
+from mp3scrub.util.mp3index import MP3Index
 from mp3scrub.util.musicTypes import Artist, Album, Track, MP3File
 from mp3scrub.gui.guiThreads import *    
 
+# session file dialogs. SESSION_FORMATS is the format for each wildcard entry
+SESSION_WILDCARD = ('XML session (*.xml)|*.xml|'
+                    'Binary session (*%s)|*%s|'
+                    'All files (*.*)|*.*') % (globalz.BIN_SESSION_EXT, globalz.BIN_SESSION_EXT)
+SESSION_FORMATS = ('xml', 'bin', None)
+
+# getFieldList columns the grid sorts on by default. the jobs don't re-sort
+# MP3_OBJ_LIST anymore, handleWorkDone picks one of these for the grid instead
+# (see MP3Grid.sortBy)
+ORIG_ARTIST_COL = 0
+CLEAN_ARTIST_COL = 1
+
 
 class RefineTrackDialog(wx.Dialog):
-    ''' manual track refine dialog  '''
+    ''' manual track refine dialog. the guesses come from globalz.LOOKUP_SERVICE
+        and fill in the combos as they arrive, the dialog can be used meanwhile. 
+    '''
     
     def __init__(self, parent, row_num):
         wx.Dialog.__init__(self, parent, wx.ID_ANY, 'Refine Track')
 
         self.row_num = row_num
+        self.grid = parent.grid
 
         try:
             '''get the current data outta the grid'''
 
-            self.artist_str = globalz.SUBJECT_LIST[row_num].mp3_obj.orig_track.artist
-            self.album_str = globalz.SUBJECT_LIST[row_num].mp3_obj.orig_track.album
-            self.track_str = globalz.SUBJECT_LIST[row_num].mp3_obj.orig_track.name
-            self.track_num = globalz.SUBJECT_LIST[row_num].mp3_obj.orig_track.track_num
+            self.mp3_obj = self.grid.getMP3(row_num)
+
+            self.artist_str = self.mp3_obj.orig_track.artist
+            self.album_str = self.mp3_obj.orig_track.album
+            self.track_str = self.mp3_obj.orig_track.name
+            self.track_num = self.mp3_obj.orig_track.track_num
             self.artist_obj = None
 
-        except KeyError:
+        except IndexError:
             err_dialog = wx.MessageDialog(self, 'Bad row: %d' % row_num, 'Error', wx.OK | wx.ICON_ERROR)
             err_dialog.ShowModal()
             parent.Destroy()
@@ -42,6 +59,7 @@ class RefineTrackDialog(wx.Dialog):
         self.album_combo = wx.ComboBox(self, wx.ID_ANY, choices=[], style=wx.CB_SORT) 
         self.track_combo = wx.ComboBox(self, wx.ID_ANY, choices=[], style=wx.CB_SORT) 
         self.track_entry = wx.TextCtrl(self, wx.ID_ANY, '1')
+        self.status_text = wx.StaticText(self, label='')
         self.search_btn = wx.Button(self, wx.ID_ANY, 'Guess Tracks...', size=(160, 30))
         self.cancel_btn = wx.Button(self, wx.ID_ANY, 'Cancel', size=(160, 30))
         self.save_btn = wx.Button(self, wx.ID_ANY, 'Save', size=(160, 30))
@@ -51,6 +69,7 @@ class RefineTrackDialog(wx.Dialog):
         self.Bind(wx.EVT_BUTTON, self.saveChanges, self.save_btn) 
         self.Bind(wx.EVT_COMBOBOX, self.onAlbumSelect, self.album_combo)
         self.Bind(wx.EVT_COMBOBOX, self.onTrackSelect, self.track_combo)
+        self.Bind(wx.EVT_WINDOW_DESTROY, self.onDestroy)
 
         self.grid_sizer =  wx.GridSizer(rows=5, cols=2, vgap=5, hgap=5)
        
@@ -72,12 +91,16 @@ class RefineTrackDialog(wx.Dialog):
         self.box = wx.StaticBox(self, wx.ID_ANY, 'Edit Track')
         self.sizer = wx.StaticBoxSizer(self.box, wx.VERTICAL)
         self.sizer.Add(self.grid_sizer, wx.ID_ANY, wx.ALL, 15)
-        self.sizer.AddSpacer(40, 1)
+        self.sizer.Add(self.status_text, 0, wx.LEFT, 15)
+        self.sizer.AddSpacer(25, 1)
         self.sizer.Add(self.button_sizer, 0, wx.CENTER | wx.ALIGN_BOTTOM, 15)
 
         self.SetSizer(self.sizer)
         self.sizer.Fit(self)
 
+        # usually already looked up (see MainApp.onGridClick)
+        self.initCombos(None)
+
     def saveChanges(self, evt):
         '''put the changes back into the grid'''
 
@@ -86,17 +109,24 @@ class RefineTrackDialog(wx.Dialog):
         trk_str = self.track_combo.GetValue()
         trk_num = self.track_entry.GetValue()
 
-        globalz.SUBJECT_LIST[self.row_num].mp3_obj.clean_track.artist = art_str
-        globalz.SUBJECT_LIST[self.row_num].mp3_obj.clean_track.album = alb_str
-        globalz.SUBJECT_LIST[self.row_num].mp3_obj.clean_track.name = trk_str
-        globalz.SUBJECT_LIST[self.row_num].mp3_obj.clean_track.track_num = trk_num
-        globalz.SUBJECT_LIST[self.row_num].mp3_obj.result = MP3File.QRY_RESULT.FIELDS_CHANGED;
-        globalz.SUBJECT_LIST[self.row_num].notify()
+        self.mp3_obj.clean_track.artist = art_str
+        self.mp3_obj.clean_track.album = alb_str
+        self.mp3_obj.clean_track.name = trk_str
+        self.mp3_obj.clean_track.track_num = trk_num
+        self.mp3_obj.result = MP3File.QRY_RESULT.FIELDS_CHANGED;
+        self.grid.refreshMP3s([self.mp3_obj])
         self.Destroy()
 
     def closeMe(self, evt):
         self.Destroy()
 
+    def onDestroy(self, evt):
+        ''' no more lookup results for us '''
+
+        globalz.LOOKUP_SERVICE.cancel(self.onLookup)
+
+        evt.Skip()
+
     def onAlbumSelect(self, evt):
         '''when album changes, update the track combo'''
 
@@ -144,40 +174,35 @@ class RefineTrackDialog(wx.Dialog):
 
 
     def initCombos(self, evt):
-        ''' make some web queries to init the combo boxes '''
+        ''' ask for the guesses to init the combo boxes (see onLookup) '''
 
         self.artist_combo.Clear()
         self.album_combo.Clear()
         self.track_combo.Clear()
 
-        wait_dialog = wx.ProgressDialog('Searching...', 'Searching...',  maximum=10, parent=self)
-        wait_dialog.SetSize((300, 150))
-        wait_dialog.SetMaxSize((300,300))
-        wait_dialog.SetPosition((250,250))
-        wait_dialog.Update(1, 'querying web...')
-        self.Refresh()
+        self.status_text.SetLabel('querying web...')
+
+        globalz.LOOKUP_SERVICE.request(self.artist_str, self.onLookup)
+
 
-        _, web_guess = tagGuessCache.queryGoogCache(self.artist_str) 
+    def onLookup(self, artist_str, web_guess, artist_obj, is_done):
+        ''' the guesses, from the LookupService. first the artist name, then the 
+            albums/tracks '''
 
-        if web_guess:
+        if web_guess and self.artist_combo.IsEmpty():
            self.artist_combo.Append(web_guess)
            self.artist_combo.SetSelection(0)
 
-        if not self.artist_obj and web_guess:
-            wait_dialog.Update(2, 'querying web...')
-            self.artist_obj = tagGuessCache.getRawArtistInfo(web_guess)
+        if artist_obj and web_guess:
+            self.artist_obj = artist_obj
+
+            self.album_combo.Clear()
+            self.track_combo.Clear()
 
-        if self.artist_obj and web_guess:
             do_first_alb = True
             do_first_trk = True
 
-
-            i = 0
-
             for album_obj in self.artist_obj.albums:
-                i += 1
-
-                wait_dialog.Update(i % 10, album_obj.name)
 
                 self.album_combo.Append(album_obj.name)
 
@@ -195,76 +220,253 @@ class RefineTrackDialog(wx.Dialog):
 
                     do_first_alb = False
 
+        if not is_done:
+            self.status_text.SetLabel('querying web for %s albums...' % web_guess)
+        elif not web_guess:
+            self.status_text.SetLabel('no guesses found')
+        else:
+            self.status_text.SetLabel('')
+
+
+
+class MP3Table(wx.grid.PyGridTableBase):
+    ''' what the main grid shows: a list of MP3File, one per row. the grid only asks
+        for the cells it's drawing, so they're read out of the MP3Files on demand 
+        and the size of the list doesn't matter.
+    '''
+
+    def __init__(self):
+        wx.grid.PyGridTableBase.__init__(self)
+
+        self.labelz = MP3File.getFieldLabels()
+        self.rows = []
+
+        # id(MP3File) => row, to find the rows a job changed
+        self.row_of = {}
+
+        # (column, reverse) the rows are sorted by, for the label
+        self.sort_mark = (None, False)
+
+        # rows we couldn't guess anything for
+        self.red_attr = wx.grid.GridCellAttr()
+        self.red_attr.SetBackgroundColour(wx.RED)
+
+    def GetNumberRows(self):
+        return len(self.rows)
+
+    def GetNumberCols(self):
+        return len(self.labelz)
+
+    def IsEmptyCell(self, row, col):
+        return False
+
+    def GetValue(self, row, col):
+        try:
+            return unicode(self.rows[row].fieldList[col])
+        except IndexError:
+            return u''
+
+    def SetValue(self, row, col, val):
+        # read only, changes go through RefineTrackDialog
+        pass
+
+    def GetColLabelValue(self, col):
+        (sort_col, reverse) = self.sort_mark
+
+        if col == sort_col:
+            return self.labelz[col] + (u' \u25bc' if reverse else u' \u25b2')
+
+        return self.labelz[col]
+
+    def GetAttr(self, row, col, kind):
+        if row < len(self.rows) and self.rows[row].result == MP3File.QRY_RESULT.NO_GUESS:
+            self.red_attr.IncRef()
+            return self.red_attr
+
+        return None
 
-        wait_dialog.Destroy()
+    def getMP3(self, row):
+        ''' returns -> the MP3File in row. raises IndexError if there isn't one '''
+        return self.rows[row]
 
+    def findRow(self, mp3_obj):
+        ''' returns -> the row mp3_obj is in, None if it isn't showing '''
+        return self.row_of.get(id(mp3_obj))
+
+    def setRows(self, rows):
+        ''' show a new list of MP3File. the grid gets told how many rows came or
+            went, and repaints what's visible.
+        '''
+
+        old_len = len(self.rows)
+        self.rows = rows
+        self.row_of = dict([ (id(o), row) for (row, o) in enumerate(rows) ])
+        new_len = len(rows)
+
+        grid = self.GetView()
+
+        if not grid: return
+
+        grid.BeginBatch()
+
+        if new_len < old_len:
+            grid.ProcessTableMessage(wx.grid.GridTableMessage(self, 
+                                     wx.grid.GRIDTABLE_NOTIFY_ROWS_DELETED, new_len, old_len - new_len))
+        elif new_len > old_len:
+            grid.ProcessTableMessage(wx.grid.GridTableMessage(self, 
+                                     wx.grid.GRIDTABLE_NOTIFY_ROWS_APPENDED, new_len - old_len))
+
+        grid.ProcessTableMessage(wx.grid.GridTableMessage(self, 
+                                 wx.grid.GRIDTABLE_REQUEST_VIEW_GET_VALUES))
+        grid.EndBatch()
+
+        grid.ForceRefresh()
 
 
 class MP3Grid(wx.grid.Grid):
-    ''' main grid to display files and tags '''
+    ''' main grid to display files and tags. a virtual grid, see MP3Table. which 
+        rows it shows, and in what order, comes from an MP3Index of the mp3 list.
+    '''
 
     def __init__(self, parent):
         super(MP3Grid, self).__init__(parent)
 
-        # setup grid and all its glory
-        labelz = MP3File.getFieldLabels()
+        # setup grid and all its glory. keep our own ref to the table, the 
+        # grid won't
+        self.table = MP3Table()
 
-        self.CreateGrid(globalz.MAXROWS, len(labelz))
+        self.SetTable(self.table, True)
         self.EnableEditing(False)
         self.EnableCellEditControl(False)
 
-        for x, l in enumerate(labelz):
-            self.SetColLabelValue(x, l)
-
         self.SetColSize(0, 150)
         self.SetColSize(1, 150)
 
         for c in xrange(2,6):
             self.SetColSize(c, 300)
 
+        self.index = MP3Index()
 
-    def populateCells(self, filter=None):
+        # the view: {filter kind : key} (see mp3index.FILTER_KINDS), search string,
+        # sort column
+        self.filters = {}
+        self.search = u''
+        self.sort_col = None
+        self.sort_reverse = False
+
+        self.Bind(wx.grid.EVT_GRID_LABEL_LEFT_CLICK, self.onLabelClick)
+
+
+    def populateCells(self):
         ''' call everytime a major change is made to the global mp3 list '''
 
-        self.ClearGrid()
+        self.index.reset(snapshotMP3s())
+        self.applyView()
 
-        with globalz.MP3_MUTEX:
 
-            globalz.SUBJECT_LIST.clear()
+    def applyView(self):
+        ''' show the rows that match the current filters/search, in sort order '''
 
-            row_num = 0
+        rows = self.index.select(self.filters, self.search, self.sort_col, self.sort_reverse)
 
-            for o in globalz.MP3_OBJ_LIST:
+        mylog.DBG1(6, 'showing %d of %d tracks' % (len(rows), len(self.index)))
 
-                if filter:
-                    if not o.clean_track.artist or o.clean_track.artist[0].lower() != filter: continue
+        self.table.sort_mark = (self.sort_col, self.sort_reverse)
+        self.table.setRows(rows)
 
-                
-                mylog.DBG1(6, 'adding track # %d: %s' % (row_num, o.orig_track.path))
-                mp3_sub = MP3Subject(o)
 
-                mp3Obz = MP3Observer(mp3_sub, row_num, self)
-                mp3_sub.addObserver(mp3Obz)
+    def setFilter(self, kind, key):
+        ''' only show files whose kind is key. key None turns that filter off '''
+
+        if key is None:
+            self.filters.pop(kind, None)
+        else:
+            self.filters[kind] = key
+
+        self.applyView()
+
+
+    def setSearch(self, search):
+        self.search = search
+        self.applyView()
+
+
+    def sortBy(self, col, reverse=False):
+        ''' col None for the mp3 list's own order '''
+
+        self.sort_col = col
+        self.sort_reverse = reverse
+        self.applyView()
+
+
+    def onLabelClick(self, evt):
+        ''' sort on a column by clicking its label, again to reverse it '''
+
+        col = evt.GetCol()
+
+        if evt.GetRow() != -1 or col < 0:
+            evt.Skip()
+            return
+
+        if col == self.sort_col:
+            self.sortBy(col, not self.sort_reverse)
+        else:
+            self.sortBy(col)
+
+
+    def isViewed(self):
+        ''' returns -> True if the rows shown depend on the files' tags '''
+
+        return bool(self.filters or self.search or self.sort_col is not None)
+
+
+    def getMP3(self, row):
+        return self.table.getMP3(row)
+
 
-                globalz.SUBJECT_LIST[row_num] = mp3_sub
+    def refreshRow(self, row):
+        ''' repaint one row after its MP3File has changed. quicker than the shotgun 
+            approach of populateCells 
+        '''
 
-                mp3_sub.notify()
-                row_num += 1
+        if not 0 <= row < self.table.GetNumberRows(): return
 
+        rect = self.BlockToDeviceRect(wx.grid.GridCellCoords(row, 0),
+                                      wx.grid.GridCellCoords(row, self.table.GetNumberCols() - 1))
 
-    def setCell(self, x, y, val):
-        ''' make a change to a single cell. quicker than the shotgun approach of populateCells '''
-        self.SetCellValue(x, y, unicode(val))
+        self.GetGridWindow().RefreshRect(rect)
+
+
+    def refreshMP3s(self, mp3_list):
+        ''' the MP3Files in mp3_list have changed. if they've moved in or out of the
+            view (or within the sort) the view gets redone, otherwise just their rows
+            are repainted
+        '''
+
+        moved = [ mp3_obj for mp3_obj in mp3_list if self.index.update(mp3_obj) ]
+
+        if moved and self.isViewed():
+            self.applyView()
+            return
+
+        for mp3_obj in mp3_list:
+            row = self.table.findRow(mp3_obj)
+
+            if row is not None:
+                self.refreshRow(row)
 
 
 
 class MP3WaitDialog(wx.ProgressDialog):
-    ''' dialog to show everytime a long running process is busy '''
+    ''' dialog to show everytime a long running process is busy. it isn't modal (and 
+        has no parent, which would be disabled while it's up) so the grid can still be
+        looked through while the job runs.
+    '''
 
     def __init__(self, title, bar_len, parentx):
 
-        super(MP3WaitDialog, self).__init__(title, title, maximum=bar_len, parent=parentx, 
-                                            style=wx.PD_AUTO_HIDE|wx.PD_APP_MODAL|wx.PD_CAN_ABORT)
+        super(MP3WaitDialog, self).__init__(title, title, maximum=bar_len, parent=None, 
+                                            style=wx.PD_AUTO_HIDE|wx.PD_CAN_ABORT)
 
         self.SetSize((700,150))
         self.SetMaxSize((800,800))
@@ -306,7 +508,26 @@ class MP3ToolBar(wx.ToolBar):
         self.filter_combo = wx.ComboBox(self, 40, 'off', choices=filter_choices, size=(150,-1), 
                                         style=wx.CB_DROPDOWN | wx.CB_READONLY) 
         self.AddControl(self.filter_combo)
-        self.Bind(wx.EVT_COMBOBOX, self.doFilter)
+        self.Bind(wx.EVT_COMBOBOX, self.doFilter, self.filter_combo)
+
+        self.AddControl(wx.StaticText(self, -1, ' result: ', (30,15), style=wx.ALIGN_RIGHT))
+
+        result_choices = ['all'] + sorted([ v for (k, v) in vars(MP3File.QRY_RESULT).items() 
+                                            if not k.startswith('_') ])
+
+        self.result_combo = wx.ComboBox(self, 50, 'all', choices=result_choices, size=(150,-1), 
+                                        style=wx.CB_DROPDOWN | wx.CB_READONLY) 
+        self.AddControl(self.result_combo)
+        self.Bind(wx.EVT_COMBOBOX, self.doResultFilter, self.result_combo)
+
+        self.AddSeparator()
+
+        self.search_ctrl = wx.SearchCtrl(self, 60, size=(200,-1))
+        self.search_ctrl.ShowCancelButton(True)
+        self.AddControl(self.search_ctrl)
+        self.Bind(wx.EVT_TEXT, self.doSearch, self.search_ctrl)
+        self.Bind(wx.EVT_SEARCHCTRL_CANCEL_BTN, self.clearSearch, self.search_ctrl)
+
         self.Realize()
 
     def dispatchBtn(self, evt):
@@ -332,9 +553,30 @@ class MP3ToolBar(wx.ToolBar):
         filter_letter = self.filter_combo.GetValue()
 
         if filter_letter == 'off':
-            self.parent.grid.populateCells()
+            self.parent.grid.setFilter('artist', None)
         else:
-            self.parent.grid.populateCells(filter_letter)
+            self.parent.grid.setFilter('artist', filter_letter)
+
+
+    def doResultFilter(self, evt):
+        ''' only display the files with the specified result '''
+
+        result = self.result_combo.GetValue()
+
+        if result == 'all':
+            self.parent.grid.setFilter('result', None)
+        else:
+            self.parent.grid.setFilter('result', result)
+
+
+    def doSearch(self, evt):
+        ''' only display the files with the search text in an artist/album/track/path '''
+
+        self.parent.grid.setSearch(self.search_ctrl.GetValue())
+
+
+    def clearSearch(self, evt):
+        self.search_ctrl.SetValue('')
 
 
 
@@ -354,9 +596,15 @@ class MainApp(wx.Frame):
         self.Bind(globalz.EVT_WORK_DONE, self.handleWorkDone)
         self.Bind(globalz.EVT_STATUS_UPDATE, self.handleStatusUpdate)
         self.Bind(wx.grid.EVT_GRID_CELL_LEFT_DCLICK, self.onGridClick)
+        self.Bind(wx.EVT_CLOSE, self.onClose)
 
         self.grid = MP3Grid(self)
 
+        # repaint whatever the running job has changed
+        self.change_timer = wx.Timer(self)
+        self.Bind(wx.EVT_TIMER, self.onChangeTimer, self.change_timer)
+        self.change_timer.Start(globalz.GRID_REFRESH_MS)
+
         # make it pretty
         self.sizer2 = wx.BoxSizer(wx.HORIZONTAL)
         self.sizer2.Add(self.grid, 2, wx.EXPAND)
@@ -389,6 +637,8 @@ class MainApp(wx.Frame):
         self.Bind(wx.EVT_MENU, self.doFindMusic, item)
         item = action_menu.Append(wx.ID_ANY, 'Clean tags...', 'Identify your music')
         self.Bind(wx.EVT_MENU, self.doCleanMusic, item)
+        item = action_menu.Append(wx.ID_ANY, 'Resume clean tags...', 'Pick up the last cancelled clean')
+        self.Bind(wx.EVT_MENU, self.doResumeCleanMusic, item)
         item = action_menu.Append(wx.ID_ANY, 'Update tags...', 'Update your music')
         self.Bind(wx.EVT_MENU, self.doWriteMusic, item)
 
@@ -407,6 +657,8 @@ class MainApp(wx.Frame):
         ''' receive done events from the worker threads '''
 
         if evt.error_str:
+            self.closeWaitDialog()
+
             err_dialog = wx.MessageDialog(self, evt.error_str, 'Fatal Error', wx.OK | wx.ICON_ERROR)
             err_dialog.ShowModal()
             self.Destroy()
@@ -418,10 +670,18 @@ class MainApp(wx.Frame):
 
         if self.wait_dialog:
             self.wait_dialog.Update(self.max_progress - 1, 'Updating grid...') 
+
+            # order by artist name in the GUI
+            if evt.src == 'Clean-Tags':
+                self.grid.sort_col = CLEAN_ARTIST_COL
+                self.grid.sort_reverse = False
+            elif evt.src in ('Find-Music', 'Import-XML'):
+                self.grid.sort_col = ORIG_ARTIST_COL
+                self.grid.sort_reverse = False
+
             self.grid.populateCells()
             self.printStats()  
-            self.wait_dialog.Update(self.max_progress, 'Done') 
-            self.wait_dialog = None
+            self.closeWaitDialog()
 
         err_dialog = wx.MessageDialog(self, 'Job ' + evt.src + ' finished', 'Work Done', wx.OK)
         err_dialog.ShowModal()
@@ -429,35 +689,90 @@ class MainApp(wx.Frame):
 
 
 
+    def closeWaitDialog(self):
+        ''' take down the job's progress dialog. it has no parent, so it has to be
+            destroyed by hand or it keeps the main loop from exiting '''
+
+        if not self.wait_dialog: return
+
+        self.wait_dialog.Destroy()
+        self.wait_dialog = None
+
+
     def handleStatusUpdate(self, evt):
         ''' receive update events from the worker threads '''
 
         if self.wait_dialog:
 
-            if evt.src == 'clean_thread':
-                (cancel, skip) = self.wait_dialog.Update(evt.pct, evt.msg) 
-                if not cancel:
-                    globalz.CANCEL_EVENT.set()
+            info = evt.info
+            msg = progress.describe(info)
+
+            # the bar's only for jobs that know how far along they are
+            if info.fraction is None:
+                (cancel, skip) = self.wait_dialog.Pulse(msg) 
             else:
-                (cancel, skip) = self.wait_dialog.Pulse(evt.msg) 
-                if not cancel:
-                    globalz.CANCEL_EVENT.set()
+                pct = max(min(int(info.fraction * self.max_progress), self.max_progress - 1), 0)
+                (cancel, skip) = self.wait_dialog.Update(pct, msg) 
+
+            if not cancel:
+                globalz.CANCEL_EVENT.set()
+
+
+    def onChangeTimer(self, evt):
+        ''' show the rows the running job has changed since last time '''
+
+        changed = globalz.MP3_CHANGES.take()
+
+        if changed:
+            self.grid.refreshMP3s(changed)
+
+
+    def isBusy(self):
+        ''' returns -> True (after telling the user) if a job is still running '''
+
+        if not self.wait_dialog: return False
+
+        busy_dialog = wx.MessageDialog(self, 'Wait for the current job to finish', 'Busy', wx.OK)
+        busy_dialog.ShowModal()
+        busy_dialog.Destroy()
+
+        return True
 
 
     def onGridClick(self, evt):
         ''' on grid click kick off the manual update window '''
 
-        if evt.GetRow() + 1 <= len(globalz.SUBJECT_LIST):
+        # the job could be changing the same file
+        if self.isBusy(): return
+
+        if evt.GetRow() < self.grid.table.GetNumberRows():
             self.grid.SelectRow(evt.GetRow()) 
             dialog = RefineTrackDialog(self, evt.GetRow())
+
+            # the rows around it are likely next
+            self.prefetchNear(evt.GetRow())
+
             dialog.SetPosition((150,150))
             dialog.ShowModal()
             dialog.Destroy()
 
 
+    def prefetchNear(self, row):
+        ''' start looking up the refine guesses for the rows near row '''
+
+        num_rows = self.grid.table.GetNumberRows()
+        first = max(row - globalz.LOOKUP_PREFETCH_ROWS / 2, 0)
+        last = min(row + globalz.LOOKUP_PREFETCH_ROWS, num_rows - 1)
+
+        globalz.LOOKUP_SERVICE.prefetch([ self.grid.getMP3(r).orig_track.artist 
+                                          for r in xrange(first, last + 1) if r != row ])
+
+
     def doWriteMusic(self, evt):
         ''' spawn up the tag updater thread '''
 
+        if self.isBusy(): return
+
         mylog.INFO('working on update tags...')
 
         self.max_progress = len(globalz.MP3_OBJ_LIST)
@@ -471,9 +786,17 @@ class MainApp(wx.Frame):
         update_thr.start()
 
 
-    def doCleanMusic(self, evt):
+    def doResumeCleanMusic(self, evt):
+        ''' spawn up the tag identifier thread, skipping whatever the last run finished '''
+
+        self.doCleanMusic(evt, resume=True)
+
+
+    def doCleanMusic(self, evt, resume=False):
         ''' spawn up the tag identifier thread '''
 
+        if self.isBusy(): return
+
         mylog.INFO('working on scrubbing mp3s...')
 
         # 3 passes of cleaning, hence *3
@@ -485,7 +808,7 @@ class MainApp(wx.Frame):
 
         self.start_time = time.time()
 
-        clean_thr = CleanThread(cbwin=self, bar_max=self.max_progress)
+        clean_thr = CleanThread(cbwin=self, resume=resume)
         clean_thr.daemon = True
         clean_thr.start()
 
@@ -493,6 +816,8 @@ class MainApp(wx.Frame):
     def doFindMusic(self, evt):
         ''' spawn up the mp3 finder thread '''
 
+        if self.isBusy(): return
+
         dialog = wx.DirDialog(self, style=wx.DD_DEFAULT_STYLE)
         dialog.SetPosition((30,150))
 
@@ -517,16 +842,22 @@ class MainApp(wx.Frame):
             find_thr.start()
 
     def onExport(self, event):
-        ''' export the mp3 list an xml file '''
+        ''' export the mp3 list an xml (or binary session) file '''
+
+        if self.isBusy(): return
 
-        dialog = wx.FileDialog(self, style=wx.FD_SAVE, wildcard='*.*')
+        dialog = wx.FileDialog(self, style=wx.FD_SAVE, wildcard=SESSION_WILDCARD)
 
         save_file = ''
+        save_fmt = None
         err_str = ''
 
         if dialog.ShowModal() == wx.ID_OK:
             save_file = dialog.GetPath()
 
+            # 'All files' goes by the extension
+            save_fmt = SESSION_FORMATS[dialog.GetFilterIndex()]
+
 
         dialog.Destroy()
 
@@ -537,15 +868,17 @@ class MainApp(wx.Frame):
             self.wait_dialog.Pulse('exporting tag config to file %s...' % save_file)
 
 
-            export_thr = ExportThread(xml_name=save_file, cbwin=self)
+            export_thr = ExportThread(xml_name=save_file, fmt=save_fmt, cbwin=self)
             export_thr.daemon = True
             export_thr.start()
 
 
     def onImport(self, evt):
-        ''' open an xml file and load it into the grid '''
+        ''' open an xml (or binary session) file and load it into the grid '''
+
+        if self.isBusy(): return
 
-        dialog = wx.FileDialog(self, style=wx.FD_OPEN, wildcard='*.*')
+        dialog = wx.FileDialog(self, style=wx.FD_OPEN, wildcard=SESSION_WILDCARD)
 
         save_file = ''
         err_str = ''
@@ -573,6 +906,8 @@ class MainApp(wx.Frame):
     def doDirTree(self, evt):
         ''' move the files to a new location and make a nice tree based on artist dir '''
 
+        if self.isBusy(): return
+
         dialog = wx.DirDialog(self, style=wx.DD_DEFAULT_STYLE)
         dialog.SetPosition((30,150))
 
@@ -601,13 +936,25 @@ class MainApp(wx.Frame):
         self.Close()  # Close the main window.
 
 
+    def onClose(self, evt):
+        ''' the main window is going away, stop a running job and clean up '''
+
+        if self.wait_dialog:
+            globalz.CANCEL_EVENT.set()
+
+        self.change_timer.Stop()
+        self.closeWaitDialog()
+
+        evt.Skip()
+
+
     def printStats(self):
         ''' print some debug info '''
 
         tmp_alb = defaultdict(int)
         good, bad = 0, 0
 
-        for o in globalz.MP3_OBJ_LIST:
+        for o in snapshotMP3s():
 
             if o.result == MP3File.QRY_RESULT.FIELDS_CHANGED:
 
@@ -641,9 +988,13 @@ def guiMain():
     globalz.WorkDoneEvent, globalz.EVT_WORK_DONE = wx.lib.newevent.NewEvent()
     globalz.StatusUpdateEvent, globalz.EVT_STATUS_UPDATE = wx.lib.newevent.NewEvent()
     globalz.CANCEL_EVENT = threading.Event()
+    globalz.MP3_CHANGES = ChangeLog()
       
     wxapp = wx.App()
 
+    # needs the app (results come back with wx.CallAfter)
+    globalz.LOOKUP_SERVICE = LookupService()
+
     main_app = MainApp()
     main_app.SetPosition((100,100))
     main_app.Show()
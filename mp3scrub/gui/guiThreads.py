@@ -3,80 +3,307 @@ processes. Sometimes tag identification can take 3+ hours, and you don't want to
 wait that long for the window to repaint. 
 
 The GUI will spawn a new thread for finding/IDing/updating mp3s, and a wxEvent 
-will be sent when the work is done.
+will be sent when the work is done. The refine dialog's web lookups run on the
+LookupService's threads.
 
 The GUI also needs to be told when to refresh the main grid of mp3 metadata. The
 metadata (MP3File list) will obviously be changing as we update tags, and the grid
-needs to reflect that. There is a basic subject/observer pattern that wraps the 
-MP3File's and makes updates clean. 
+needs to reflect that. The grid reads the MP3Files directly (see guiMain.MP3Table),
+so it just needs repainting. A job adds each MP3File it changes to the ChangeLog,
+and the GUI repaints those rows a few times a second, so results show up as 
+they're found.
 
 Also note that the main list of MP3s is global (as it is shared by threads), so
-mutexs are a must. 
+mutexs are a must. globalz.MP3_MUTEX only guards the list itself, and is only
+ever held for a moment: a job copies the list under it, works on the copy 
+unlocked, and puts its new list back under it. The GUI can read the list (and
+the MP3Files in it) whenever it likes.
 '''
 
 import sys, time
 import wx
 import threading
 import traceback
+import itertools
+import Queue
+from collections import OrderedDict
 from mp3scrub import scrubCmds, globalz
-from mp3scrub.util import mylog
+from mp3scrub.util import mylog, progress
 from mp3scrub.netquery import tagGuessCache
-from mp3scrub.util.musicTypes import Artist, Album, Track, MP3File
+from mp3scrub.util.musicTypes import Artist, Album, Track
 
 
-class MP3Subject(object):
-    ''' a subject (see GoF observer pattern) that has an MP3File.
-        When it's MP3File has been modified, the user must call notify()
-        to cause the GUI to update.
+class ThreadQuit(Exception):
+    '''A safe way to exit a thread early if cancel has been clicked.'''
+    pass
+
+
+class ChangeLog(object):
+    '''per-row change records. job threads add() each MP3File as they change it,
+    and the GUI take()s them on a timer to repaint just those rows.
     '''
-    def __init__(self, mp3_obj):
-        self.mp3_obj = mp3_obj
-        self.observers = []
 
-    def addObserver(self, observer):
-        self.observers.append(observer)
+    def __init__(self):
+        self.lock = threading.Lock()
 
-    def delObserver(self, observer):
-        try:
-            self.observers.remove(observer)
-        except ValueError:
-            mylog.ERR('cannot remove observer')
+        # id => MP3File, a file changed 3 times between repaints gets repainted once
+        self.changed = {}
+
+    def add(self, mp3_obj):
+        with self.lock:
+            self.changed[id(mp3_obj)] = mp3_obj
 
-    def notify(self):
-        for i, obs in enumerate(self.observers):
-            mylog.DBG1(6, 'notifying observer %d' % i)
-            obs.update()
+    def take(self):
+        ''' returns -> the MP3Files changed since the last take() '''
 
+        with self.lock:
+            (changed, self.changed) = (self.changed, {})
 
+        return changed.values()
 
-class MP3Observer(object):
-    ''' an observer (see GoF observer pattern) that has an MP3File.
-        Needs a ref to the MP3Grid to know how to update the GUI.
+
+def guiProgress(cbwin, src, passes=1, on_cancel=None):
+    ''' returns -> the progress callback for a job thread (see util.progress). it
+        sends cbwin StatusUpdateEvents with a ProgressInfo in evt.info, at most
+        globalz.PROGRESS_HZ a second, and raises ThreadQuit once cancel has been
+        clicked (after calling on_cancel, if there is one)
     '''
-    def __init__(self, mp3_subj, row_n, grid_ref):
-        self.mp3_subj = mp3_subj
-        self.row_n = row_n
-        self.grid_ref = grid_ref
 
+    def publish(info):
+        wx.PostEvent(cbwin, globalz.StatusUpdateEvent(src=src, info=info))
 
-    def update(self):
-        set_red = False
+    def checkCancel():
+        if globalz.CANCEL_EVENT.isSet():
+            mylog.INFO('%s got cancel' % src)
 
-        if self.mp3_subj.mp3_obj.result == MP3File.QRY_RESULT.NO_GUESS: 
-            set_red = True
+            if on_cancel:
+                on_cancel()
 
-        for col, data in enumerate(self.mp3_subj.mp3_obj.fieldList):
-            if set_red: 
-                self.grid_ref.SetCellBackgroundColour(self.row_n, col, wx.RED)
+            globalz.CANCEL_EVENT.clear()
 
-            self.grid_ref.setCell(self.row_n, col, data)
+            raise ThreadQuit
 
+    return progress.Progress(publish, passes, checkCancel)
 
 
+class LookupService(object):
+    '''the web lookups behind RefineTrackDialog (google for the artist name, then
+    last.fm for their albums/tracks), done on background threads and remembered,
+    so the dialog never waits on the network and the same artist is only looked
+    up once.
 
-class ThreadQuit(Exception):
-    '''A safe way to exit a thread early if cancel has been clicked.'''
-    pass
+    request(artist_str, listener) -> listener(artist_str, web_guess, artist_obj, 
+        is_done) is called on the GUI thread: right away if artist_str is cached,
+        otherwise once with just the web guess and again (is_done) with the 
+        Artist as they come in.
+    prefetch(artist_strs) -> look them up ahead of time, after any requests. the 
+        prefetches from the last call that haven't started yet are dropped.
+    pause()/resume() -> hold off the lookups while a job uses tagGuessCache (they
+        share its caches and on-disk store). pause() waits for the lookups that 
+        have already started.
+
+    workers -> lookup threads, defaults to globalz.LOOKUP_WORKERS
+    cache_max -> most artists remembered, defaults to globalz.LOOKUP_CACHE_MAX
+    '''
+
+    # queue priorities
+    REQUEST, PREFETCH = 0, 1
+
+    def __init__(self, workers=None, cache_max=None):
+        if workers is None:
+            workers = globalz.LOOKUP_WORKERS
+
+        if cache_max is None:
+            cache_max = globalz.LOOKUP_CACHE_MAX
+
+        self.cache_max = cache_max
+
+        # (priority, seq, artist_str). seq keeps each priority first come first served
+        self.queue = Queue.PriorityQueue()
+        self.seq = itertools.count()
+
+        # guards everything below
+        self.lock = threading.Lock()
+
+        # notified when active empties out, for pause()
+        self.idle = threading.Condition(self.lock)
+
+        # set while the workers are allowed to look things up
+        self.running = threading.Event()
+        self.running.set()
+
+        # artist_str => (web_guess, artist_obj), least recently used first
+        self.results = OrderedDict()
+
+        # queued, being looked up
+        self.pending = set()
+        self.active = set()
+
+        # the part of pending only queued as prefetches, and the seq the current
+        # prefetches start at (queue entries before it are stale)
+        self.prefetched = set()
+        self.prefetch_from = 0
+
+        # artist_str => [listener]. only touched on the GUI thread
+        self.listeners = {}
+
+        for i in xrange(workers):
+            worker = threading.Thread(target=self._work)
+            worker.daemon = True
+            worker.start()
+
+    def request(self, artist_str, listener):
+        with self.lock:
+            result = self.results.pop(artist_str, None)
+
+            if result is not None:
+                self.results[artist_str] = result
+
+        if result is not None:
+            listener(artist_str, result[0], result[1], True)
+            return
+
+        self.listeners.setdefault(artist_str, []).append(listener)
+        self._queue(artist_str, LookupService.REQUEST)
+
+    def cancel(self, listener):
+        ''' listener doesn't want any more calls (its window is going away) '''
+
+        for (artist_str, listeners) in self.listeners.items():
+            if listener in listeners:
+                listeners.remove(listener)
+
+            if not listeners:
+                del self.listeners[artist_str]
+
+    def prefetch(self, artist_strs):
+        with self.lock:
+            # the old prefetches are for rows the user has moved on from
+            self.prefetch_from = self.seq.next()
+            self.pending -= self.prefetched
+            self.prefetched.clear()
+
+        for artist_str in artist_strs:
+            if artist_str:
+                self._queue(artist_str, LookupService.PREFETCH)
+
+    def pause(self):
+        self.running.clear()
+
+        with self.lock:
+            while self.active:
+                self.idle.wait()
+
+    def resume(self):
+        self.running.set()
+
+    def _queue(self, artist_str, priority):
+        with self.lock:
+            if artist_str in self.results: return
+
+            # a request for an artist already queued as a prefetch goes in again,
+            # ahead of the prefetches. whichever comes out second is skipped
+            if priority == LookupService.REQUEST:
+                self.prefetched.discard(artist_str)
+            elif artist_str in self.pending:
+                return
+            else:
+                self.prefetched.add(artist_str)
+
+            self.pending.add(artist_str)
+
+            self.queue.put((priority, self.seq.next(), artist_str))
+
+    def _work(self):
+        while True:
+            entry = self.queue.get()
+            (priority, seq, artist_str) = entry
+
+            self.running.wait()
+
+            with self.lock:
+                # paused again before we got the lock, put it back for later
+                if not self.running.is_set():
+                    self.queue.put(entry)
+                    continue
+
+                if priority == LookupService.PREFETCH and seq < self.prefetch_from: continue
+
+                # already done, or being done by another thread (which will tell
+                # the listeners)
+                if artist_str in self.active: continue
+
+                if artist_str in self.results:
+                    self.pending.discard(artist_str)
+                    self.prefetched.discard(artist_str)
+                    continue
+
+                self.active.add(artist_str)
+
+            try:
+                self._lookup(artist_str)
+            finally:
+                with self.lock:
+                    self.active.discard(artist_str)
+                    self.pending.discard(artist_str)
+                    self.prefetched.discard(artist_str)
+
+                    if not self.active:
+                        self.idle.notify_all()
+
+    def _lookup(self, artist_str):
+        web_guess = None
+        artist_obj = None
+        keep = False
+
+        try:
+            (net_error, web_guess) = tagGuessCache.queryGoogCache(artist_str)
+
+            if web_guess:
+                wx.CallAfter(self._deliver, artist_str, web_guess, None, False)
+
+                artist_obj = tagGuessCache.getRawArtistInfo(web_guess)
+
+            # try the network errors again next time
+            keep = not net_error
+
+        except Exception, e:
+            mylog.ERR('refine lookup failed for \'%s\': %s' % (artist_str, str(e)))
+            mylog.ERR(traceback.format_exc())
+
+        if keep:
+            with self.lock:
+                self.results[artist_str] = (web_guess, artist_obj)
+
+                while len(self.results) > self.cache_max:
+                    self.results.popitem(last=False)
+
+        wx.CallAfter(self._deliver, artist_str, web_guess, artist_obj, True)
+
+    def _deliver(self, artist_str, web_guess, artist_obj, is_done):
+        ''' on the GUI thread '''
+
+        if is_done:
+            listeners = self.listeners.pop(artist_str, [])
+        else:
+            listeners = self.listeners.get(artist_str, [])[:]
+
+        for listener in listeners:
+            listener(artist_str, web_guess, artist_obj, is_done)
+
+
+def snapshotMP3s():
+    ''' returns -> a copy of the global mp3 list, safe to work on unlocked '''
+
+    with globalz.MP3_MUTEX:
+        return list(globalz.MP3_OBJ_LIST)
+
+
+def swapMP3s(new_list):
+    ''' make new_list the global mp3 list '''
+
+    with globalz.MP3_MUTEX:
+        globalz.MP3_OBJ_LIST = new_list
 
 
 class DirTreeThread(threading.Thread):
@@ -93,14 +320,17 @@ class DirTreeThread(threading.Thread):
         cbwin -> ref to the parent window (need to know where to send done event)
         '''
         
+        setStatus = guiProgress(cbwin, 'dirtree_thread')
+
         try:
             mylog.INFO('exporting tag work to file \'%s\'' % dir_name)
 
-            with globalz.MP3_MUTEX:
-                scrubCmds.MakeDirTree(globalz.MP3_OBJ_LIST, dir_name)
+            scrubCmds.MakeDirTree(snapshotMP3s(), dir_name, setStatus)
 
-                del globalz.MP3_OBJ_LIST[:]
+            swapMP3s([])
        
+        except ThreadQuit: 
+            mylog.INFO('quitting dirtree_thread early...')
  
         except BaseException, e:
             mylog.ERR('error in DirTree' + str(e))
@@ -108,6 +338,7 @@ class DirTreeThread(threading.Thread):
             self.error_str = str(e)
 
         finally:
+            setStatus.finish()
             mylog.INFO('ending DirTree')
             wx.PostEvent(cbwin, globalz.WorkDoneEvent(src='DirTree', error_str=self.error_str))
 
@@ -120,17 +351,17 @@ class ExportThread(threading.Thread):
         self.error_str = ''
 
 
-    def doExport(self, xml_name='', cbwin=None):
+    def doExport(self, xml_name='', fmt=None, cbwin=None):
         '''
         xml_name -> xml tag file
+        fmt -> session format, see scrubCmds.ExportWork
         cbwin -> ref to the parent window (need to know where to send done event)
         '''
         
         try:
             mylog.INFO('exporting tag work to file \'%s\'' % xml_name)
 
-            with globalz.MP3_MUTEX:
-                scrubCmds.ExportWork(globalz.MP3_OBJ_LIST, xml_name)
+            scrubCmds.ExportWork(snapshotMP3s(), xml_name, fmt)
        
  
         except BaseException, e:
@@ -161,15 +392,12 @@ class ImportThread(threading.Thread):
         try:
             mylog.INFO('importing tag work from file \'%s\'' % xml_name)
 
-            with globalz.MP3_MUTEX:
-                scrubCmds.ImportWork(globalz.MP3_OBJ_LIST, xml_name)
+            mp3_list = snapshotMP3s()
 
-                # sort list (will order by artist name in the GUI)
-                tmp_sort = [ (i.orig_track.artist, i.orig_track.album, i) for i in globalz.MP3_OBJ_LIST ]  
-                tmp_sort.sort()
+            scrubCmds.ImportWork(mp3_list, xml_name)
 
-                del globalz.MP3_OBJ_LIST[:]
-                globalz.MP3_OBJ_LIST = [ i for (_, _, i) in tmp_sort ]
+            # the grid sorts it (see MP3Grid.sortBy)
+            swapMP3s(mp3_list)
         
   
         except BaseException, e:
@@ -199,39 +427,15 @@ class FindThread(threading.Thread):
         cbwin -> ref to the parent window (need to know where to send done event)
         '''
         
-        i = (x for x in xrange(50000))
-
         # callback (updates the progressDialog)
-        def setStatus(*args):
-            y = i.next()
-
-            if globalz.CANCEL_EVENT.isSet():
-                mylog.INFO('find_thread got cancel')
-
-                del globalz.MP3_OBJ_LIST[:]
-
-                globalz.CANCEL_EVENT.clear()
-
-                raise ThreadQuit
-
-            if args and (y % globalz.MAX_EVT == 0):
-                pctx = y % globalz.MAXROWS
-                txt = unicode(args[0])
-                wx.PostEvent(cbwin, globalz.StatusUpdateEvent(src='find_thread', pct=pctx, msg=txt))
-
+        setStatus = guiProgress(cbwin, 'find_thread', on_cancel=lambda: swapMP3s([]))
 
         try:
             # find all *.mp3 and read their current tags
-            with globalz.MP3_MUTEX:
-                raw_mp3_list = scrubCmds.FindMusic(dir_name, setStatus)
-
-                # sort list (will order by artist name in the GUI)
-                tmp_sort = [ (i.orig_track.artist, i.orig_track.album, i) for i in raw_mp3_list ]  
-                tmp_sort.sort()
-
-                del globalz.MP3_OBJ_LIST
+            raw_mp3_list = scrubCmds.FindMusic(dir_name, setStatus)
 
-                globalz.MP3_OBJ_LIST = [ i for (_, _, i) in tmp_sort ]
+            # the grid sorts it (see MP3Grid.sortBy)
+            swapMP3s(raw_mp3_list)
 
   
         except ThreadQuit: 
@@ -243,6 +447,7 @@ class FindThread(threading.Thread):
             self.error_str = str(e)
 
         finally:
+            setStatus.finish()
             mylog.INFO('ending find_thread')
             wx.PostEvent(cbwin, globalz.WorkDoneEvent(src='Find-Music', error_str=self.error_str))
 
@@ -263,30 +468,13 @@ class UpdateThread(threading.Thread):
         cbwin -> ref to the parent window (need to know where to send done event)
         '''
 
-        i = (x for x in xrange(50000))
-
         # callback (updates the progressDialog)
-        def setStatus(*args):
-            y = i.next()
-
-            if globalz.CANCEL_EVENT.isSet():
-                mylog.INFO('clean_thread got cancel')
-
-                globalz.CANCEL_EVENT.clear()
-
-                raise ThreadQuit
-
-            if args:
-                pctx = y % globalz.MAXROWS
-                txt = unicode(args[0])
-                wx.PostEvent(cbwin, globalz.StatusUpdateEvent(src='update_thread', pct=pctx, msg=txt))
-
+        setStatus = guiProgress(cbwin, 'update_thread')
 
         try:
             mylog.INFO('starting UpdateThread....')
 
-            with globalz.MP3_MUTEX:
-                scrubCmds.WriteMusic(globalz.MP3_OBJ_LIST, setStatus)
+            scrubCmds.WriteMusic(snapshotMP3s(), setStatus)
 
         except ThreadQuit: 
             mylog.INFO('quitting update_thread early...')
@@ -297,6 +485,7 @@ class UpdateThread(threading.Thread):
             self.error_str = str(e)
 
         finally:
+            setStatus.finish()
             mylog.INFO('ending update_thread')
             wx.PostEvent(cbwin, globalz.WorkDoneEvent(src='Write-Tags', error_str=self.error_str))
 
@@ -312,43 +501,24 @@ class CleanThread(threading.Thread):
         self.error_str = ''
 
 
-    def cleanMusic(self, cbwin=None, bar_max=globalz.MAXROWS):
+    def cleanMusic(self, cbwin=None, resume=False):
         '''
         cbwin -> ref to the parent window (need to know where to send done event)
-        bar_max -> length of the mp3 list. needed for progressDialog updating
+        resume -> pick up the last (cancelled/crashed) run where it left off
         '''
 
         mylog.INFO('cleaning up mp3 tags...')
 
-        i = (x for x in xrange(50000))
-
-        def setStatus(*args):
-            y = i.next()
-
-            if globalz.CANCEL_EVENT.isSet():
-                mylog.INFO('clean_thread got cancel')
-
-                globalz.CANCEL_EVENT.clear()
+        setStatus = guiProgress(cbwin, 'clean_thread', scrubCmds.IDENTIFY_PASSES)
 
-                raise ThreadQuit
-
-            if args and (y % globalz.MAX_EVT == 0):
-                pctx = y % bar_max
-                txt = unicode(args[0])
-                wx.PostEvent(cbwin, globalz.StatusUpdateEvent(src='clean_thread', pct=pctx, msg=txt))
+        # the refine lookups share tagGuessCache with the job, they wait until it's done
+        if globalz.LOOKUP_SERVICE:
+            globalz.LOOKUP_SERVICE.pause()
 
         try:
-            with globalz.MP3_MUTEX:
-
-                scrubCmds.IdentifyMusic(globalz.MP3_OBJ_LIST, setStatus)
-
-                # sort
-                tmp_sort = [ (i.clean_track.artist, i.clean_track.album, i) for i in globalz.MP3_OBJ_LIST ]  
-                tmp_sort.sort()
-
-                del globalz.MP3_OBJ_LIST
-
-                globalz.MP3_OBJ_LIST = [ i for (_, _, i) in tmp_sort ]
+            # the MP3Files in the copy are the ones in the grid, so the grid shows
+            # them changing (and keeps them sorted, see MP3Grid.sortBy)
+            scrubCmds.IdentifyMusic(snapshotMP3s(), setStatus, resume, globalz.MP3_CHANGES.add)
 
         except ThreadQuit: 
             mylog.INFO('quitting clean_thread early...')
@@ -359,5 +529,9 @@ class CleanThread(threading.Thread):
             self.error_str = str(e)
 
         finally:
+            if globalz.LOOKUP_SERVICE:
+                globalz.LOOKUP_SERVICE.resume()
+
+            setStatus.finish()
             mylog.INFO('ending clean_thread')
             wx.PostEvent(cbwin, globalz.WorkDoneEvent(src='Clean-Tags', error_str=self.error_str))
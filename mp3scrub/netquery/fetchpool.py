@@ -0,0 +1,169 @@
+'''Helpers to run a bunch of web queries at the same time without hammering the
+   remote site.
+
+   1. RateLimiter - token bucket shared by every thread talking to a service.
+                    callers block in acquire() until they're allowed another request.
+   2. parallelMap - map a function over a list with a bounded number of worker
+                    threads. results come back in the same order as the input list,
+                    so callers can build their trees exactly as they would serially.
+   3. imapUnordered - the same, but a generator that hands back each result as soon
+                    as it's ready, for long jobs that report progress (or get 
+                    cancelled) as they go.
+'''
+
+import threading
+import Queue
+import sys
+import time
+
+
+class RateLimiter(object):
+    '''token bucket. rate is the number of requests per second we're allowed to
+       make on average, burst is how many we can make back to back after idling.
+    '''
+
+    def __init__(self, rate, burst=1):
+        self.rate = float(rate)
+        self.burst = float(max(burst, 1))
+        self.tokens = self.burst
+        self.last = time.time()
+        self.lock = threading.Lock()
+
+    def _refill(self, now):
+        elapsed = now - self.last
+        self.last = now
+
+        if elapsed > 0:
+            self.tokens = min(self.burst, self.tokens + elapsed * self.rate)
+
+    def acquire(self):
+        ''' block until a token is available, then use it up '''
+
+        if self.rate <= 0: return
+
+        while True:
+            with self.lock:
+                self._refill(time.time())
+
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+
+                wait_secs = (1 - self.tokens) / self.rate
+
+            time.sleep(wait_secs)
+
+
+def parallelMap(func, items, max_workers):
+    '''call func(item) for every item using up to max_workers threads.
+
+       returns -> list of results, in the same order as items. if a call raises,
+                  the first exception (in item order) is re-raised once all the
+                  workers are done.
+    '''
+
+    items = list(items)
+
+    if max_workers <= 1 or len(items) <= 1:
+        return [ func(x) for x in items ]
+
+    results = [None] * len(items)
+    errors = [None] * len(items)
+    work_q = Queue.Queue()
+
+    for i, x in enumerate(items):
+        work_q.put((i, x))
+
+    def worker():
+        while True:
+            try:
+                i, x = work_q.get_nowait()
+            except Queue.Empty:
+                return
+
+            try:
+                results[i] = func(x)
+            except BaseException:
+                errors[i] = sys.exc_info()
+
+    threads = [ threading.Thread(target=worker) for _ in xrange(min(max_workers, len(items))) ]
+
+    for thr in threads:
+        thr.daemon = True
+        thr.start()
+
+    for thr in threads:
+        thr.join()
+
+    for err in errors:
+        if err:
+            raise err[0], err[1], err[2]
+
+    return results
+
+
+def imapUnordered(func, items, max_workers):
+    '''call func(item) for every item using up to max_workers threads, the items are
+       started in order.
+
+       yields -> each result as soon as it's ready (so not in order), on the calling
+                 thread. if a call raises, it's re-raised from here. closing the 
+                 generator early means no more calls get started, and the ones 
+                 running are waited for.
+    '''
+
+    items = list(items)
+
+    if max_workers <= 1 or len(items) <= 1:
+        for x in items:
+            yield func(x)
+        return
+
+    stop = threading.Event()
+    work_q = Queue.Queue()
+
+    # (result, exc_info)
+    result_q = Queue.Queue()
+
+    for x in items:
+        work_q.put(x)
+
+    def worker():
+        while not stop.is_set():
+            try:
+                x = work_q.get_nowait()
+            except Queue.Empty:
+                return
+
+            try:
+                result_q.put((func(x), None))
+            except BaseException:
+                result_q.put((None, sys.exc_info()))
+
+    threads = [ threading.Thread(target=worker) for _ in xrange(min(max_workers, len(items))) ]
+
+    for thr in threads:
+        thr.daemon = True
+        thr.start()
+
+    try:
+        for _ in xrange(len(items)):
+
+            # a timeout so ctrl-c still gets through
+            while True:
+                try:
+                    (result, err) = result_q.get(True, 1)
+                    break
+                except Queue.Empty:
+                    pass
+
+            if err:
+                raise err[0], err[1], err[2]
+
+            yield result
+
+    finally:
+        stop.set()
+
+        for thr in threads:
+            thr.join()
@@ -9,11 +9,11 @@
     go to last.fm, type in 'ozzy osborne', and observe the poor results.
 '''
  
-import urllib2
 import simplejson
 import types, sys, urllib
 import re, unicodedata
 from mp3scrub.util import mylog, strtool
+from mp3scrub.netquery import httpclient
 
 
 def trav(x):
@@ -45,16 +45,13 @@ def getresp(search_str):
     mylog.DBG1(9,'googURL: %s' % url)
 
     try:
-        request = urllib2.Request(
-            url, None, {'Referer': 'http://1024.us'})
-        response = urllib2.urlopen(request)
+        response = httpclient.CLIENT.get(url, service='google', endpoint='websearch',
+                                         headers={'Referer': 'http://1024.us'})
 
         # Process the JSON string.
-        results = simplejson.load(response)
+        results = simplejson.loads(response)
 
-        response.close()
-
-    except urllib2.URLError:
+    except httpclient.HTTPClientError:
         mylog.ERR('google query failed...possible connection down')
     
     return results
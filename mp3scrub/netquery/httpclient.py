@@ -0,0 +1,269 @@
+'''One HTTP layer shared by all the web queries (last.fm, google, musicbrainz).
+
+   A full run makes thousands of requests, so:
+
+   1. connections are kept alive and pooled per host instead of a new TCP
+      connection (and urllib2 opener) per request
+   2. each service gets its own token bucket (see fetchpool.RateLimiter), so
+      throttling is done in one place instead of sleep()s sprinkled everywhere
+   3. failures are retried with exponential backoff + jitter
+   4. latency/retry counters are kept per endpoint, see logStats()
+
+   Nothing in here is specific to a service, so it can be pointed at a local
+   stand-in HTTP server for testing, e.g. HTTPClient().get('http://127.0.0.1:8080/x')
+'''
+
+import httplib, urlparse, socket
+import threading
+import random
+import time
+from mp3scrub import globalz
+from mp3scrub.util import mylog
+from mp3scrub.netquery import fetchpool
+
+
+class HTTPClientError(Exception):
+    '''request failed for good. status is the HTTP status, or None if we never
+       got a response (connection refused, timeout, etc...)
+    '''
+
+    def __init__(self, url, status=None, reason=''):
+        Exception.__init__(self, '%s: %s %s' % (url, status, reason))
+        self.url = url
+        self.status = status
+        self.reason = reason
+
+
+class EndpointStats(object):
+    '''counters for one endpoint'''
+
+    def __init__(self):
+        self.requests = 0
+        self.retries = 0
+        self.failures = 0
+        self.total_secs = 0.0
+        self.max_secs = 0.0
+
+    def addLatency(self, secs):
+        self.requests += 1
+        self.total_secs += secs
+        self.max_secs = max(self.max_secs, secs)
+
+    def avgSecs(self):
+        return self.total_secs / self.requests if self.requests else 0.0
+
+    def __unicode__(self):
+        return (u'requests: %d retries: %d failures: %d avg: %.3fs max: %.3fs' %
+                (self.requests, self.retries, self.failures, self.avgSecs(), self.max_secs))
+
+
+class HTTPClient(object):
+    '''thread safe keep-alive HTTP GETter. see module doc.'''
+
+    RETRY_STATUS = (429, 500, 502, 503, 504)
+    REDIRECT_STATUS = (301, 302, 303, 307)
+    MAX_REDIRECTS = 3
+
+    def __init__(self, max_idle=globalz.HTTP_MAX_IDLE, timeout=globalz.HTTP_TIMEOUT,
+                       max_attempts=globalz.HTTP_MAX_ATTEMPTS,
+                       backoff_base=globalz.HTTP_BACKOFF_BASE,
+                       backoff_max=globalz.HTTP_BACKOFF_MAX):
+
+        self.max_idle = max_idle
+        self.timeout = timeout
+        self.max_attempts = max_attempts
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+
+        # (scheme, host, port) => [idle connections]
+        self.idle_conns = {}
+
+        # service name => RateLimiter
+        self.limiters = {}
+
+        # (service, endpoint) => EndpointStats
+        self.stats = {}
+
+        self.lock = threading.Lock()
+
+    def setRate(self, service, rate, burst=1):
+        ''' limit service to rate requests/sec. rate <= 0 means unlimited '''
+
+        with self.lock:
+            self.limiters[service] = fetchpool.RateLimiter(rate, burst)
+
+    def throttle(self, service):
+        ''' wait for our turn to hit service. get() does this for you '''
+
+        with self.lock:
+            limiter = self.limiters.get(service)
+
+        if limiter:
+            limiter.acquire()
+
+    def backoff(self, attempt):
+        ''' exponential backoff w/ jitter so a bunch of threads don't retry in lockstep '''
+
+        delay = min(self.backoff_max, self.backoff_base * (2 ** (attempt - 1)))
+        return delay * random.uniform(0.5, 1.5)
+
+    def _getStats(self, service, endpoint):
+        key = (service, endpoint)
+
+        if key not in self.stats:
+            self.stats[key] = EndpointStats()
+
+        return self.stats[key]
+
+    def _getConn(self, conn_key):
+        ''' returns (conn, is_reused) '''
+
+        with self.lock:
+            conns = self.idle_conns.get(conn_key)
+            if conns:
+                return (conns.pop(), True)
+
+        (scheme, host, port) = conn_key
+
+        if scheme == 'https':
+            conn = httplib.HTTPSConnection(host, port, timeout=self.timeout)
+        else:
+            conn = httplib.HTTPConnection(host, port, timeout=self.timeout)
+
+        return (conn, False)
+
+    def _putConn(self, conn_key, conn):
+        with self.lock:
+            conns = self.idle_conns.setdefault(conn_key, [])
+
+            if len(conns) < self.max_idle:
+                conns.append(conn)
+                return
+
+        conn.close()
+
+    def _request(self, url, headers):
+        ''' one GET, no retries. returns (status, reason, body, location) '''
+
+        parts = urlparse.urlsplit(url)
+        scheme = parts.scheme or 'http'
+        port = parts.port or (443 if scheme == 'https' else 80)
+        conn_key = (scheme, parts.hostname, port)
+
+        path = parts.path or '/'
+        if parts.query: path += '?' + parts.query
+
+        (conn, is_reused) = self._getConn(conn_key)
+
+        try:
+            conn.request('GET', path, None, headers)
+            resp = conn.getresponse()
+            body = resp.read()
+
+        except (httplib.HTTPException, socket.error):
+            conn.close()
+
+            # the server probably closed the idle connection on us. that's not a
+            # real failure, just try again on a fresh one
+            if not is_reused: raise
+
+            mylog.DBG1(6, 'stale connection to %s, reconnecting' % parts.hostname)
+            return self._request(url, headers)
+
+        if resp.will_close:
+            conn.close()
+        else:
+            self._putConn(conn_key, conn)
+
+        return (resp.status, resp.reason, body, resp.getheader('location'))
+
+    def get(self, url, service='default', headers=None, endpoint=None):
+        ''' GET url, retrying with backoff on connection errors and 5xx/429s.
+
+            url -> full url
+            service -> name of the rate limit bucket to use (see setRate)
+            headers -> dict of extra request headers
+            endpoint -> label to record stats under. defaults to host + path
+
+            returns -> response body (str)
+            raises -> HTTPClientError when we give up
+        '''
+
+        if not headers: headers = {}
+        if not endpoint:
+            parts = urlparse.urlsplit(url)
+            endpoint = parts.netloc + parts.path
+
+        attempt = 1
+        redirects = 0
+
+        while True:
+            self.throttle(service)
+
+            mylog.DBG1(4,'url: %s attempt: %d' % (url, attempt))
+
+            start = time.time()
+            status, reason, body, location = None, '', None, None
+
+            try:
+                (status, reason, body, location) = self._request(url, headers)
+            except (httplib.HTTPException, socket.error), e:
+                reason = str(e)
+
+            with self.lock:
+                self._getStats(service, endpoint).addLatency(time.time() - start)
+
+            if status in self.REDIRECT_STATUS and location and redirects < self.MAX_REDIRECTS:
+                redirects += 1
+                url = urlparse.urljoin(url, location)
+                continue
+
+            if status is not None and status < 400:
+                return body
+
+            if status is not None and status not in self.RETRY_STATUS:
+                with self.lock:
+                    self._getStats(service, endpoint).failures += 1
+
+                raise HTTPClientError(url, status, reason)
+
+            if attempt >= self.max_attempts:
+                with self.lock:
+                    self._getStats(service, endpoint).failures += 1
+
+                raise HTTPClientError(url, status, reason)
+
+            mylog.ERR('http error %s on \'%s\', retrying...' % (status, url))
+
+            with self.lock:
+                self._getStats(service, endpoint).retries += 1
+
+            time.sleep(self.backoff(attempt))
+            attempt += 1
+
+    def getStats(self):
+        ''' returns -> dict of (service, endpoint) => EndpointStats (copy) '''
+
+        with self.lock:
+            return dict(self.stats)
+
+    def logStats(self):
+        for (service, endpoint), stat in sorted(self.getStats().items()):
+            mylog.INFO('HTTPSTATS: %s %s %s' % (service, endpoint, unicode(stat)))
+
+    def close(self):
+        ''' drop all the idle connections '''
+
+        with self.lock:
+            for conns in self.idle_conns.values():
+                for conn in conns:
+                    conn.close()
+
+            self.idle_conns.clear()
+
+
+# the client everybody shares
+CLIENT = HTTPClient()
+
+for _service, (_rate, _burst) in globalz.HTTP_SERVICE_RATES.items():
+    CLIENT.setRate(_service, _rate, _burst)
@@ -5,14 +5,23 @@
    2. getArtistsAlbums - given string returned from #1, list of popular albums
    3. getAlbumDetails - given album_mbid #2, list of likely last.fm IDs
    4. getAlbumTracks - given id from #3, returns tracks 
+
+   responses are never turned into a DOM, each api method's records are pulled 
+   straight out of the xml as it's parsed (see lfmparse, recordSpec).
+
+   getAllArtistInfo/getManyArtistInfo glue those together, fanning the per album
+   requests out over a few threads (see fetchpool). all requests go through the
+   'lastfm' bucket of the shared http client, so we never go over the last.fm rate
+   limit no matter how many threads are busy.
 '''
 
-import urllib, urllib2, httplib, sys
-from xml.dom.minidom import parseString 
-import time
+import urllib, urllib2, urlparse, sys, os
+import hashlib
+import xml.parsers.expat
 from mp3scrub import globalz
 from mp3scrub.util.musicTypes import Artist, Album, Track
-from mp3scrub.util import mylog, findxml
+from mp3scrub.util import mylog
+from mp3scrub.netquery import fetchpool, httpclient, lfmparse
 
 
 class XMLTAG:
@@ -29,50 +38,112 @@ class XMLTAG:
    ALBUMRANK = 'playcount'
   
 
+def _urlMethod(url):
+    ''' the api method of a last.fm url, e.g. 'album.getinfo' '''
+
+    return urlparse.parse_qs(urlparse.urlsplit(url).query).get('method', [''])[0]
+
+def recordSpec(method):
+    ''' what the callers want out of each api method's response:
+        (tag, fields, limit, within), see lfmparse.parseRecords
+    '''
+
+    specs = { 'album.getinfo'       : (XMLTAG.ALBUMNODE, 
+                                       (XMLTAG.ALBUMARTIST, XMLTAG.ALBUMID, 
+                                        XMLTAG.ALBUMNAME, XMLTAG.ALBUMRANK),
+                                       globalz.MAX_POTENTIAL_ALBUM_MATCH, None),
+              'playlist.fetch'      : (XMLTAG.TRACKNODE, (XMLTAG.TRACKNAME,), None, 
+                                       XMLTAG.TRACKLIST),
+              'artist.search'       : (XMLTAG.ARTIST, (XMLTAG.ARTISTNAME,), None, None),
+              'artist.gettopalbums' : (XMLTAG.ALBUMNODE, (XMLTAG.ALBUMMBID,), 
+                                       globalz.MAX_ALBUM_MATCH, None) }
+
+    return specs[method]
+
+def _recordResponse(method, url, ret_str):
+    ''' save a response to LASTFM_RECORD_DIR, as a fixture for the BENCH '''
+
+    if isinstance(url, unicode):
+        url = url.encode('utf-8')
+
+    file_name = '%s-%s.xml' % (method, hashlib.md5(url).hexdigest())
+
+    try:
+        with open(os.path.join(globalz.LASTFM_RECORD_DIR, file_name), 'wb') as fl:
+            fl.write(ret_str)
+    except IOError, e:
+        mylog.ERR('can\'t record response for \'%s\': %s' % (url, str(e)))
+
 def genericQuery(url):
-    ''' low level HTTP request to last.fm. retries a few if failure.
+    ''' low level HTTP request to last.fm. the http client retries a few if failure.
 
-        returns XML obj if ok, None if not 
+        returns the response str if ok, None if not 
     '''
 
+    # keep the http stats per api method, they all share the same path
+    method = _urlMethod(url)
+
     key = urllib.urlencode({'api_key' : globalz.API_KEY})
-    url += ('&' + key)
-    request = urllib2.Request(url, None, {'User-Agent': 'http://1024.us'})
 
-    attempt = 1
-    ret_str = ''
-    dom_obj = None
+    try:
+        ret_str = httpclient.CLIENT.get(url + '&' + key, service='lastfm', endpoint=method,
+                                        headers={'User-Agent': 'http://1024.us'})
 
-    # don't hammer the site
-    time.sleep(.1)
-    
-    while True:
+    except httpclient.HTTPClientError:
+        mylog.ERR('MAX http error on \'%s\' returning None...' % url)   
+        return None            
 
-        if attempt == 4: 
-            mylog.ERR('MAX http error on \'%s\' returning None...' % url)   
-            return None            
+    if globalz.LASTFM_RECORD_DIR:
+        _recordResponse(method, url, ret_str)
+  
+    return ret_str 
 
-        mylog.DBG1(4,'url: %s attempt: %d' % (url, attempt))
+def recordQuery(url):
+    ''' genericQuery, then pull out the records for the url's api method 
+        (see recordSpec).
 
-        try:
-            response = urllib2.urlopen(request)
-            ret_str = response.read()
-            response.close()
-            break
+        returns list of tuples if ok, None if not 
+    '''
 
-        except (urllib2.HTTPError, httplib.BadStatusLine, urllib2.URLError): 
-            mylog.ERR('http error on \'%s\', retrying...' % url)   
-            attempt += 1
-            time.sleep(2)
+    ret_str = genericQuery(url)
+
+    if ret_str is None: return None
+
+    (tag, fields, limit, within) = recordSpec(_urlMethod(url))
 
-   
     try:
-        my_dom = parseString(ret_str)
-    except:
-        mylog.ERR('xml dom error on \'%s\'. returning None' % url)   
-        my_dom = None
-  
-    return my_dom 
+        return lfmparse.parseRecords(ret_str, tag, fields, limit, within)
+    except xml.parsers.expat.ExpatError:
+        mylog.ERR('xml error on \'%s\'. returning None' % url)   
+        return None
+
+def _getAlbumInfo(album_mbid):
+   ''' details + tracklist for one album mbid. runs in a fetchpool worker.
+
+       returns -> (album_str, album_id, album_rank, tracks) or None if no usable album
+   '''
+   mylog.DBG("getAllArtistInfo: searching for album mbid %s" % (album_mbid))
+   mbid_matches = []
+
+   try:
+      mbid_matches = getAlbumDetails(album_mbid)
+   except urllib2.HTTPError:
+      mylog.ERR('HTTP err. cannot find album match for MBID %s' % (album_mbid))
+      return None
+
+   ''' annoying RESTfulness, gotta GET 234432 resources to find the track details needed '''
+   for maybe_album in mbid_matches:
+
+      mylog.DBG("getAllArtistInfo: potential album %s" % (maybe_album))
+      album_str = maybe_album.get('name')
+      album_id = maybe_album.get('id')
+      album_rank = maybe_album.get('rank')
+
+      if album_str and album_id: 
+         return (album_str, album_id, album_rank, getAlbumTracks(album_id))
+
+   return None
+
 
 def getAllArtistInfo(fixed_artist_str):
    ''' given a corrected artist name via prior api call (preferbly google), returns struct below 
@@ -85,6 +156,9 @@ def getAllArtistInfo(fixed_artist_str):
                 TrackObj2
                 TrackObj3
              AlbumObj2
+
+       the album lookups are done in parallel (LASTFM_THREADS at a time), but the
+       albums are added in the same order as getArtistsAlbums returned them.
 '''
    artist_obj = Artist()
 
@@ -101,40 +175,35 @@ def getAllArtistInfo(fixed_artist_str):
    mbid_list = getArtistsAlbums(artist_obj.name)
 
    ''' get the details for each top album '''
-   for album_mbid in mbid_list:
-      mylog.DBG("getAllArtistInfo: searching for album mbid %s" % (album_mbid))
-      mbid_matches = []
+   album_infos = fetchpool.parallelMap(_getAlbumInfo, mbid_list, globalz.LASTFM_THREADS)
+
+   for album_info in album_infos:
+      if not album_info: continue
 
-      try:
-         mbid_matches = getAlbumDetails(album_mbid)
-      except urllib2.HTTPError:
-         mylog.ERR('HTTP err. cannot find album match for MBID %s' % (album_mbid))
-         continue
+      (album_str, album_id, album_rank, tracks) = album_info
 
-      ''' annoying RESTfulness, gotta GET 234432 resources to find the track details needed '''
-      for maybe_album in mbid_matches:
+      album_obj = Album(artist_obj.name, album_str, album_id, album_rank)
 
-         mylog.DBG("getAllArtistInfo: potential album %s" % (maybe_album))
-         artist_name = maybe_album.get('artist')
-         album_str = maybe_album.get('name')
-         album_id = maybe_album.get('id')
-         album_rank = maybe_album.get('rank')
+      for track in tracks:
+         track_obj = Track(_album=album_str, _name=track[0], _track_num=track[1])
+         album_obj.addTrack(track_obj) 
+         album_obj.total_tracks += 1
 
-         album_obj = Album(artist_obj.name, album_str, album_id, album_rank)
+      artist_obj.addAlbum(album_obj)
 
-         if album_str and album_id: 
+   return artist_obj
 
-            tracks = getAlbumTracks(album_id)
+def getManyArtistInfo(fixed_artist_strs):
+   ''' getAllArtistInfo for several artists at once (LASTFM_ARTIST_THREADS at a time) 
 
-            for track in tracks:
-               track_obj = Track(_album=album_str, _name=track[0], _track_num=track[1])
-               album_obj.addTrack(track_obj) 
-               album_obj.total_tracks += 1
+       returns -> dict of fixed_artist_str => ArtistObj
+   '''
+   artist_strs = list(fixed_artist_strs)
 
-            artist_obj.addAlbum(album_obj)
-            break
+   artist_objs = fetchpool.parallelMap(getAllArtistInfo, artist_strs, 
+                                       globalz.LASTFM_ARTIST_THREADS)
 
-   return artist_obj
+   return dict(zip(artist_strs, artist_objs))
 
 def getAlbumDetails(album_mbid):
     ''' given an album mbid, returns a list of potential album_id matches. 
@@ -144,32 +213,27 @@ def getAlbumDetails(album_mbid):
 
     album_mbid_url = urllib.urlencode({'mbid' : album_mbid})
     url = 'http://ws.audioscrobbler.com/2.0/?method=album.getinfo&' + album_mbid_url
-    my_dom = genericQuery(url)
+    album_recs = recordQuery(url)
 
-    if not my_dom: 
+    if album_recs is None: 
         mylog.ERR('bad DOM for %s' % album_mbid_url)
         return []
 
-    album_nodes = my_dom.getElementsByTagName(XMLTAG.ALBUMNODE)
     album_strs = []
 
-    hits = 0
-    for album_node in album_nodes:
-        if hits == globalz.MAX_POTENTIAL_ALBUM_MATCH: break
-        hits += 1
+    # only the first MAX_POTENTIAL_ALBUM_MATCH, see recordSpec
+    for (artist_str, id_str, name_str, rank_str) in album_recs:
 
         album_info = {'artist' : '', 'id' : '', 'name' : ''}
-        album_info['artist'] = findxml.safeChildGet(album_node, XMLTAG.ALBUMARTIST)
-        album_info['id'] = findxml.safeChildGet(album_node, XMLTAG.ALBUMID)
-        album_info['name'] = findxml.safeChildGet(album_node, XMLTAG.ALBUMNAME)
-        album_info['rank'] = findxml.safeChildGet(album_node, XMLTAG.ALBUMRANK)
+        album_info['artist'] = artist_str
+        album_info['id'] = id_str
+        album_info['name'] = name_str
+        album_info['rank'] = rank_str
         mylog.DBG1(4, "getAlbumDetails: for album %s appending potential name %s" % 
                   (album_mbid, album_info.get('name')))
 
         album_strs.append(album_info)
 
-    del my_dom
-
     return album_strs
 
 def getAlbumTracks(album_id):
@@ -179,26 +243,17 @@ def getAlbumTracks(album_id):
 
     url = 'http://ws.audioscrobbler.com/2.0/?method=playlist.fetch&playlistURL=lastfm://playlist/album/' + album_id
 
-    my_dom = genericQuery(url)
-    if not my_dom: 
+    track_recs = recordQuery(url)
+    if track_recs is None: 
         mylog.ERR('bad DOM for %s' % album_id)
         return []
 
     tracks = []
 
-    track_root = my_dom.getElementsByTagName(XMLTAG.TRACKLIST) 
-
-    if track_root:
-        track_nodes = track_root[0].getElementsByTagName(XMLTAG.TRACKNODE) 
-        track_num = 1
-        for track_node in track_nodes:
-            track_str = findxml.safeChildGet(track_node, XMLTAG.TRACKNAME)
-
-            mylog.DBG("getAlbumTracks: appending track %s number: %s" % (track_str, str(track_num)))
-            tracks.append((track_str, track_num))
-            track_num += 1
-
-        del my_dom
+    # only the tracks in the first trackList, see recordSpec
+    for track_num, (track_str,) in enumerate(track_recs, 1):
+        mylog.DBG("getAlbumTracks: appending track %s number: %s" % (track_str, str(track_num)))
+        tracks.append((track_str, track_num))
 
     return tracks
 
@@ -210,21 +265,17 @@ def artistSearch(artist_str):
 
     url = 'http://ws.audioscrobbler.com/2.0/?method=artist.search&' + artist_url
 
-    my_dom = genericQuery(url)
-    if not my_dom: 
+    artist_recs = recordQuery(url)
+    if artist_recs is None: 
         mylog.ERR('bad DOM for %s' % artist_str)
         return []
 
-    artist_nodes = my_dom.getElementsByTagName(XMLTAG.ARTIST)
     artist_names = []
 
-    for artist_node in artist_nodes:
-        fixed_artist_str = findxml.safeChildGet(artist_node, XMLTAG.ARTISTNAME)
+    for (fixed_artist_str,) in artist_recs:
         if fixed_artist_str:
             artist_names.append(fixed_artist_str)
 
-    del my_dom
-
     return artist_names
 
 def getArtistsAlbums(artist_str):
@@ -234,30 +285,89 @@ def getArtistsAlbums(artist_str):
 
     url = unicode(u'http://ws.audioscrobbler.com/2.0/?method=artist.gettopalbums&' + artist_url).encode('utf-8')
 
-    my_dom = genericQuery(url)
-    if not my_dom: 
+    album_recs = recordQuery(url)
+    if album_recs is None: 
         mylog.ERR('bad DOM for %s' % artist_str)
         return []
 
     album_mbids = []
 
-    album_nodes = my_dom.getElementsByTagName(XMLTAG.ALBUMNODE)
-
-    hits = 0
-    for album_node in album_nodes:
-        if hits == globalz.MAX_ALBUM_MATCH: break
-        hits += 1
-
-        mbid = findxml.safeChildGet(album_node, XMLTAG.ALBUMMBID)
+    # only the first MAX_ALBUM_MATCH, see recordSpec
+    for (mbid,) in album_recs:
         if mbid:
             mylog.DBG("getArtistsAlbums: for artist %s appending album mbid %s" % (artist_str, mbid))
             album_mbids.append(mbid)
 
-    del my_dom
-
     return album_mbids
 
 
+def _peakKB(fn, *args):
+    ''' run fn in a forked child, returns -> how many KB its peak rss went up by '''
+
+    import resource
+
+    (rd, wr) = os.pipe()
+    pid = os.fork()
+
+    if pid == 0:
+        os.close(rd)
+        before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        fn(*args)
+        after = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        os.write(wr, str(after - before))
+        os._exit(0)
+
+    os.close(wr)
+    ret = os.read(rd, 64)
+    os.close(rd)
+    os.waitpid(pid, 0)
+
+    return int(ret)
+
+def benchParse(fixture_dir, loops=20):
+    ''' parse every response recorded in fixture_dir (see LASTFM_RECORD_DIR) with
+        lfmparse and with the old minidom way, check they agree and time them.
+    '''
+
+    import time
+
+    fixtures = []
+
+    for file_name in sorted(os.listdir(fixture_dir)):
+        if not file_name.endswith('.xml'): continue
+
+        method = file_name.split('-')[0]
+
+        with open(os.path.join(fixture_dir, file_name), 'rb') as fl:
+            fixtures.append((file_name, fl.read(), recordSpec(method)))
+
+    if not fixtures:
+        sys.exit('no fixtures in %s' % fixture_dir)
+
+    def parseAll(parse_fn):
+        for (_, xml_str, spec) in fixtures:
+            parse_fn(xml_str, *spec)
+
+    for (file_name, xml_str, spec) in fixtures:
+        if lfmparse.parseRecords(xml_str, *spec) != lfmparse.parseRecordsDOM(xml_str, *spec):
+            print 'MISMATCH: %s' % file_name
+
+    results = []
+
+    for (name, parse_fn) in [ ('minidom', lfmparse.parseRecordsDOM),
+                              ('stream', lfmparse.parseRecords) ]:
+        start = time.time()
+
+        for i in xrange(loops):
+            parseAll(parse_fn)
+
+        results.append((name, time.time() - start, _peakKB(parseAll, parse_fn)))
+
+    for (name, secs, peak_kb) in results:
+        print '%-8s %d responses x %d: %.3fs (%.1fx) peak +%dKB' % \
+              (name, len(fixtures), loops, secs, results[0][1] / secs, peak_kb)
+
+
 def printEach(x):
     for y in x:
        print '[ ',
@@ -266,12 +376,14 @@ def printEach(x):
        print ']\n\n\n'
 
 if __name__ == '__main__':
+   usage = 'usage: %s [ARTISTALBUMS|ALBUM|ARTIST|TRACKS|ALL|BENCH] artist_str|fixture_dir' % sys.argv[0]
+
    werd = ''
    try:
       werd = sys.argv[2]
       type = sys.argv[1]
    except IndexError:
-      sys.exit('usage: %s [ARTISTALBUMS|ALBUM|ARTIST|TRACKS|ALL] artist_str' % sys.argv[0])
+      sys.exit(usage)
 
    if type == 'ARTISTALBUMS':
       printEach(getArtistsAlbums(werd))
@@ -284,6 +396,7 @@ if __name__ == '__main__':
    elif type == 'ALL':
       all = getAllArtistInfo(werd)
       print all
+   elif type == 'BENCH':
+      benchParse(werd)
    else:
-      sys.exit('usage: %s [ARTISTALBUMS|ALBUM|ARTIST|TRACKS|ALL] artist_str' % sys.argv[0])
-
+      sys.exit(usage)
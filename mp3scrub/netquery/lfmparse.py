@@ -0,0 +1,230 @@
+'''streaming parser for last.fm responses.
+
+   the lastfmquery functions only ever want a few child values out of each of the
+   <album>/<artist>/<track> nodes in a response, i.e.
+
+       for node in dom.getElementsByTagName(tag)[:limit]:
+           [ findxml.safeChildGet(node, field) for field in fields ]
+
+   parseRecords gives back exactly that, straight from expat callbacks, without
+   building a DOM. it only remembers the records it's collecting, and it stops
+   reading as soon as it has limit of them.
+
+   quirks of the DOM version that are kept, so callers see the same values:
+     - a field is the first child node of the first child element with that name
+       that has any children. an empty element is skipped, an element whose first
+       child is another element gives None.
+     - text is only the first text node (so up to the first child element, comment
+       or CDATA section), a CDATA section or comment first gives its contents.
+     - a missing field is u''.
+'''
+
+import xml.parsers.expat
+from xml.dom.minidom import parseString
+from mp3scrub.util import findxml
+
+
+class _StopParse(Exception):
+    pass
+
+
+class _Record(object):
+    '''one tag node being collected'''
+
+    __slots__ = ('seq', 'depth', 'values', 'field', 'field_depth', 'kind', 'buf')
+
+    def __init__(self, seq, depth):
+        self.seq = seq
+        self.depth = depth
+        self.values = {}
+
+        # the field child we're reading the first node of, if any
+        self.field = None
+        self.field_depth = 0
+
+        # None, 'text' or 'cdata', what the first node is so far
+        self.kind = None
+        self.buf = []
+
+
+class RecordParser(object):
+    '''see parseRecords'''
+
+    def __init__(self, tag, fields, limit=None, within=None):
+        self.tag = tag
+        self.fields = fields
+        self.limit = limit
+        self.within = within
+
+    def _reset(self):
+        self.depth = 0
+        self.seq = 0
+        self.open_recs = []
+        self.done_recs = []
+
+        # within: None = not seen yet, depth of it once seen
+        self.within_depth = None
+
+    def _setField(self, rec, val):
+        rec.values[rec.field] = val
+        rec.field = None
+        rec.kind = None
+        rec.buf = []
+
+    def _endText(self, rec):
+        ''' something other than text showed up in the field we're reading '''
+
+        if rec.kind == 'text':
+            self._setField(rec, u''.join(rec.buf))
+
+    def _start(self, name, attrs):
+        depth = self.depth
+        self.depth += 1
+
+        for rec in self.open_recs:
+            if rec.field is not None:
+                if depth == rec.field_depth + 1:
+                    if rec.kind is None:
+                        # first child is an element, it has no nodeValue
+                        self._setField(rec, None)
+                    else:
+                        self._endText(rec)
+
+            elif depth == rec.depth + 1 and name in self.fields and name not in rec.values:
+                rec.field = name
+                rec.field_depth = depth
+
+        if self.within is not None:
+            if self.within_depth is None:
+                if name == self.within: self.within_depth = depth
+                return
+
+            if depth <= self.within_depth: return
+
+        if name == self.tag:
+            self.open_recs.append(_Record(self.seq, depth))
+            self.seq += 1
+
+    def _end(self, name):
+        self.depth -= 1
+        depth = self.depth
+
+        for rec in self.open_recs:
+            if rec.field is not None and depth == rec.field_depth:
+                if rec.kind == 'text':
+                    self._setField(rec, u''.join(rec.buf))
+                else:
+                    # empty, try the next one with this name
+                    rec.field = None
+
+        if self.open_recs and self.open_recs[-1].depth == depth:
+            rec = self.open_recs.pop()
+            self.done_recs.append((rec.seq, tuple([ rec.values.get(f, u'') for f in self.fields ])))
+
+            if self.limit is not None and not self.open_recs and \
+               len(self.done_recs) >= self.limit:
+                raise _StopParse()
+
+        if self.within_depth is not None and depth == self.within_depth:
+            raise _StopParse()
+
+    def _chars(self, data):
+        for rec in self.open_recs:
+            if rec.field is None or self.depth != rec.field_depth + 1: continue
+
+            if rec.kind is None:
+                rec.kind = 'text'
+
+            rec.buf.append(data)
+
+    def _comment(self, data):
+        for rec in self.open_recs:
+            if rec.field is None or self.depth != rec.field_depth + 1: continue
+
+            if rec.kind is None:
+                self._setField(rec, data)
+            else:
+                self._endText(rec)
+
+    def _startCdata(self):
+        for rec in self.open_recs:
+            if rec.field is None or self.depth != rec.field_depth + 1: continue
+
+            if rec.kind is None:
+                rec.kind = 'cdata'
+            else:
+                self._endText(rec)
+
+    def _endCdata(self):
+        for rec in self.open_recs:
+            if rec.field is not None and rec.kind == 'cdata' and \
+               self.depth == rec.field_depth + 1:
+                self._setField(rec, u''.join(rec.buf))
+
+    def parse(self, xml_str):
+        ''' returns -> list of tuples, one value per field, for each tag node.
+            raises xml.parsers.expat.ExpatError on bad xml.
+        '''
+
+        self._reset()
+
+        parser = xml.parsers.expat.ParserCreate()
+        parser.buffer_text = True
+        parser.StartElementHandler = self._start
+        parser.EndElementHandler = self._end
+        parser.CharacterDataHandler = self._chars
+        parser.CommentHandler = self._comment
+        parser.StartCdataSectionHandler = self._startCdata
+        parser.EndCdataSectionHandler = self._endCdata
+
+        try:
+            parser.Parse(xml_str, True)
+        except _StopParse:
+            pass
+
+        self.done_recs.sort()
+
+        recs = [ vals for (_, vals) in self.done_recs ]
+
+        if self.limit is not None:
+            del recs[self.limit:]
+
+        return recs
+
+
+def parseRecords(xml_str, tag, fields, limit=None, within=None):
+    ''' xml_str -> the response
+        tag -> node name to collect
+        fields -> names of the child values wanted from each node
+        limit -> only the first limit nodes, None for all of them
+        within -> only look under the first node with this name
+
+        returns -> list of tuples of unicode (see module doc for the quirks)
+        raises xml.parsers.expat.ExpatError on bad xml
+    '''
+
+    return RecordParser(tag, fields, limit, within).parse(xml_str)
+
+
+def parseRecordsDOM(xml_str, tag, fields, limit=None, within=None):
+    ''' the same thing done the old way with minidom, for checking/benchmarking '''
+
+    my_dom = parseString(xml_str)
+
+    root = my_dom
+
+    if within is not None:
+        within_nodes = my_dom.getElementsByTagName(within)
+        if not within_nodes: return []
+        root = within_nodes[0]
+
+    nodes = root.getElementsByTagName(tag)
+
+    if limit is not None:
+        nodes = nodes[:limit]
+
+    recs = [ tuple([ findxml.safeChildGet(node, f) for f in fields ]) for node in nodes ]
+
+    my_dom.unlink()
+
+    return recs
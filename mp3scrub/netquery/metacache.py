@@ -0,0 +1,97 @@
+'''on-disk cache for the web lookups (last.fm artist trees, google artist names).
+
+   one shelve record per lookup, written as soon as the lookup resolves, so a crash
+   hours into a job doesn't lose anything. records are only read when somebody asks
+   for them, so startup time and memory don't grow with the size of the cache.
+
+   every record remembers when it was stored, and is thrown away once it's older
+   than the ttl for its kind, so stale last.fm data gets looked up again.
+
+   a store can be close()d while another thread is still using it: after that
+   get() finds nothing and put()/sync() do nothing.
+'''
+
+import shelve
+import threading
+import time
+from mp3scrub.util import mylog
+
+
+class MetaStore(object):
+    '''keyed store of (kind, name) => value.
+
+       file_name -> the shelve file
+       ttls -> dict of kind => secs a record of that kind stays valid. 0 = forever
+    '''
+
+    def __init__(self, file_name, ttls=None):
+        self.file_name = file_name
+        self.ttls = ttls if ttls else {}
+        self.lock = threading.Lock()
+        self.closed = False
+
+        # protocol -1, the default protocol can't pickle everything we store
+        self.shelf = shelve.open(file_name, 'c', protocol=-1)
+
+    @staticmethod
+    def makeKey(kind, name):
+        ''' shelve keys have to be plain strs '''
+        return '%s:%s' % (kind, unicode(name).encode('utf-8'))
+
+    def get(self, kind, name, default=None):
+        ''' returns the stored value, or default if not there (or expired) '''
+
+        key = MetaStore.makeKey(kind, name)
+
+        with self.lock:
+            if self.closed: return default
+
+            try:
+                (stamp, val) = self.shelf[key]
+            except KeyError:
+                return default
+            except Exception, e:
+                mylog.ERR('bad cache record for \'%s\', dropping it: %s' % (key, str(e)))
+                self._drop(key)
+                return default
+
+            ttl = self.ttls.get(kind, 0)
+
+            if ttl and (time.time() - stamp) > ttl:
+                mylog.DBG1(6, 'cache record for \'%s\' expired' % key)
+                self._drop(key)
+                return default
+
+        return val
+
+    def _drop(self, key):
+        ''' delete a record, with the lock held. a bad record might not come out '''
+
+        try:
+            del self.shelf[key]
+        except Exception, e:
+            mylog.ERR('can\'t drop cache record \'%s\': %s' % (key, str(e)))
+
+    def put(self, kind, name, val):
+        ''' store val and flush it to disk right away '''
+
+        key = MetaStore.makeKey(kind, name)
+
+        with self.lock:
+            if self.closed: return
+
+            self.shelf[key] = (time.time(), val)
+            self.shelf.sync()
+
+    def sync(self):
+        with self.lock:
+            if self.closed: return
+
+            self.shelf.sync()
+
+    def close(self):
+        with self.lock:
+            if self.closed: return
+
+            self.closed = True
+            self.shelf.close()
@@ -1,17 +1,90 @@
-'''Wrappers for musicbrainz secret PUID generator and looker-upper'''
+'''Wrappers for musicbrainz secret PUID generator and looker-upper.
 
-from musicbrainz2.webservice import Query, TrackFilter, RequestError, WebServiceError
+   making a fingerprint means decoding the whole file, so lookupMany spreads that
+   over a process pool and does the (rate limited) web lookups on a few threads
+   as the fingerprints come in.
+'''
+
+from musicbrainz2.webservice import Query, TrackFilter, WebService, RequestError, \
+                                    WebServiceError, AuthenticationError, ResourceNotFoundError
 import musicdns, musicdns.cache
-import sys, os, time
+import sys, os
+import itertools
+import multiprocessing
+import threading
+import Queue
+from StringIO import StringIO
 from mp3scrub import globalz
 from mp3scrub.util import mylog 
+from mp3scrub.netquery import httpclient
+
+
+class PooledWebService(WebService):
+    ''' musicbrainz2 web service that goes through our shared http client, so the
+        lookups reuse connections and obey the 'musicbrainz' rate limit
+    '''
+
+    def get(self, entity, id_, include=(), filter={}, version='1'):
+        url = self._makeUrl(entity, id_, include, filter, version)
+
+        try:
+            body = httpclient.CLIENT.get(url, service='musicbrainz', endpoint=entity,
+                                         headers={'User-Agent': 'http://1024.us'})
+
+        except httpclient.HTTPClientError, e:
+            # same exceptions musicbrainz2's own WebService would throw
+            if e.status == 400:
+                raise RequestError(str(e), e)
+            elif e.status == 401:
+                raise AuthenticationError(str(e), e)
+            elif e.status == 404:
+                raise ResourceNotFoundError(str(e), e)
+            else:
+                raise WebServiceError(str(e), e)
+
+        return StringIO(body)
+
+
+# musicdns.initialize() only needs to happen once per process
+_MUSICDNS_READY = False
+
+def _initMusicDNS():
+    global _MUSICDNS_READY
+
+    if not _MUSICDNS_READY:
+        musicdns.initialize()
+        _MUSICDNS_READY = True
+
+
+def fingerprintEntry(entry):
+    ''' (i, mp3fn) -> (i, mp3fn, fingerprint, duration). fingerprint is None if the 
+        file couldn't be decoded. top level so it can run in a multiprocessing worker.
+    '''
+
+    (i, mp3fn) = entry
+
+    _initMusicDNS()
+
+    try:
+        (fingerprint, duration) = musicdns.create_fingerprint(mp3fn.encode('utf-8'))
+
+    except Exception as e:
+        mylog.ERR('couldnt fingerprint: %s reason: %s' % (mp3fn, e))
+        return (i, mp3fn, None, 0)
+
+    return (i, mp3fn, fingerprint, duration)
+
 
 class PUIDQuery():
+    ''' store -> optional puidstore.PUIDStore, so lookupTrack doesn't have to decode
+                 files it's seen before
+    '''
      
-    def __init__(self):
-        musicdns.initialize()
+    def __init__(self, store=None):
+        _initMusicDNS()
         self.cache = musicdns.cache.MusicDNSCache()
-        self.query = Query()
+        self.query = Query(PooledWebService())
+        self.store = store
 
     def getPUID(self,mp3fn):
         ''' hash generator '''
@@ -30,6 +103,24 @@ class PUIDQuery():
         finally:
             return puid 
 
+    def lookupFingerprint(self, fingerprint, duration):
+        ''' the MusicDNS half of getPUID, for a fingerprint made elsewhere 
+            (see fingerprintEntry). returns -> puid, '' if there isn't one
+        '''
+
+        if not fingerprint: return ''
+
+        httpclient.CLIENT.throttle('musicdns')
+
+        try:
+            puid = musicdns.lookup_fingerprint(fingerprint, duration, globalz.MUSICDNS_KEY)
+
+        except Exception as e:
+            mylog.ERR('couldnt look up fingerprint, reason: %s' % e)
+            puid = ''
+
+        return puid or ''
+
     def lookupPUID(self,puid):
         ''' after generating puid, attempt to look it up online '''
 
@@ -40,8 +131,7 @@ class PUIDQuery():
             return (artistStr, albumStr, trackStr, trackNum)
 
         try:
-            # limit 1 query per second according to doc
-            time.sleep(1)
+            # limit 1 query per second according to doc (see HTTP_SERVICE_RATES)
             filter = TrackFilter(puid=puid)
             results = self.query.getTracks(filter)
 
@@ -74,9 +164,169 @@ class PUIDQuery():
 
     def lookupTrack(self,mp3fn):
         ''' gen and lookup in one swell function '''
-   
-        puid = self.getPUID(mp3fn)
-        return self.lookupPUID(puid) 
+
+        file_key = None
+        rec = None
+
+        if self.store:
+            file_key = self.store.fileKey(mp3fn)
+            rec = self.store.get(file_key)
+
+        if rec and rec[1][0]:
+            return rec[1]
+
+        puid = rec[0] if rec else self.getPUID(mp3fn)
+        tags = self.lookupPUID(puid) 
+
+        if self.store:
+            self.store.put(file_key, puid, tags)
+
+        return tags
+
+
+def lookupMany(paths, procs=None, threads=None, query=None, store=None):
+    ''' lookupTrack for a list of files, as a pipeline: fingerprints get made on a
+        pool of procs processes and handed to threads lookup threads (the lookups 
+        are rate limited, see httpclient), which all share one PUIDQuery.
+
+        with a store (puidstore.PUIDStore), the whole list is looked up in it
+        first. files it has a track for are done, files it has a puid for skip the
+        fingerprinting, and everything looked up gets saved to it.
+
+        paths -> list of mp3 paths
+        procs -> fingerprinting processes, defaults to globalz.PUID_PROCS. 1 makes 
+                 them in this process (on a thread)
+        threads -> lookup threads, defaults to globalz.PUID_LOOKUP_THREADS
+        query -> PUIDQuery to use, one is made if not given
+
+        this is a generator, yielding (i, (artist, album, track, tracknum)) for 
+        paths[i] as each one finishes (so not in order). the results are yielded 
+        on the calling thread. stop iterating (or close() it) to cancel, the 
+        pool and threads get cleaned up.
+    '''
+
+    if not paths: return
+
+    if procs is None:
+        procs = globalz.PUID_PROCS or multiprocessing.cpu_count()
+
+    if threads is None:
+        threads = globalz.PUID_LOOKUP_THREADS
+
+    threads = max(1, threads)
+
+    if not query:
+        query = PUIDQuery()
+
+    stop = threading.Event()
+
+    # (i, puid, fingerprint, duration), puid None if it still has to be looked up
+    lookup_q = Queue.Queue()
+
+    # (i, tags, exc_info)
+    result_q = Queue.Queue()
+
+    # i => (puid, tags) from the store
+    (keys, recs) = store.prefetch(paths) if store else ([None] * len(paths), {})
+
+    # found, or nothing more to try for now (see puidstore)
+    done = []
+
+    for (i, (puid, tags)) in recs.items():
+        if puid and not tags[0]:
+            lookup_q.put((i, puid, None, 0))
+        else:
+            done.append((i, tags))
+
+    entries = [ (i, mp3fn) for (i, mp3fn) in enumerate(paths) if i not in recs ]
+
+    pool = None
+
+    if procs > 1 and len(entries) > 1:
+        pool = multiprocessing.Pool(procs, _initMusicDNS)
+        fingerprints = pool.imap_unordered(fingerprintEntry, entries)
+    else:
+        fingerprints = itertools.imap(fingerprintEntry, entries)
+
+    def feeder():
+        try:
+            while not stop.is_set():
+                try:
+                    # with a timeout, a terminated pool would leave us waiting forever
+                    entry = fingerprints.next(1) if pool else fingerprints.next()
+                except multiprocessing.TimeoutError:
+                    continue
+                except StopIteration:
+                    break
+
+                (i, mp3fn, fingerprint, duration) = entry
+                lookup_q.put((i, None, fingerprint, duration))
+
+        except BaseException:
+            result_q.put((None, None, sys.exc_info()))
+
+        finally:
+            for _ in xrange(threads):
+                lookup_q.put(None)
+
+    def looker():
+        while True:
+            entry = lookup_q.get()
+
+            if entry is None: return
+
+            # cancelled, just drain the queue
+            if stop.is_set(): continue
+
+            (i, puid, fingerprint, duration) = entry
+
+            try:
+                if puid is None:
+                    puid = query.lookupFingerprint(fingerprint, duration)
+
+                tags = query.lookupPUID(puid)
+
+                if store:
+                    store.put(keys[i], puid, tags)
+
+                result_q.put((i, tags, None))
+
+            except BaseException:
+                result_q.put((i, None, sys.exc_info()))
+
+    workers = [ threading.Thread(target=feeder) ]
+    workers += [ threading.Thread(target=looker) for _ in xrange(threads) ]
+
+    for thr in workers:
+        thr.daemon = True
+        thr.start()
+
+    try:
+        for (i, tags) in done:
+            yield (i, tags)
+
+        for _ in xrange(len(paths) - len(done)):
+
+            # a timeout so ctrl-c still gets through
+            while True:
+                try:
+                    (i, tags, err) = result_q.get(True, 1)
+                    break
+                except Queue.Empty:
+                    pass
+
+            if err:
+                raise err[0], err[1], err[2]
+
+            yield (i, tags)
+
+    finally:
+        stop.set()
+
+        if pool:
+            pool.terminate()
+            pool.join()
+
        
 if __name__ == '__main__':
 
@@ -87,8 +337,5 @@ if __name__ == '__main__':
         print 'please specify argv[1]'
         exit()
 
-    lookupObj = PUIDQuery()
-
-    for fn in filez:
-        (artistStr, albumStr, trackStr, trackNum) = lookupObj.lookupTrack(fn)
-        print ' '.join((artistStr, albumStr, trackStr, str(trackNum)))
+    for (i, (artistStr, albumStr, trackStr, trackNum)) in lookupMany(filez):
+        print filez[i], ' '.join((artistStr, albumStr, trackStr, str(trackNum)))
@@ -0,0 +1,84 @@
+'''on-disk cache of PASS 2 hashing results, so a file only ever gets decoded and
+   fingerprinted once.
+
+   records are keyed by the file's content, not its path: (size, mtime, partial
+   digest) (see util.dupfind.partialDigest), so moving/renaming a file doesn't
+   lose its record. each record is (puid, (artist, album, track, tracknum)), what
+   puidquery.PUIDQuery.lookupTrack gave back for it.
+
+   found tracks are kept forever. misses are kept for globalz.PUID_MISS_TTL, and if
+   they at least have a puid only the (cheap) musicbrainz half is redone for them.
+'''
+
+import os
+from mp3scrub import globalz
+from mp3scrub.util import mylog, dupfind
+from mp3scrub.netquery import metacache, fetchpool
+
+
+class PUIDStore(object):
+    '''see module doc. file_name -> the shelve file (see metacache.MetaStore)'''
+
+    def __init__(self, file_name):
+        self.store = metacache.MetaStore(file_name, {'puid' : 0,
+                                                     'nopuid' : globalz.PUID_MISS_TTL})
+
+    @staticmethod
+    def fileKey(path):
+        ''' returns -> the key for path's contents, None if it can't be read '''
+
+        try:
+            st = os.stat(path)
+            digest = dupfind.partialDigest(path)
+
+        except (IOError, OSError), e:
+            mylog.ERR('couldnt read %s for the puid store: %s' % (path, str(e)))
+            return None
+
+        return '%d:%d:%s' % (st.st_size, int(st.st_mtime), digest.encode('hex'))
+
+    def get(self, file_key):
+        ''' returns -> (puid, tags) stored for file_key, None if there isn't one '''
+
+        if not file_key: return None
+
+        rec = self.store.get('puid', file_key)
+
+        if rec is None:
+            rec = self.store.get('nopuid', file_key)
+
+        return rec
+
+    def put(self, file_key, puid, tags):
+        if not file_key: return
+
+        self.store.put('puid' if tags[0] else 'nopuid', file_key, (puid, tags))
+
+    def prefetch(self, paths, workers=None):
+        ''' look up a whole list of files at once (the digests get read on workers
+            threads, defaults to globalz.SCAN_WORKERS)
+
+            returns -> (keys, recs). keys[i] is the key of paths[i] (to put() its
+                       result later), recs is a dict of i => (puid, tags) for the
+                       files we have a record for
+        '''
+
+        if workers is None:
+            workers = globalz.SCAN_WORKERS
+
+        keys = fetchpool.parallelMap(PUIDStore.fileKey, paths, workers)
+
+        recs = {}
+
+        for i, file_key in enumerate(keys):
+            rec = self.get(file_key)
+
+            if rec is not None:
+                recs[i] = rec
+
+        mylog.INFO('puid store: %d of %d files already hashed' % (len(recs), len(paths)))
+
+        return (keys, recs)
+
+    def close(self):
+        self.store.close()
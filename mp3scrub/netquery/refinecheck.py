@@ -0,0 +1,151 @@
+'''regression harness for tagGuessCache.refineGuessCache. runs the heap based
+   _refineArtist and the original _refineArtistLegacy on the same guess caches and
+   checks they end up with exactly the same album assignments (and the same
+   pct_complete/pct_score floats on every album).
+
+   record real caches by setting globalz.GUESS_RECORD_DIR before a run, then:
+
+       python refinecheck.py guesscache-*.pkl
+
+   or make up some random ones:
+
+       python refinecheck.py SYNTH num_artists
+'''
+
+import sys, time, random
+import cPickle as pickle
+
+from mp3scrub.util.musicTypes import Album, Track
+from mp3scrub.netquery import tagGuessCache
+
+
+def _snapshot(track_cache, album_cache):
+    ''' everything a refine can change, in a form we can compare with == '''
+
+    ret = []
+
+    for artist in sorted(album_cache):
+        for album in sorted(album_cache[artist]):
+            ptr = album_cache[artist][album]
+            ret.append((artist, album, [ t.path for t in ptr.tracks ],
+                        getattr(ptr, 'pct_complete', None), getattr(ptr, 'pct_score', None)))
+
+    for artist in sorted(track_cache):
+        for path in sorted(track_cache[artist]):
+            ret.append((artist, path, track_cache[artist][path].albums[:]))
+
+    return ret
+
+
+def _runRefine(refine_fn, caches):
+    ''' run refine_fn on a copy of caches. returns -> (snapshot, secs) '''
+
+    (track_cache, album_cache) = pickle.loads(caches)
+
+    start = time.time()
+
+    for artist in sorted(album_cache):
+        refine_fn(album_cache[artist], track_cache[artist])
+
+    secs = time.time() - start
+
+    return (_snapshot(track_cache, album_cache), secs)
+
+
+def compareRefine(track_cache, album_cache):
+    ''' returns -> (list of differences, legacy secs, new secs) '''
+
+    caches = pickle.dumps((track_cache, album_cache), -1)
+
+    (legacy_snap, legacy_secs) = _runRefine(tagGuessCache._refineArtistLegacy, caches)
+    (new_snap, new_secs) = _runRefine(tagGuessCache._refineArtist, caches)
+
+    diffs = [ (x, y) for (x, y) in zip(legacy_snap, new_snap) if x != y ]
+
+    if len(legacy_snap) != len(new_snap):
+        diffs.append(('length', len(legacy_snap), len(new_snap)))
+
+    return (diffs, legacy_secs, new_secs)
+
+
+def synthCache(num_artists, num_albums=40, num_files=300, seed=0):
+    ''' random guess caches shaped like the real thing: every file guessed into
+        a handful of albums, lots of them live albums full of the same songs.
+
+        returns -> (track_cache, album_cache)
+    '''
+
+    rnd = random.Random(seed)
+
+    track_cache = {}
+    album_cache = {}
+
+    for i in xrange(num_artists):
+        artist = u'artist%d' % i
+        track_cache[artist] = {}
+        album_cache[artist] = {}
+
+        albums = []
+        for j in xrange(num_albums):
+            album_obj = Album(artist, u'album%d' % j, None, rnd.choice([1, 1, 2, 5, 100]),
+                              rnd.randint(8, 30))
+            albums.append(album_obj)
+            album_cache[artist][album_obj.name] = album_obj
+
+        for k in xrange(num_files):
+            path = u'/music/%s/%d.mp3' % (artist, k)
+
+            for album_obj in rnd.sample(albums, rnd.randint(1, 8)):
+                track_obj = Track(_album=album_obj.name, _name=u'track%d' % (k % 50),
+                                  _track_num=k % 30, _path=path)
+
+                if path not in track_cache[artist]:
+                    track_cache[artist][path] = track_obj.copy()
+                    del track_cache[artist][path].albums[:]
+
+                track_cache[artist][path].addAlbum(album_obj.name)
+                album_obj.addTrack(track_obj.copy())
+
+    return (track_cache, album_cache)
+
+
+def checkRefine(name, track_cache, album_cache):
+    ''' compare, print the results. returns -> True if they matched '''
+
+    (diffs, legacy_secs, new_secs) = compareRefine(track_cache, album_cache)
+
+    print '%s: %d artists %s legacy: %.3fs new: %.3fs' % \
+          (name, len(album_cache), 'OK' if not diffs else 'MISMATCH', legacy_secs, new_secs)
+
+    for diff in diffs[:10]:
+        print '    legacy: %s\n    new:    %s' % (unicode(diff[0]), unicode(diff[1:]))
+
+    return not diffs
+
+
+if __name__ == '__main__':
+    usage = 'usage: %s guesscache.pkl [guesscache.pkl...] | SYNTH num_artists' % sys.argv[0]
+
+    if len(sys.argv) < 2:
+        exit(usage)
+
+    ok = True
+
+    if sys.argv[1] == 'SYNTH':
+        try:
+            num_artists = int(sys.argv[2])
+        except (IndexError, ValueError):
+            exit(usage)
+
+        for seed in xrange(5):
+            (track_cache, album_cache) = synthCache(num_artists, seed=seed)
+            ok = checkRefine('synth seed %d' % seed, track_cache, album_cache) and ok
+
+    else:
+        for file_name in sys.argv[1:]:
+            with open(file_name, 'rb') as fl:
+                (track_cache, album_cache) = pickle.load(fl)
+
+            ok = checkRefine(file_name, track_cache, album_cache) and ok
+
+    exit(0 if ok else 1)
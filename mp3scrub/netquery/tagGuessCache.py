@@ -9,14 +9,23 @@
      ALBUM_GUESS_CACHE: these two dicts keep track of the same info (the artists, albums,
                  tracks, and associated mp3 path names). I use 2 dicts because it
                  makes the refineGuessCache algorithm much easier. 
+
+ ARTIST_INDEX_CACHE holds a util.matchindex.ArtistMatchIndex for every artist in 
+ ARTIST_META_CACHE, built when the artist is loaded, so updateGuessCache doesn't
+ have to clean and compare every track name for every mp3.
+
+ ARTIST_META_CACHE and GOOG_META_CACHE only hold what's been used this run. if 
+ PERSIST_CACHE_ON, they're backed by an on-disk MetaStore (see metacache) that
+ every lookup is written through to as soon as it resolves.
 '''
 
-import sys, pickle, os
+import sys, pickle, os, time
+import heapq
 
-from mp3scrub.util import strtool, mylog
+from mp3scrub.util import mylog, matchindex
 from mp3scrub import globalz
 from mp3scrub.util.musicTypes import Artist, Album, Track
-from mp3scrub.netquery import lastfmquery, googquery
+from mp3scrub.netquery import lastfmquery, googquery, metacache
 
 # track_cache['artist_name']['mp3Path'] = (Track obj)
 TRACK_GUESS_CACHE = {}
@@ -27,9 +36,15 @@ ALBUM_GUESS_CACHE = {}
 # artist_cache['artist_name'] = Artist obj
 ARTIST_META_CACHE = {}
 
+# index_cache['artist_name'] = ArtistMatchIndex obj
+ARTIST_INDEX_CACHE = {}
+
 # google artist lookup cache
 GOOG_META_CACHE = {}
 
+# on-disk backing for the two caches above. None if not persisting
+META_STORE = None
+
 
 def clearCache():
    ''' reset all the cache '''    
@@ -44,39 +59,83 @@ def _updateArtistCache(fixed_artist_str):
        details: will update the local cache so we only query lastfm once per artist.
    '''
 
-   # load up the artist info from last.fm
+   # load up the artist info from disk, or last.fm if we've never seen it
 
    if not fixed_artist_str in ARTIST_META_CACHE:
-      mylog.INFO('looking up %s metadata...' % fixed_artist_str)
-      ARTIST_META_CACHE[fixed_artist_str] = lastfmquery.getAllArtistInfo(fixed_artist_str) 
+      artist_obj = _loadStored('artist', fixed_artist_str)
+
+      if not artist_obj:
+         mylog.INFO('looking up %s metadata...' % fixed_artist_str)
+         artist_obj = lastfmquery.getAllArtistInfo(fixed_artist_str) 
+         _store('artist', fixed_artist_str, artist_obj)
+
+      ARTIST_META_CACHE[fixed_artist_str] = artist_obj
+
+   # prefetched/resumed artists show up in ARTIST_META_CACHE without going through
+   # here, so build the index the first time they're asked for
+   if not fixed_artist_str in ARTIST_INDEX_CACHE:
+      ARTIST_INDEX_CACHE[fixed_artist_str] = \
+         matchindex.ArtistMatchIndex(ARTIST_META_CACHE[fixed_artist_str])
 
    return ARTIST_META_CACHE[fixed_artist_str]
 
 
+def prefetchArtistCache(fixed_artist_strs):
+   ''' 
+       input:   iterable of clean artist names.
+       output:  None
+       details: looks up all the artists we don't have cached yet in parallel, so the
+                _updateArtistCache calls that follow are just dict lookups.
+   '''
+
+   missing = []
+
+   for artist_str in fixed_artist_strs:
+      if artist_str in ARTIST_META_CACHE or artist_str in missing: continue
+
+      artist_obj = _loadStored('artist', artist_str)
+
+      if artist_obj:
+         ARTIST_META_CACHE[artist_str] = artist_obj
+      else:
+         missing.append(artist_str)
+
+   if not missing: return
+
+   mylog.INFO('looking up metadata for %d artists...' % len(missing))
+
+   for artist_str, artist_obj in lastfmquery.getManyArtistInfo(missing).items():
+      _store('artist', artist_str, artist_obj)
+      ARTIST_META_CACHE[artist_str] = artist_obj
+
+
 def _updateTrackGuesses(artist_name, path_name, track_obj):
    if not TRACK_GUESS_CACHE.get(artist_name):
       TRACK_GUESS_CACHE[artist_name] = {}
 
    if not TRACK_GUESS_CACHE[artist_name].get(path_name):
       # only using track_obj as a trackname/trackno bean
-      TRACK_GUESS_CACHE[artist_name][path_name] = track_obj.copy() 
-      del TRACK_GUESS_CACHE[artist_name][path_name].albums[:]
+      TRACK_GUESS_CACHE[artist_name][path_name] = track_obj.copy(with_albums=False)
 
    TRACK_GUESS_CACHE[artist_name][path_name].addAlbum(track_obj.album)
 
 
 def _updateAlbumGuesses(artist_name, track_obj, album_obj):
+   ''' album_obj is the one in ARTIST_META_CACHE, it doesn't get changed. the guess
+       cache gets its own copy of the album info (without the tracks) the first time
+       a track lands on it. track_obj is added as is, so don't reuse it.
+   '''
+
    if not ALBUM_GUESS_CACHE.get(artist_name):
       ALBUM_GUESS_CACHE[artist_name] = {}   
 
    if not ALBUM_GUESS_CACHE[artist_name].get(album_obj.name):
-      ALBUM_GUESS_CACHE[artist_name][album_obj.name] = album_obj.copy()
-      del ALBUM_GUESS_CACHE[artist_name][album_obj.name].tracks[:]
+      ALBUM_GUESS_CACHE[artist_name][album_obj.name] = album_obj.copy(with_tracks=False)
 
    mylog.DBG1(4,'ALGDBG: adding track \'%s\' to album \'%s\'...' % 
              (track_obj.name, album_obj.name))
 
-   ALBUM_GUESS_CACHE[artist_name][album_obj.name].addTrack(track_obj.copy())
+   ALBUM_GUESS_CACHE[artist_name][album_obj.name].addTrack(track_obj)
 
 def getRawArtistInfo(artist_str):
    _updateArtistCache(artist_str)
@@ -93,78 +152,142 @@ def updateGuessCache(path_str, id3_track_str, fixed_artist_str):
    # lookup the full artist/album info if haven't already
    artist_obj = _updateArtistCache(fixed_artist_str)
 
-   # we loop through all the tracks, looking for the one with the least difference 
-   # from id3_track_str. see strtool for more info
-   for i,album_obj in enumerate(artist_obj.albums):
+   # for every album, the track with the least difference from id3_track_str 
+   # (junky parens removed). see strtool and matchindex for more info
+   matches = ARTIST_INDEX_CACHE[fixed_artist_str].match(id3_track_str)
 
-      if i > globalz.ALBUM_GUESS_LIMIT: break
+   for (album_obj, track_obj, targ_track_str, dist) in matches:
 
-      if not album_obj.name: 
-         mylog.DBG('null album length for artist \'%s\' track \'%s\'' % 
-                   (fixed_artist_str, id3_track_str))
-         continue 
+      mylog.DBG1(10,'track match: \'%s\' guesstrack: \'%s\' guessalbum: \'%s\' dist: %d' % 
+                    (id3_track_str, targ_track_str, album_obj.name, dist))
 
-      guess_album_obj = album_obj.copy()
+      best_track_obj = Track(_album=album_obj.name, _name=targ_track_str, 
+                             _track_num=track_obj.track_num, _path=path_str)
 
+      _updateTrackGuesses(artist_obj.name, path_str, best_track_obj)
+      _updateAlbumGuesses(artist_obj.name, best_track_obj, album_obj)
 
-      # remove junky parens. see strtool for details
-      clean_id3_track_str = strtool.removeTrackJunk(id3_track_str)
+      found_track = True
 
-      best_track_matches = []
+   return found_track
 
-      # loop through all the track in this album, searching for the specified track
-      for track_obj in album_obj.tracks:
 
-         targ_track_str = strtool.removeTrackJunk(track_obj.name) 
+def _scoreAlbum(ptr, tracks_found):
+   ''' rank an album guess by (%complete * %complete * albumRank * total_tracks) '''
 
-         mylog.DBG1(10,'comparing mytrack_obj: \'%s\' guesstrack: \'%s\' guessalbum: \'%s\'' % 
-                       (clean_id3_track_str, targ_track_str, album_obj.name))
+   # easiest to calculate % here
+   ptr.pct_complete = float(tracks_found) / ptr.total_tracks
+   ptr.pct_score = (ptr.pct_complete * ptr.pct_complete * ptr.rank * tracks_found)
 
+   mylog.DBG1(4,'ALGDBG: artist: %s album: %s complete: %f rank: %d found: %d' %
+                (ptr.artist, ptr.name, ptr.pct_complete, ptr.rank, tracks_found))
 
-         dist = strtool.trackCompare(clean_id3_track_str, targ_track_str)
+   return ptr.pct_score
 
-         if dist != -1:
-            mylog.DBG1(10,'track match: \'%s\' guesstrack: \'%s\' guessalbum: \'%s\'' % 
-                          (clean_id3_track_str, targ_track_str, album_obj.name))
 
-            guess_track_obj = Track(_album=album_obj.name, _name=targ_track_str, 
-                                    _track_num=track_obj.track_num, _path=path_str)
+class _AlbumRank(object):
+   ''' heap entry for _refineArtist. heapq pops the smallest, we want the biggest
+       (pct_score, album name) first. found is the album's track count when it was 
+       scored, if that's changed since the entry is stale.
+   '''
 
-            best_track_matches.append((dist, guess_track_obj))
+   __slots__ = ('key', 'name', 'found')
 
-      # if we found a match...
-      if best_track_matches:
-         # return the track with the least dist from id3's trackName  
-         best_track_matches.sort()
+   def __init__(self, score, name, found):
+      self.key = (score, name)
+      self.name = name
+      self.found = found
 
-         best_track_obj = best_track_matches[0][1]
+   def __lt__(self, other):
+      return self.key > other.key
 
-         _updateTrackGuesses(artist_obj.name, path_str, best_track_obj)
-         _updateAlbumGuesses(artist_obj.name, best_track_obj, guess_album_obj)
 
-         del best_track_matches
-         found_track = True
+def _refineArtist(albums_ptr, tracks_ptr):
+   ''' the REFINE STEPS (see refineGuessCache) for one artist.
 
-   return found_track
+       instead of rescoring and resorting every album after every track, albums sit
+       in a heap and only get rescored (and pushed again) when they lose a track. 
+       old heap entries are skipped when popped. an inverted index of path => albums
+       finds the albums to remove a track from without scanning them all, and the
+       removed tracks are only filtered out of the track lists when an album gets 
+       picked, and once at the end.
+   '''
 
+   # path => {album name: how many tracks with that path}
+   path_albums = {}
 
-def refineGuessCache():
-   ''' narrow down album guesses after everythings been processed.
+   # album name => tracks left
+   found = {}
 
-       REFINE STEPS
-       1. sort your albums from best to worst, ranked by: 
-                     (%complete * %complete * albumRank * total_tracks)
-      
-       2. look at all your tracks from your current top album.
-           a) remove all these tracks from lesser albums (cause they're a 
-              worse match)
-           b) add the current top album to a 'processed' list, so we don't 
-              process it again
-           c) since removing tracks from lesser albums will change their 
-              %complete rank, resort by going back to step 1
-      
-       3. repeat until all albums processed
+   # album name => paths removed from it
+   gone = {}
+
+   heap = []
+
+   for album in albums_ptr:
+      ptr = albums_ptr[album]
+
+      for trk in ptr.tracks:
+         counts = path_albums.setdefault(trk.path, {})
+         counts[album] = counts.get(album, 0) + 1
+
+      found[album] = len(ptr.tracks)
+      gone[album] = set()
+
+      if found[album]:
+         heap.append(_AlbumRank(_scoreAlbum(ptr, found[album]), album, found[album]))
+
+   heapq.heapify(heap)
+
+   processed_albums = set()
+
+   while heap:
+      entry = heapq.heappop(heap)
+      better_album = entry.name
+
+      if better_album in processed_albums or entry.found != found[better_album]: continue
+
+      processed_albums.add(better_album)
+
+      ptr = albums_ptr[better_album]
+
+      if gone[better_album]:
+         ptr.tracks[:] = [ t for t in ptr.tracks if t.path not in gone[better_album] ]
+         gone[better_album].clear()
+
+      for trk in ptr.tracks[:]:
+
+         mylog.DBG1(10,'keeping %s in %s\n' % (trk.name, better_album))
+
+         # delete the current trk in every album that's not here
+         for del_album, count in path_albums[trk.path].items():
+            if del_album == better_album or trk.path in gone[del_album]: continue
+
+            gone[del_album].add(trk.path)
+            found[del_album] -= count
+
+            if found[del_album] and del_album not in processed_albums:
+               del_ptr = albums_ptr[del_album]
+               heapq.heappush(heap, _AlbumRank(_scoreAlbum(del_ptr, found[del_album]), 
+                                               del_album, found[del_album]))
+
+         # delete all other albums from TRACK_GUESS_CACHE
+         if better_album in tracks_ptr[trk.path].albums:
+            tracks_ptr[trk.path].album = better_album
+         else:
+            del tracks_ptr[trk.path].albums[:]
+
+   for album in albums_ptr:
+      if gone[album]:
+         albums_ptr[album].tracks[:] = [ t for t in albums_ptr[album].tracks 
+                                         if t.path not in gone[album] ]
+
+
+def _refineArtistLegacy(albums_ptr, tracks_ptr):
+   ''' the original refine, resorting everything after every track. only kept to
+       check _refineArtist against, see refinecheck.
    '''
+
    def removeTrackElsewhere(track_obj, keep_album_str, alb_ptr, trkPtr):
       ''' helper function that keeps a track in one album but removes it everywhere else '''
 
@@ -172,11 +295,6 @@ def refineGuessCache():
 
       modded = False
 
-      if globalz.LOG_DEBUG > 8: 
-         for i,alb in enumerate(alb_ptr):
-            for y, trk in enumerate(alb_ptr[alb].tracks):
-               mylog.DBG1(8,'albName: \'%s\' albptrTrk1 %d: \'%s\'\n' % (alb, y, unicode(trk.name)))
-
       # delete the current track in every album that's not here
       for del_album in alb_ptr:
          if del_album == keep_album_str: continue
@@ -195,11 +313,6 @@ def refineGuessCache():
       else:
          del trkPtr[track_obj.path].albums[:]
 
-      if globalz.LOG_DEBUG > 8: 
-         for i,alb in enumerate(alb_ptr):
-            for y, trk in enumerate(alb_ptr[alb].tracks):
-               mylog.DBG1(8,'albName2: \'%s\' albptrTrk %d: \'%s\'\n' % (alb, y, unicode(trk.name)))
-
       return modded
 
    def reSortAlbums(my_albums, alb_ptr, skip_albums):
@@ -214,47 +327,73 @@ def refineGuessCache():
          if album in skip_albums: continue 
          if tracks_found == 0: continue
 
-         # easiest to calculate % here
-         ptr.pct_complete = float(tracks_found) / ptr.total_tracks
-         ptr.pct_score = (ptr.pct_complete * ptr.pct_complete * ptr.rank * tracks_found)
+         my_albums.append((_scoreAlbum(ptr, tracks_found), album))
 
-         mylog.DBG1(4,'ALGDBG: artist: %s album: %s complete: %f rank: %d found: %d' %
-                      (ptr.artist, ptr.name, ptr.pct_complete, ptr.rank, tracks_found))
+      my_albums.sort(reverse=True)
 
-         my_albums.append((ptr.pct_score, album))
 
-      my_albums.sort(reverse=True)
+   sort_all_albums = []
 
+   reSortAlbums(sort_all_albums, albums_ptr, [])
 
-   # iterate through the potential album list
-   for artist in sorted(ALBUM_GUESS_CACHE):
+   processed_albums = []
+
+   while sort_all_albums:
+
+      resort = False
+
+      for _, better_album in sort_all_albums:
+         if resort: break
+
+         ptr = albums_ptr[better_album]
 
-      albums_ptr = ALBUM_GUESS_CACHE[artist]
-      tracks_ptr = TRACK_GUESS_CACHE[artist]
-    
+         for trk in ptr.tracks[:]:
 
-      sort_all_albums = []
+            # delete the current trk in every album that's not here
+            removeTrackElsewhere(trk, better_album, albums_ptr, tracks_ptr)
+            processed_albums.append(better_album)
+            reSortAlbums(sort_all_albums, albums_ptr, processed_albums)
+            resort = True
 
-      reSortAlbums(sort_all_albums, albums_ptr, [])
 
-      processed_albums = []
+def recordGuessCache(dir_name):
+   ''' pickle the guess caches as they are before a refine, for refinecheck '''
 
-      while sort_all_albums:
+   file_name = os.path.join(dir_name, 'guesscache-%s-%d.pkl' % 
+                            (time.strftime('%Y%m%d%H%M%S'), len(TRACK_GUESS_CACHE)))
 
-         resort = False
+   with open(file_name, 'wb') as fl:
+      pickle.dump((TRACK_GUESS_CACHE, ALBUM_GUESS_CACHE), fl, -1)
 
-         for _, better_album in sort_all_albums:
-            if resort: break
+   mylog.INFO('recorded guess cache to %s' % file_name)
+
+
+def refineGuessCache():
+   ''' narrow down album guesses after everythings been processed.
+
+       REFINE STEPS
+       1. sort your albums from best to worst, ranked by: 
+                     (%complete * %complete * albumRank * total_tracks)
+      
+       2. look at all your tracks from your current top album.
+           a) remove all these tracks from lesser albums (cause they're a 
+              worse match)
+           b) add the current top album to a 'processed' list, so we don't 
+              process it again
+           c) since removing tracks from lesser albums will change their 
+              %complete rank, resort by going back to step 1
+      
+       3. repeat until all albums processed
 
-            ptr = albums_ptr[better_album]
+       (ties go to the album name that sorts last)
+   '''
 
-            for trk in ptr.tracks[:]:
+   if globalz.GUESS_RECORD_DIR:
+      recordGuessCache(globalz.GUESS_RECORD_DIR)
 
-               # delete the current trk in every album that's not here
-               removeTrackElsewhere(trk, better_album, albums_ptr, tracks_ptr)
-               processed_albums.append(better_album)
-               reSortAlbums(sort_all_albums, albums_ptr, processed_albums)
-               resort = True
+   # iterate through the potential album list
+   for artist in sorted(ALBUM_GUESS_CACHE):
+      _refineArtist(ALBUM_GUESS_CACHE[artist], TRACK_GUESS_CACHE[artist])
                   
 
 def searchGuessCache(artist_str, path_str):
@@ -306,28 +445,98 @@ def dbgPrint(fileDes):
                uniP('{0:>35} {1:>30}\n'.format('TRACK:', unicode(t)))
       uniP('\n\n\n')
 
+def _loadStored(kind, name):
+   ''' returns the on-disk record for name, or None '''
+
+   # dump() can run on another thread, so only look at META_STORE once
+   store = META_STORE
+
+   if store is None: return None
+
+   return store.get(kind, name)
+
+
+def _store(kind, name, val):
+   ''' write a resolved lookup through to disk '''
+
+   store = META_STORE
+
+   if store is None: return
+
+   store.put(kind, name, val)
+
+
+def _importPickle(pickle_file):
+   ''' one time import of the old style artists.pkl into the MetaStore '''
+
+   # the pickle is only removed once everything in it is in the store. one that
+   # can't even be loaded is moved aside (it'd fail again every run), one that
+   # fails going into the store is left alone for the next run
+   try:
+      with open(pickle_file,'rb') as fl:
+         artist_cache = pickle.load(fl)
+         goog_cache = pickle.load(fl)
+   except Exception, e:
+      bad_file = pickle_file + '.bad'
+
+      mylog.ERR('error loading pickle file %s, moving it to %s: %s' % 
+                (pickle_file, bad_file, str(e)))
+
+      try:
+         if os.path.exists(bad_file):
+            os.remove(bad_file)
+
+         os.rename(pickle_file, bad_file)
+      except OSError, e:
+         mylog.ERR('can\'t move %s aside, removing it: %s' % (pickle_file, str(e)))
+         os.remove(pickle_file)
+
+      return
+
+   mylog.INFO('importing %d artists from %s' % (len(artist_cache), pickle_file))
+
+   try:
+      for artist_str, artist_obj in artist_cache.items():
+         _store('artist', artist_str, artist_obj)
+
+      for artist_str, goog_pack in goog_cache.items():
+         _store('goog', artist_str, goog_pack)
+   except Exception, e:
+      mylog.ERR('error importing pickle file %s, keeping it: %s' % (pickle_file, str(e)))
+      return
+
+   os.remove(pickle_file)
+
+
 def undump():
-   ''' if we've already queried artist info in the past, load it up, son! '''
+   ''' if we've already queried artist info in the past, load it up, son! 
+
+       (opens the on-disk store, records are loaded when they're asked for)
+   '''
+
+   global META_STORE
+
+   if META_STORE is not None: return
 
-   global ARTIST_META_CACHE
-   global GOOG_META_CACHE
+   META_STORE = metacache.MetaStore(globalz.META_CACHE_FILE, 
+                                    {'artist' : globalz.ARTIST_CACHE_TTL,
+                                     'goog'   : globalz.GOOG_CACHE_TTL})
 
    if os.path.exists(globalz.PICKLE_FILE):
-      with open(globalz.PICKLE_FILE,'rb') as fl:
-         try:
-            ARTIST_META_CACHE = pickle.load(fl)
-            GOOG_META_CACHE = pickle.load(fl)
-         except:
-            mylog.ERR('error loading pickle file, continuing...')
-            ARTIST_META_CACHE = {}
-            GOOG_META_CACHE = {}
-            os.remove(globalz.PICKLE_FILE)
+      _importPickle(globalz.PICKLE_FILE)
 
 def dump():
-   ''' save off the artist info we've found for next time '''
-   with open(globalz.PICKLE_FILE,'wb') as fl:
-      pickle.dump(ARTIST_META_CACHE, fl,-1)
-      pickle.dump(GOOG_META_CACHE, fl,-1)
+   ''' save off the artist info we've found for next time 
+
+       (everything's already on disk, this just closes the store)
+   '''
+
+   global META_STORE
+
+   if META_STORE is None: return
+
+   META_STORE.close()
+   META_STORE = None
 
 
 
@@ -336,12 +545,23 @@ def queryGoogCache(artist_name):
  
    ret_pack = GOOG_META_CACHE.get(artist_name)
 
+   if not ret_pack:
+      ret_pack = _loadStored('goog', artist_name)
+
+      if ret_pack:
+         GOOG_META_CACHE[artist_name] = ret_pack
+
    if not ret_pack: 
       mylog.DBG1(10,'GOOG_META_CACHE: not found key \'%s\'' % (artist_name))
 
       GOOG_META_CACHE[artist_name] = googquery.googquery(unicode(artist_name).encode('utf-8'))
       ret_pack = GOOG_META_CACHE.get(artist_name)
 
+      # don't remember network errors across runs
+      (net_error, _) = ret_pack
+      if not net_error:
+         _store('goog', artist_name, ret_pack)
+
    else:
       mylog.DBG1(10,'GOOG_META_CACHE: found key \'%s\' val: \'%s\'' % (artist_name, unicode(ret_pack)))
 
@@ -354,7 +574,7 @@ if __name__ == '__main__':
    input_arg = ''
    processDir = False
 
-   globalz.PICKLE_FILE = 'meh.pkl'
+   globalz.META_CACHE_FILE = 'meh.db'
 
    # if we've already queried artist info in the past, load it up, son!
    undump()
@@ -3,85 +3,138 @@ as a CLI.
 '''
 
 import re, os
-from shutil import move
-from mp3scrub import globalz
-from mp3scrub.util import strtool, mylog, fileio
+import itertools
+import multiprocessing
+from mp3scrub import globalz, checkpoint, dirtree
+from mp3scrub.util import strtool, mylog, fileio, dupfind, scanindex, binsession, progress
 from mp3scrub.util.musicTypes import Artist, Album, Track, MP3File
-from mp3scrub.netquery import puidquery, tagGuessCache
+from mp3scrub.netquery import puidquery, puidstore, tagGuessCache, httpclient, fetchpool
 
 
-def ExportWork(mp3_list, file_name):
-    '''Wrapper for persisting the mp3 tags to an XML file.
+def ExportWork(mp3_list, file_name, fmt=None):
+    '''Wrapper for persisting the mp3 tags to a session file.
 
     mp3_list -> list of MP3File objects (supposedly populated via main.FindMusic) 
-    file_name -> name of the xml file to output
+    file_name -> name of the file to output
+    fmt -> 'xml', or 'bin' for the binary session format (see util.binsession, 
+           it saves every field). by default 'bin' if file_name ends with 
+           globalz.BIN_SESSION_EXT, else 'xml'
 
     returns -> None
     '''
 
-    fileio.exportMP3s(mp3_list, file_name)
+    if fmt is None:
+        fmt = 'bin' if file_name.endswith(globalz.BIN_SESSION_EXT) else 'xml'
 
+    if fmt == 'bin':
+        binsession.exportMP3s(mp3_list, file_name)
+    elif fmt == 'xml':
+        fileio.exportMP3s(mp3_list, file_name)
+    else:
+        raise ValueError('unknown session format \'%s\'' % fmt)
 
-def ImportWork(mp3_list, file_name):
+
+def ImportWork(mp3_list, file_name, fmt=None):
     '''load up a previously exported list 
     
-    file_name -> name of the xml file of exported list
+    file_name -> name of the exported session file
     mp3_list -> empty list to populate with MP3File's
+    fmt -> 'xml' or 'bin', see ExportWork. by default it's worked out from the file
 
     returns -> None
     '''
 
-    fileio.importMP3s(mp3_list, file_name)
+    if fmt is None:
+        fmt = 'bin' if binsession.isBinSession(file_name) else 'xml'
+
+    if fmt == 'bin':
+        binsession.importMP3s(mp3_list, file_name)
+    elif fmt == 'xml':
+        fileio.importMP3s(mp3_list, file_name)
+    else:
+        raise ValueError('unknown session format \'%s\'' % fmt)
 
 
-def MakeDirTree(mp3_list, dir_path):
+def MakeDirTree(mp3_list, dir_path, callback=None, workers=None, journal_file=None):
     '''Given a list of MP3File, will move the *.mp3 files they represnt to a new
     directory in dir_path. Will make a pretty tree with a new folder per artist.
 
+    every move is planned and journaled before anything moves, so if this gets
+    interrupted, ResumeDirTree can finish it or UndoDirTree can put everything back
+    (see dirtree).
+
     mp3_list -> list of MP3File objects (supposedly populated via main.FindMusic)
     dir_path -> directory to create the tree
+    callback -> optional function pointer funct(str) used to return status info
+    workers -> threads moving files, defaults to globalz.MOVE_WORKERS
+    journal_file -> defaults to globalz.MOVE_JOURNAL_FILE
 
-    returns -> None
+    returns -> number of files that couldn't be moved
     '''
 
     if not os.path.exists(dir_path):
         mylog.ERR('no existe \'%s\'' % dir_path)
+        return 0
 
+    if journal_file is None:
+        journal_file = globalz.MOVE_JOURNAL_FILE
 
-    for i,mp3 in enumerate(mp3_list):
-        if mp3.is_dup:
-            mylog.INFO('skipping dup track \'%s\'...' % (mp3.orig_track.path))
-            continue
+    journal = dirtree.MoveJournal(journal_file)
 
-        sub_dir = strtool.safeUni(mp3.clean_track.artist)
+    try:
+        journal.setPlan(dirtree.planMoves(mp3_list, dir_path))
+
+        return dirtree.runPlan(journal, callback, workers)
 
-        if not sub_dir or re.search(r'^\s+$', sub_dir):
-            sub_dir = strtool.safeUni(mp3.orig_track.artist)
+    finally:
+        journal.close()
 
-            if not sub_dir or re.search(r'^\s+$', sub_dir):
-                sub_dir = 'UNKNOWN'
 
-        new_dir = os.path.join(dir_path, sub_dir)
-        orig_path = mp3.orig_track.path
+def ResumeDirTree(callback=None, workers=None, journal_file=None):
+    '''Finish the moves of an interrupted MakeDirTree.
 
-        if not os.path.exists(new_dir):
-            try:
-                os.mkdir(new_dir)
-            except:
-                mylog.ERR('error creating \'%s\'...' % (orig_path))
-                continue
-                
+    returns -> number of files that couldn't be moved, -1 if there's no journal
+    '''
 
-        mylog.DBG('moving \'%s\' to \'%s\'...' % (orig_path, new_dir))
+    if journal_file is None:
+        journal_file = globalz.MOVE_JOURNAL_FILE
 
-        try:
-            move(orig_path, new_dir)
-        except:
-            mylog.ERR('error moving \'%s\' to \'%s\'...' % (orig_path, new_dir))
-            continue
-        
+    if not os.path.exists(journal_file):
+        mylog.ERR('no move journal \'%s\', nothing to resume' % journal_file)
+        return -1
+
+    journal = dirtree.MoveJournal(journal_file, resume=True)
+
+    try:
+        return dirtree.runPlan(journal, callback, workers)
+    finally:
+        journal.close()
+
+
+def UndoDirTree(callback=None, workers=None, journal_file=None):
+    '''Put every file the last MakeDirTree moved (finished or not) back where it
+    was, and remove the artist folders it made.
 
-def FindMusic(my_dir, callback, only_artist_str=''):
+    returns -> number of files that couldn't be moved back, -1 if there's no journal
+    '''
+
+    if journal_file is None:
+        journal_file = globalz.MOVE_JOURNAL_FILE
+
+    if not os.path.exists(journal_file):
+        mylog.ERR('no move journal \'%s\', nothing to undo' % journal_file)
+        return -1
+
+    journal = dirtree.MoveJournal(journal_file, resume=True)
+
+    try:
+        return dirtree.rollbackPlan(journal, callback, workers)
+    finally:
+        journal.close()
+
+
+def FindMusic(my_dir, callback, only_artist_str='', workers=None, dup_groups=None,
+              index_file=None, changes=None):
     '''Given a directory, will populate a list with all the *.mp3 files found in
     that directory (recursively) and read their current tag info. Usually the 
     first step in any use case. 
@@ -89,39 +142,69 @@ def FindMusic(my_dir, callback, only_artist_str=''):
     my_dir -> directory to search for *.mp3
     callback -> a function pointer funct(str) used to return status info 
     only_artist_str -> optional tag to only find artists matching this string
+    workers -> number of processes reading tags. defaults to globalz.SCAN_WORKERS,
+               1 reads them in this process. the list order is the same either way.
+    dup_groups -> optional empty list, populated with the groups of duplicate files 
+                  (see dupfind.DupFinder.getGroups)
+    index_file -> scan index (see util.scanindex), so only files that are new or 
+                  changed since the last scan get opened. defaults to 
+                  globalz.SCAN_INDEX_FILE, '' to read everything.
+    changes -> optional empty dict, populated with the 'added', 'removed' and
+               'changed' paths since the last scan (needs the scan index)
 
     returns -> mp3_list, a list of MP3File objects
     '''
 
-    mp3_list = []
+    if workers is None:
+        workers = globalz.SCAN_WORKERS
 
-    fileio.MP3Finder(my_dir, mp3_list, callback)
+    if index_file is None:
+        index_file = globalz.SCAN_INDEX_FILE
 
     new_mp3_list = []
 
-    for mp3_file in mp3_list:
+    if not os.path.exists(my_dir):
+        mylog.ERR('directory %s doesn\'t exist' % (my_dir))
+        return new_mp3_list
 
-        fn = mp3_file.orig_track.path
-        is_dup = mp3_file.is_dup
+    # paths get streamed to the workers while we're still walking the tree
+    dup_finder = dupfind.DupFinder()
+    scan_index = scanindex.ScanIndex(index_file) if index_file else None
+    entries = fileio.iterMusicFiles(my_dir, dup_finder, scan_index)
+    pool = None
+    walked = False
 
-        callback('processing: %s' % fn)
+    if workers > 1:
+        pool = multiprocessing.Pool(workers)
+        tag_records = pool.imap(fileio.readTagEntry, entries, globalz.SCAN_CHUNK)
+    else:
+        tag_records = itertools.imap(fileio.readTagEntry, entries)
 
-        
-        # load up the id3 tags from the mp3s in our xml list 
-        try:
-            id3_reader = fileio.Id3tool(fn)
+    # no total, the tree is walked as the files are read
+    progress.newPass(callback, 'finding')
+
+    try:
+        for (fn, is_dup, tags) in tag_records:
 
+            callback('processing: %s' % fn)
 
-            orig_mp3 = Track(_artist=id3_reader.readTag('artist'),
-                             _name=id3_reader.readTag('title'),
-                             _album=id3_reader.readTag('album'),
-                             _track_num=id3_reader.readTag('tracknumber'),
-                             _path=fn)
+            if scan_index:
+                scan_index.update(fn, tags, dup_finder.partials.get(unicode(fn)))
 
+            if not tags:
+                mylog.ERR('ID3 read failed on \'%s\'\n' % fn)
+
+                new_mp3_list.append(MP3File(my_path=fn, is_dup_flag=is_dup))
+                continue
+
+            (artist, title, album, track_num) = tags
+
+            orig_mp3 = Track(_artist=artist, _name=title, _album=album,
+                             _track_num=track_num, _path=fn)
 
             if only_artist_str:
                 srch = strtool.sanitizeTrackStr(only_artist_str)
-                artist = strtool.sanitizeTrackStr(mp3_obj.orig_track.artist)
+                artist = strtool.sanitizeTrackStr(orig_mp3.artist)
 
                 if not re.search(srch, artist, re.IGNORECASE):
                     mylog.DBG1(6,'skipping artist %s for match %s' % (srch, artist))
@@ -130,57 +213,134 @@ def FindMusic(my_dir, callback, only_artist_str=''):
             new_mp3_list.append(MP3File(orig_track=orig_mp3.copy(), 
                                 my_path=fn, is_dup_flag=is_dup))
 
+        walked = True
+
+    finally:
+        # also where we end up on a cancel (ThreadQuit from the callback)
+        if pool:
+            pool.terminate()
+            pool.join()
+
+        if scan_index:
+            # on a cancel we keep the records already read, but the walk didn't
+            # finish so we can't tell what was removed
+            if walked:
+                (added, removed, changed) = scan_index.finish(my_dir, dup_finder)
+
+                if changes is not None:
+                    changes.update({'added' : added, 'removed' : removed, 'changed' : changed})
 
-        except:
-            mylog.ERR('ID3 read failed on \'%s\'\n' % fn)
+            scan_index.close()
 
-            new_mp3_list.append(MP3File(my_path=fn, is_dup_flag=is_dup))
+    groups = dup_finder.getGroups()
+    mylog.INFO('found %d groups of duplicate files' % len(groups))
 
-    del mp3_list
+    if dup_groups is not None:
+        dup_groups.extend(groups)
 
     return new_mp3_list
 
 
-def WriteMusic(mp3_list, callback):
+def _writeMP3(mp3):
+    ''' write one MP3File's clean_track to its file. 
+
+        returns -> (mp3, written, error_str). written is True if the file changed,
+                   False if it already had the tags. error_str is None unless the 
+                   write failed
+    '''
+
+    if not os.path.exists(mp3.orig_track.path):
+        return (mp3, False, 'no existe')
+
+    try:
+        written = fileio.writeTagEntry(mp3.orig_track.path,
+                                       (mp3.clean_track.artist, mp3.clean_track.name,
+                                        mp3.clean_track.album, mp3.clean_track.track_num))
+    except Exception, e:
+        return (mp3, False, str(e) or e.__class__.__name__)
+
+    return (mp3, written, None)
+
+
+def WriteMusic(mp3_list, callback, workers=None, failures=None):
     '''Given a list of MP3File, will write to the *.mp3 files the new tag info stored
     in the MP3File.
 
 
     mp3_list -> list of MP3File objects (supposedly populated via main.FindMusic)
     callback -> a function pointer funct(str) used to return status info 
+    workers -> threads writing tags, defaults to globalz.WRITE_WORKERS. 1 writes them
+               in this thread. files are written a directory at a time either way, 
+               and files that already have the new tags aren't touched.
+    failures -> optional empty list, populated with (path, reason) for every file 
+                that couldn't be written
 
     returns -> None
     '''
 
-    for i,mp3 in enumerate(mp3_list):
+    if workers is None:
+        workers = globalz.WRITE_WORKERS
 
-        callback('updating tags for %s...' % mp3.orig_track.path)
+    jobs = []
 
-        if not os.path.exists(mp3.orig_track.path):
-            mylog.ERR('no existe \'%s\'' % mp3.orig_track.path)
-            continue
+    for mp3 in mp3_list:
 
         if mp3.result != MP3File.QRY_RESULT.FIELDS_CHANGED:
             mylog.ERR('failed cleanup for \'%s\', skipping' % mp3.orig_track.path)
             continue
 
-        try:
-            mylog.INFO('writing tags to fn: %s' % mp3.orig_track.path)
-            id3_writer = fileio.Id3tool(mp3.orig_track.path)
+        jobs.append(mp3)
 
-            id3_writer.writeTag('artist', mp3.clean_track.artist) 
-            id3_writer.writeTag('title', mp3.clean_track.name) 
-            id3_writer.writeTag('album', mp3.clean_track.album) 
-            id3_writer.writeTag('tracknumber', mp3.clean_track.track_num) 
-            id3_writer.save()
+    # neighbouring files are next to each other on the disk (and in the os caches)
+    jobs.sort(key=lambda mp3: os.path.split(mp3.orig_track.path))
 
-        except:
-            mylog.ERR('ID3 write failed on \'%s\'\n' % mp3.orig_track.path)
-            continue
+    (written, unchanged, failed) = (0, 0, 0)
+
+    progress.newPass(callback, 'writing', len(jobs))
+
+    # the results come back on this thread, so the callback can still cancel (the
+    # writes already going get finished first)
+    results = fetchpool.imapUnordered(_writeMP3, jobs, workers)
+
+    try:
+        for (mp3, is_written, error_str) in results:
+
+            if error_str:
+                mylog.ERR('ID3 write failed on \'%s\': %s\n' % (mp3.orig_track.path, error_str))
+                callback('failed to update tags for %s: %s' % (mp3.orig_track.path, error_str))
 
+                if failures is not None:
+                    failures.append((mp3.orig_track.path, error_str))
 
+                failed += 1
 
-def IdentifyMusic(mp3_list, callback=None):
+            elif is_written:
+                mylog.INFO('wrote tags to fn: %s' % mp3.orig_track.path)
+                callback('updated tags for %s' % mp3.orig_track.path)
+                written += 1
+
+            else:
+                mylog.DBG1(3, 'tags already up to date for fn: %s' % mp3.orig_track.path)
+                callback('tags already up to date for %s' % mp3.orig_track.path)
+                unchanged += 1
+
+    finally:
+        results.close()
+
+        mylog.INFO('tags written: %d already up to date: %d failed: %d' % 
+                   (written, unchanged, failed))
+
+
+
+def _noChange(mp3_obj):
+    pass
+
+
+# how many progress.newPass calls IdentifyMusic makes, for a progress.Progress
+IDENTIFY_PASSES = 4
+
+
+def IdentifyMusic(mp3_list, callback=None, resume=False, changed=None):
     '''The meat of the entire program. Loops through a list of MP3File objs, and will
     attempt to find better tag matches for the artist, album, track, and tracknum.
 
@@ -193,55 +353,120 @@ def IdentifyMusic(mp3_list, callback=None):
 
     callback -> a function pointer funct(str) used to return status info 
 
+    resume -> pick up where the last run left off (see checkpoint.RunJournal). files
+              already finished in a pass are not looked up again.
+
+    changed -> a function pointer funct(MP3File), called with each file as its
+               refined tags change (so a GUI can show the results as they come in)
+
     returns -> None
     '''
 
+    if changed is None:
+        changed = _noChange
+
     if globalz.PERSIST_CACHE_ON:
         tagGuessCache.undump()
 
+    journal = checkpoint.RunJournal(globalz.JOURNAL_FILE, resume, mp3_list)
+
     try:
 
+        # whole run finished last time, just put the results back. if any file
+        # didn't make it into the journal, do the run again (the files that did
+        # skip the lookups in passes 1 and 2)
+        if journal.isPassDone(3):
+            missing = len([ 1 for mp3_obj in mp3_list if not journal.restore(3, mp3_obj) ])
+
+            if not missing:
+                mylog.INFO('last run already finished, restoring results')
+
+                for mp3_obj in mp3_list:
+                    changed(mp3_obj)
+
+                return mp3_list
+
+            mylog.INFO('last run finished without %d files, running again for them' % missing)
+
         # PASS 1: use google to refine the artist name
-        for mp3_count, mp3_obj in enumerate(mp3_list):
+        progress.newPass(callback, 'pass1', len(mp3_list))
 
-            if callback:
-                callback('pass1: %s - %s' % (mp3_obj.orig_track.artist, mp3_obj.orig_track.name))
+        for chunk_start in xrange(0, len(mp3_list), globalz.PREFETCH_CHUNK):
 
-            # use google instead of last.fm to correct the artist name
-            (net_error, web_guess) = tagGuessCache.queryGoogCache(mp3_obj.orig_track.artist) 
+            chunk = mp3_list[chunk_start:chunk_start + globalz.PREFETCH_CHUNK]
 
-            if not net_error:
+            # use google instead of last.fm to correct the artist names for this chunk
+            web_guesses = []
 
-                if web_guess:
+            for mp3_obj in chunk:
 
-                    # run some heuristics to make sure the artist makes sense
-                    if strtool.artistCompare(mp3_obj.orig_track.artist, web_guess):
-                        mp3_obj.clean_track.artist = web_guess
+                if callback:
+                    callback('pass1: %s - %s' % (mp3_obj.orig_track.artist, mp3_obj.orig_track.name))
 
-                        # now look up the last.fm track list for the top 10 albums of artist
-                        is_track_found = tagGuessCache.updateGuessCache(mp3_obj.orig_track.path, 
-                                                                        mp3_obj.orig_track.name, 
-                                                                        mp3_obj.clean_track.artist)
+                # already done in a previous run
+                if journal.restore(1, mp3_obj):
+                    web_guesses.append(None)
+                    continue
 
-                        if not is_track_found: 
-                            mp3_obj.result = MP3File.QRY_RESULT.TRACK_NOT_FOUND 
-                            mp3_obj.clean_track.artist = mp3_obj.orig_track.artist 
-                        else:
-                            mp3_obj.result = MP3File.QRY_RESULT.OK
+                web_guesses.append(tagGuessCache.queryGoogCache(mp3_obj.orig_track.artist))
+
+            # fan out the last.fm lookups for every artist name that looks sane
+            tagGuessCache.prefetchArtistCache([ web_pack[1] for (mp3_obj, web_pack) 
+                                                in zip(chunk, web_guesses) 
+                                                if web_pack and not web_pack[0] and web_pack[1] and
+                                                strtool.artistCompare(mp3_obj.orig_track.artist, web_pack[1]) ])
+
+            for mp3_count, (mp3_obj, web_pack) in enumerate(zip(chunk, web_guesses), chunk_start):
+
+                if not web_pack:
+                    changed(mp3_obj)
+
+                    # restored from the journal. the artist info came back with it, so
+                    # this just rebuilds the guess cache without any web lookups
+                    if mp3_obj.result == MP3File.QRY_RESULT.OK:
+                        tagGuessCache.updateGuessCache(mp3_obj.orig_track.path, 
+                                                       mp3_obj.orig_track.name, 
+                                                       mp3_obj.clean_track.artist)
+                    continue
+
+                (net_error, web_guess) = web_pack
+
+                if not net_error:
+
+                    if web_guess:
+
+                        # run some heuristics to make sure the artist makes sense
+                        if strtool.artistCompare(mp3_obj.orig_track.artist, web_guess):
+                            mp3_obj.clean_track.artist = web_guess
+
+                            # now look up the last.fm track list for the top 10 albums of artist
+                            is_track_found = tagGuessCache.updateGuessCache(mp3_obj.orig_track.path, 
+                                                                            mp3_obj.orig_track.name, 
+                                                                            mp3_obj.clean_track.artist)
 
+                            if not is_track_found: 
+                                mp3_obj.result = MP3File.QRY_RESULT.TRACK_NOT_FOUND 
+                                mp3_obj.clean_track.artist = mp3_obj.orig_track.artist 
+                            else:
+                                mp3_obj.result = MP3File.QRY_RESULT.OK
+
+                        else:
+                            mp3_obj.result = MP3File.QRY_RESULT.ARTIST_BAD_MATCH
+                            mp3_obj.clean_track.artist = mp3_obj.orig_track.artist 
                     else:
-                        mp3_obj.result = MP3File.QRY_RESULT.ARTIST_BAD_MATCH
+                        mp3_obj.result = MP3File.QRY_RESULT.ARTIST_NOT_FOUND
                         mp3_obj.clean_track.artist = mp3_obj.orig_track.artist 
                 else:
-                    mp3_obj.result = MP3File.QRY_RESULT.ARTIST_NOT_FOUND
+                    mp3_obj.result = MP3File.QRY_RESULT.NET_ERROR
                     mp3_obj.clean_track.artist = mp3_obj.orig_track.artist 
-            else:
-                mp3_obj.result = MP3File.QRY_RESULT.NET_ERROR
-                mp3_obj.clean_track.artist = mp3_obj.orig_track.artist 
 
-            if (mp3_count % 100) == 0:
-                mylog.INFO('processed %d files' % (mp3_count))
+                journal.record(1, mp3_obj)
+                changed(mp3_obj)
+
+                if (mp3_count % 100) == 0:
+                    mylog.INFO('processed %d files' % (mp3_count))
 
+        journal.passDone(1)
 
         if globalz.CACHE_DEBUG_ON:
             with open('pprint.txt','w') as f:
@@ -255,6 +480,9 @@ def IdentifyMusic(mp3_list, callback=None):
         # PASS 2: use lastfm and musicbrainz for better track/album info
         tagGuessCache.refineGuessCache()
 
+        progress.newPass(callback, 'pass2: lastfm', 
+                         len([ 1 for mp3_obj in mp3_list if mp3_obj.result == MP3File.QRY_RESULT.OK ]))
+
         # see if we found a guess in last.fm
         for mp3_obj in mp3_list:
 
@@ -276,36 +504,87 @@ def IdentifyMusic(mp3_list, callback=None):
                     mp3_obj.clean_track.track_num = guess_track_obj.track_num
                     mp3_obj.method1 = MP3File.METHOD.ID3ID
 
+                changed(mp3_obj)
+
         # now use musicbrainz for what lastfm couldn't find 
         # (skip NET_ERROR tracks too...want to be clear in the gui that 
         #  these tracks failed due to network problems, not algorithm failure
+        hash_list = []
+
         for mp3_obj in mp3_list:
 
             if mp3_obj.result != MP3File.QRY_RESULT.OK and \
                mp3_obj.result != MP3File.QRY_RESULT.NET_ERROR:
 
+                if journal.restore(2, mp3_obj): 
+                    changed(mp3_obj)
+                    continue
+
+                hash_list.append(mp3_obj)
+
+        if hash_list:
+            mylog.INFO('using hashing for %d unknown files' % len(hash_list))
+
+        progress.newPass(callback, 'pass2: hashing', len(hash_list))
+
+        # files hashed in an earlier run come straight out of the store, the rest 
+        # get fingerprinted on all the cpus. the results come back here as they 
+        # finish (see puidquery.lookupMany)
+        puid_store = None
+
+        if hash_list and globalz.PUID_STORE_FILE:
+            puid_store = puidstore.PUIDStore(globalz.PUID_STORE_FILE)
+
+        puid_results = puidquery.lookupMany([ mp3_obj.orig_track.path for mp3_obj in hash_list ],
+                                            store=puid_store)
+
+        try:
+            for (i, tags) in puid_results:
+
+                mp3_obj = hash_list[i]
+
+                mylog.INFO('hashed unknown file %s' % (mp3_obj.orig_track.path))
+
                 if callback:
                     callback('pass2: hashing: %s - %s' % (mp3_obj.orig_track.artist, 
                               mp3_obj.orig_track.name))
 
-                mylog.INFO('using hashing for unknown file %s' % (mp3_obj.orig_track.path))
-                puid_qry_obj = puidquery.PUIDQuery()
-
                 (mp3_obj.clean_track.artist, 
                  mp3_obj.clean_track.album, 
                  mp3_obj.clean_track.name,
-                 mp3_obj.clean_track.track_num) = puid_qry_obj.lookupTrack(mp3_obj.orig_track.path)
+                 mp3_obj.clean_track.track_num) = tags
 
                 if mp3_obj.clean_track.artist:
                     mp3_obj.method1 = MP3File.METHOD.HASHED
                 else:
                     mp3_obj.method1 = MP3File.METHOD.FAILEDHASH
 
+                journal.record(2, mp3_obj)
+                changed(mp3_obj)
+
+        finally:
+            # also where a cancel (ThreadQuit from the callback) ends up
+            puid_results.close()
+
+            if puid_store:
+                puid_store.close()
+
+        journal.passDone(2)
 
         # PASS 3: retry album name guessing. now that the data has been partially cleaned, we'll have 
         #         better luck guessing the correct album name
         tagGuessCache.clearCache()
 
+        # artists musicbrainz came up with that we haven't loaded yet, all at once. 
+        # the ones from PASS 1 are still cached, and so are their track matches
+        # (see matchindex), so only the titles that changed get matched again
+        tagGuessCache.prefetchArtistCache([ mp3_obj.clean_track.artist for mp3_obj in mp3_list
+                                            if mp3_obj.result != MP3File.QRY_RESULT.NET_ERROR and
+                                            mp3_obj.clean_track.artist ])
+
+        progress.newPass(callback, 'pass3', 
+                         len([ 1 for mp3_obj in mp3_list if mp3_obj.result != MP3File.QRY_RESULT.NET_ERROR ]))
+
         for mp3_obj in mp3_list:
             if mp3_obj.result == MP3File.QRY_RESULT.NET_ERROR: continue
 
@@ -357,6 +636,13 @@ def IdentifyMusic(mp3_list, callback=None):
                 else:
                     mp3_obj.result = MP3File.QRY_RESULT.FIELDS_CHANGED
 
+            changed(mp3_obj)
+
+        for mp3_obj in mp3_list:
+            journal.record(3, mp3_obj)
+
+        journal.passDone(3)
+
 
         if globalz.CACHE_DEBUG_ON:
             for x in mp3_list: print unicode(x).encode('utf-8')
@@ -367,11 +653,84 @@ def IdentifyMusic(mp3_list, callback=None):
 
 
     finally:
+        # save whatever we got done, so a cancel/crash can be resumed
+        journal.close()
+
         if globalz.PERSIST_CACHE_ON:
             mylog.INFO('persisting track guesses')
             tagGuessCache.dump()
 
+        httpclient.CLIENT.logStats()
+
     return mp3_list
 
 
 
+
+
+if __name__ == '__main__':
+    import sys
+
+    usage = 'usage: %s [GENTAG|RESUME] mp3_xml_file id3_xml_file\n' \
+            '       %s FIND music_dir mp3_xml_file\n' \
+            '       %s TREE mp3_xml_file new_music_dir\n' \
+            '       %s [RESUMETREE|UNDOTREE]' % ((sys.argv[0],) * 4)
+
+    def printStatus(msg):
+        mylog.STDERR(unicode(msg))
+
+    # the job's progress, throttled (see util.progress)
+    console = progress.ConsoleReporter()
+
+    def runJob(job_fn, passes, *args, **kwargs):
+        ''' job_fn(*args, callback, **kwargs) with a Progress for the callback '''
+
+        status = progress.Progress(console, passes)
+
+        try:
+            return job_fn(*(args + (status,)), **kwargs)
+        finally:
+            status.finish()
+            console.done()
+
+    # the journal knows what to do for these
+    if sys.argv[1:] == ['RESUMETREE']:
+        exit(1 if runJob(ResumeDirTree, 1) else 0)
+
+    if sys.argv[1:] == ['UNDOTREE']:
+        exit(1 if runJob(UndoDirTree, 1) else 0)
+
+    try:
+        cmd = sys.argv[1]
+        in_file = sys.argv[2]
+        out_file = sys.argv[3]
+    except IndexError:
+        exit(usage)
+
+    if cmd == 'GENTAG' or cmd == 'RESUME':
+        mp3_list = []
+        ImportWork(mp3_list, in_file)
+
+        # RESUME picks up the last GENTAG run from its journal
+        runJob(IdentifyMusic, IDENTIFY_PASSES, mp3_list, resume=(cmd == 'RESUME'))
+
+        ExportWork(mp3_list, out_file)
+
+    elif cmd == 'FIND':
+        # with the scan index, a nightly rescan only opens what's changed
+        changes = {}
+        mp3_list = runJob(FindMusic, 1, in_file, changes=changes)
+
+        for change in ('added', 'removed', 'changed'):
+            for path in changes.get(change, []):
+                printStatus('%s: %s' % (change, path))
+
+        ExportWork(mp3_list, out_file)
+
+    elif cmd == 'TREE':
+        mp3_list = []
+        ImportWork(mp3_list, in_file)
+
+        exit(1 if runJob(MakeDirTree, 1, mp3_list, out_file) else 0)
+    else:
+        exit(usage)
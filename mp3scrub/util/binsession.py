@@ -0,0 +1,318 @@
+'''compact binary session format, the alternative to the xml from fileio.exportMP3s.
+
+   unlike the xml, it keeps everything in MP3File.getFieldList (plus the dup flag),
+   so a session comes back exactly as it was saved. layout:
+
+       header   HEADER_FMT: magic, version, rows, columns, string table offset,
+                            string count
+       rows     one fixed width row per MP3File, one CELL_FMT (type, value) per
+                column. strings are stored once in the string table and the cell
+                holds their id, so the same artist/album name 500 times costs
+                one string.
+       strings  STR_FMT (offset, length) per string, then the utf-8 blob
+
+   fixed width rows mean row i is at a known offset, so SessionReader mmaps the
+   file and only decodes the rows (and strings) that are asked for.
+'''
+
+import os
+import mmap
+import struct
+from mp3scrub.util import mylog
+from mp3scrub.util.musicTypes import MP3File, Track
+
+MAGIC = 'MP3SCRUB'
+VERSION = 1
+
+HEADER_FMT = '<8sIIIQI'
+CELL_FMT = '<Bq'
+STR_FMT = '<QI'
+
+HEADER_SIZE = struct.calcsize(HEADER_FMT)
+CELL_SIZE = struct.calcsize(CELL_FMT)
+STR_SIZE = struct.calcsize(STR_FMT)
+
+# getFieldList, then the dup flag
+NUM_COLS = len(MP3File.getFieldLabels()) + 1
+
+# cell types
+T_NONE, T_INT, T_UNI, T_STR, T_BOOL = range(5)
+
+INT_MIN = -(1 << 63)
+INT_MAX = (1 << 63) - 1
+
+
+def isBinSession(file_name):
+    ''' returns -> True if file_name is a binary session (by its magic, not its name) '''
+
+    with open(file_name, 'rb') as fl:
+        return fl.read(len(MAGIC)) == MAGIC
+
+
+def _mp3Row(mp3_file_obj):
+    return list(mp3_file_obj.getFieldList()) + [mp3_file_obj.is_dup]
+
+
+def _rowMP3(row):
+    ''' MP3File back from a row of fields '''
+
+    (orig_artist, clean_artist, orig_album, clean_album, orig_name, clean_name,
+     orig_track_num, clean_track_num, path, method1, method2, fields_changed,
+     result, is_dup) = row
+
+    mp3_obj = MP3File(result=result, fields_changed=fields_changed,
+                      is_dup_flag=is_dup, my_path=path)
+
+    mp3_obj.orig_track = Track(_artist=orig_artist, _name=orig_name,
+                               _track_num=orig_track_num, _path=path)
+    mp3_obj.clean_track = Track(_artist=clean_artist, _name=clean_name,
+                                _track_num=clean_track_num)
+
+    # the constructor always gives a Track an album, even if it didn't have one
+    mp3_obj.orig_track.albums = [orig_album] if orig_album is not None else []
+    mp3_obj.clean_track.albums = [clean_album] if clean_album is not None else []
+
+    mp3_obj.method1 = method1
+    mp3_obj.method2 = method2
+
+    return mp3_obj
+
+
+class SessionWriter(object):
+    '''writes a binary session a row at a time. the string table is kept in memory
+       until close(), only one copy of each string though.
+
+       the rows go to a temp file next to file_name, close() finishes it and renames
+       it over file_name. abort() throws it away, so a failed save never leaves a
+       half written session (or clobbers the last good one).
+    '''
+
+    def __init__(self, file_name):
+        self.file_name = file_name
+        self.tmp_name = file_name + '.tmp'
+
+        self.fl = open(self.tmp_name, 'wb')
+        self.rows = 0
+
+        # string => id, (type matters, u'3' and '3' are different cells)
+        self.str_ids = {}
+        self.strs = []
+
+        self.row_struct = struct.Struct('<' + CELL_FMT[1:] * NUM_COLS)
+
+        # filled in on close
+        self.fl.write('\0' * HEADER_SIZE)
+
+    def _strId(self, val):
+        key = (type(val), val)
+        str_id = self.str_ids.get(key)
+
+        if str_id is None:
+            str_id = len(self.strs)
+            self.str_ids[key] = str_id
+            self.strs.append(val.encode('utf-8') if isinstance(val, unicode) else val)
+
+        return str_id
+
+    def _cell(self, val):
+        ''' returns -> (type, value) for one field '''
+
+        if val is None:
+            return (T_NONE, 0)
+
+        if isinstance(val, bool):
+            return (T_BOOL, int(val))
+
+        if isinstance(val, (int, long)) and INT_MIN <= val <= INT_MAX:
+            return (T_INT, val)
+
+        if isinstance(val, str):
+            return (T_STR, self._strId(val))
+
+        if not isinstance(val, unicode):
+            mylog.INFO('binsession: saving %s value %s as a string' % (type(val), repr(val)))
+            val = unicode(val)
+
+        return (T_UNI, self._strId(val))
+
+    def addRow(self, row):
+        cells = []
+        str_ids = self.str_ids
+
+        for val in row:
+            # the common cases inline, this is the hot loop
+            typ = type(val)
+
+            if typ is unicode:
+                str_id = str_ids.get((typ, val))
+                cells += (T_UNI, self._strId(val) if str_id is None else str_id)
+            elif typ is int:
+                cells += (T_INT, val)
+            else:
+                cells += self._cell(val)
+
+        self.fl.write(self.row_struct.pack(*cells))
+        self.rows += 1
+
+    def addMP3(self, mp3_file_obj):
+        self.addRow(_mp3Row(mp3_file_obj))
+
+    def close(self):
+        strtab_off = self.fl.tell()
+
+        offset = 0
+        entries = []
+
+        for val in self.strs:
+            entries.append(struct.pack(STR_FMT, offset, len(val)))
+            offset += len(val)
+
+        self.fl.write(''.join(entries))
+        self.fl.write(''.join(self.strs))
+
+        self.fl.seek(0)
+        self.fl.write(struct.pack(HEADER_FMT, MAGIC, VERSION, self.rows, NUM_COLS,
+                                  strtab_off, len(self.strs)))
+        self.fl.flush()
+        os.fsync(self.fl.fileno())
+        self.fl.close()
+
+        # windows won't rename over an existing file
+        if os.name == 'nt' and os.path.exists(self.file_name):
+            os.remove(self.file_name)
+
+        os.rename(self.tmp_name, self.file_name)
+
+    def abort(self):
+        ''' give up on the session, file_name is left as it was '''
+
+        self.fl.close()
+
+        try:
+            os.remove(self.tmp_name)
+        except OSError, e:
+            mylog.ERR('binsession: can\'t remove %s: %s' % (self.tmp_name, str(e)))
+
+
+class SessionReader(object):
+    '''random access to a binary session through mmap.
+
+       len(reader), reader.getRow(i) -> tuple of fields, reader.getMP3(i) -> MP3File,
+       iter(reader) -> every MP3File in order
+    '''
+
+    def __init__(self, file_name):
+        self.fl = open(file_name, 'rb')
+
+        try:
+            self.mm = mmap.mmap(self.fl.fileno(), 0, access=mmap.ACCESS_READ)
+        except:
+            self.fl.close()
+            raise
+
+        try:
+            (magic, version, self.rows, self.cols, strtab_off, self.num_strs) = \
+                struct.unpack_from(HEADER_FMT, self.mm, 0)
+        except struct.error:
+            self.close()
+            raise ValueError('%s is not a binary session' % file_name)
+
+        if magic != MAGIC or version != VERSION or self.cols != NUM_COLS:
+            self.close()
+            raise ValueError('%s is not a version %d binary session' % (file_name, VERSION))
+
+        self.row_struct = struct.Struct('<' + CELL_FMT[1:] * self.cols)
+        self.row_size = self.row_struct.size
+
+        self.strtab_off = strtab_off
+        self.blob_off = strtab_off + self.num_strs * STR_SIZE
+
+        # id => decoded string, so repeated names are the same object
+        self.str_cache = {}
+
+    def __len__(self):
+        return self.rows
+
+    def _str(self, str_id, typ):
+        ret = self.str_cache.get((typ, str_id))
+
+        if ret is None:
+            if not 0 <= str_id < self.num_strs:
+                raise ValueError('bad string id %d' % str_id)
+
+            (offset, length) = struct.unpack_from(STR_FMT, self.mm,
+                                                  self.strtab_off + str_id * STR_SIZE)
+            start = self.blob_off + offset
+            ret = self.mm[start:start + length]
+
+            if typ == T_UNI:
+                ret = ret.decode('utf-8')
+
+            self.str_cache[(typ, str_id)] = ret
+
+        return ret
+
+    def getRow(self, i):
+        ''' returns -> the fields of row i (see MP3File.getFieldList, then is_dup) '''
+
+        if i < 0: i += self.rows
+
+        if not 0 <= i < self.rows:
+            raise IndexError('row %d out of range' % i)
+
+        cells = self.row_struct.unpack_from(self.mm, HEADER_SIZE + i * self.row_size)
+
+        row = []
+
+        for c in xrange(0, len(cells), 2):
+            (typ, val) = cells[c:c + 2]
+
+            if typ == T_INT:
+                row.append(val)
+            elif typ == T_UNI or typ == T_STR:
+                row.append(self._str(val, typ))
+            elif typ == T_NONE:
+                row.append(None)
+            elif typ == T_BOOL:
+                row.append(bool(val))
+            else:
+                raise ValueError('bad cell type %d in row %d' % (typ, i))
+
+        return tuple(row)
+
+    def getMP3(self, i):
+        return _rowMP3(self.getRow(i))
+
+    def __iter__(self):
+        for i in xrange(self.rows):
+            yield self.getMP3(i)
+
+    def close(self):
+        self.mm.close()
+        self.fl.close()
+
+
+def exportMP3s(mp3_list, file_name):
+    ''' given an mp3_list, save them as a binary session '''
+
+    writer = SessionWriter(file_name)
+
+    try:
+        for mp3_file in mp3_list:
+            writer.addMP3(mp3_file)
+
+        writer.close()
+    except:
+        writer.abort()
+        raise
+
+
+def importMP3s(mp3_list, file_name):
+    ''' load a binary session into an MP3File list '''
+
+    reader = SessionReader(file_name)
+
+    try:
+        mp3_list.extend(reader)
+    finally:
+        reader.close()
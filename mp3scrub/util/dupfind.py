@@ -0,0 +1,166 @@
+'''duplicate music file detection.
+
+   A file is a dup if an earlier file had the same "taste" (a 10KB sample read
+   from 100KB into the file, which skips past the tags). Instead of keeping every
+   taste around and comparing against all of them, we keep md5 digests in a dict,
+   so each lookup is O(1) and costs a few bytes per file:
+
+   1. size stage (DUP_SIZE_STAGE, off by default): files are bucketed by size
+      first. a file is only opened when another file of the same size shows up,
+      so most files are never read at all. the size becomes part of the key
+      though, so dups that differ in size (the same audio with and without a
+      trailing ID3v1/APE tag) are missed.
+   2. partial stage: md5 of the taste.
+   3. full stage (DUP_FULL_CONFIRM): md5 of the whole file, for when you really
+      want to be sure before calling something a dup.
+
+   The results are reported as groups, each one the original file followed by its
+   dups, see getGroups().
+'''
+
+import hashlib
+import os
+from mp3scrub import globalz
+
+TASTE_OFFSET = 100000
+TASTE_LEN = 10000
+READ_CHUNK = 1 << 20
+
+
+def partialDigest(path):
+    ''' md5 of the taste of path. files too short to have a taste are hashed whole '''
+
+    with open(path, 'rb') as fl:
+        fl.seek(TASTE_OFFSET)
+        taste = fl.read(TASTE_LEN)
+
+        if not taste:
+            fl.seek(0)
+            taste = fl.read()
+
+    return hashlib.md5(taste).digest()
+
+
+def fullDigest(path):
+    ''' md5 of the whole file '''
+
+    md5 = hashlib.md5()
+
+    with open(path, 'rb') as fl:
+        while True:
+            buf = fl.read(READ_CHUNK)
+            if not buf: break
+            md5.update(buf)
+
+    return md5.digest()
+
+
+class DupFinder(object):
+    '''feed it every file with add(), in order. see module doc.'''
+
+    def __init__(self, size_stage=None, full_confirm=None):
+        self.size_stage = globalz.DUP_SIZE_STAGE if size_stage is None else size_stage
+        self.full_confirm = globalz.DUP_FULL_CONFIRM if full_confirm is None else full_confirm
+
+        # size => first path with that size, until a second one shows up and
+        # we have to hash the first
+        self.unhashed = {}
+
+        # key => first path seen with that key
+        self.first_seen = {}
+
+        # first path => [dup paths]
+        self.dups = {}
+
+        # originals, in the order their first dup showed up
+        self.dup_order = []
+
+        # path => digest, only for files we've had to hash
+        self.partials = {}
+        self.fulls = {}
+
+    def _partial(self, path, partial=None):
+        if partial is None:
+            partial = self.partials.get(path)
+
+            if partial is None:
+                partial = partialDigest(path)
+
+        self.partials[path] = partial
+        return partial
+
+    def _full(self, path):
+        if path not in self.fulls:
+            self.fulls[path] = fullDigest(path)
+
+        return self.fulls[path]
+
+    def _firstWithKey(self, key, path):
+        ''' returns the path that first had key, registering path if it's the first '''
+
+        orig_path = self.first_seen.get(key)
+
+        if orig_path is None:
+            self.first_seen[key] = path
+
+        return orig_path
+
+    def _partialKey(self, path, size, partial):
+        if self.size_stage:
+            return (size, self._partial(path, partial))
+        else:
+            return (self._partial(path, partial),)
+
+    def add(self, path, size=None, partial=None):
+        ''' path -> file to check
+            size -> file size, if already known (saves a stat)
+            partial -> partial digest, if already known (saves a read)
+
+            returns -> True if path is a dup of an earlier file
+        '''
+
+        if self.size_stage:
+            if size is None:
+                size = os.path.getsize(path)
+
+            if size not in self.unhashed:
+                # first file this size, can't be a dup. don't even open it yet
+                self.unhashed[size] = path
+
+                if partial is not None:
+                    self.partials[path] = partial
+
+                return False
+
+            first_path = self.unhashed[size]
+
+            if first_path is not None:
+                self._firstWithKey(self._partialKey(first_path, size, None), first_path)
+                self.unhashed[size] = None
+
+        key = self._partialKey(path, size, partial)
+        orig_path = self._firstWithKey(key, path)
+
+        if orig_path is None: return False
+
+        if self.full_confirm:
+            # both the same taste. now compare the whole thing
+            self._firstWithKey(key + (self._full(orig_path),), orig_path)
+            full_orig = self._firstWithKey(key + (self._full(path),), path)
+
+            if full_orig is None: return False
+
+            orig_path = full_orig
+
+        if orig_path not in self.dups:
+            self.dups[orig_path] = []
+            self.dup_order.append(orig_path)
+
+        self.dups[orig_path].append(path)
+
+        return True
+
+    def getGroups(self):
+        ''' returns -> list of [original path, dup path, dup path...] '''
+
+        return [ [orig_path] + self.dups[orig_path] for orig_path in self.dup_order ]
@@ -1,26 +1,27 @@
 ''' functions for searching fs for music, reading/writing tags from files '''
 
 import fnmatch, os, sys 
-import hashlib, zlib 
 from mutagen.easyid3 import EasyID3
 from mutagen.flac import FLAC  
 from mutagen.oggvorbis import OggVorbis  
 from mp3scrub import globalz
-from mp3scrub.util import strtool, mylog, findxml
+from mp3scrub.util import strtool, mylog, findxml, dupfind
 from mp3scrub.util.musicTypes import MP3File, Track
 
 
-def MP3Finder(dir_str, mp3_list, callback):
-    ''' search for mp3 files in directory dir_str. populates list mp3_list '''
+def iterMusicFiles(dir_str, dup_finder=None, scan_index=None):
+    ''' walk dir_str, yielding (full_path, is_dup, cached_tags) for every music file 
+        as we find it. pass in a dupfind.DupFinder if you want the dup groups afterwards.
 
-    hash_list = []
+        with a scanindex.ScanIndex, files that haven't changed since the last scan
+        come back with the tags saved last time in cached_tags (and their saved
+        digest goes to the dup finder), so they never get opened. cached_tags is
+        None for everything else.
+    '''
+
+    if dup_finder is None:
+        dup_finder = dupfind.DupFinder()
 
-    if not os.path.exists(dir_str):
-        mylog.ERR('directory %s doesn\'t exist' % (dir_str))
-        return -1
-  
-     
-    i = 0
     for root, dirs, files in os.walk(str(dir_str)):
 
         for file in files:
@@ -29,32 +30,80 @@ def MP3Finder(dir_str, mp3_list, callback):
                fnmatch.fnmatch(file, '*.mp4') or \
                fnmatch.fnmatch(file, '*.ogg') or \
                fnmatch.fnmatch(file, '*.flac'):
-                i += 1
                 full_path = os.path.join(root, file)
 
                 try:
-                    with open(unicode(full_path), 'rb') as mp3fn:
+                    uni_path = unicode(full_path)
+                    cached_tags = None
 
-                        mp3fn.seek(100000)
-                        taste = mp3fn.read(10000)
-                        is_dup = False
+                    if scan_index:
+                        st = os.stat(full_path)
+                        cached = scan_index.lookup(uni_path, st)
 
-                        if taste in hash_list:
-                            is_dup = True
+                        if cached:
+                            (cached_tags, partial) = cached
+                            is_dup = dup_finder.add(uni_path, st.st_size, partial)
                         else:
-                            hash_list.append(taste)
-
-                        mp3_list.append(MP3File(is_dup_flag=is_dup, my_path=full_path))
+                            is_dup = dup_finder.add(uni_path, st.st_size)
+                    else:
+                        is_dup = dup_finder.add(uni_path)
 
-                        callback('adding: %s' % (full_path))
-
-                        mylog.DBG1(3, 'adding to list len: %d file: %s' % (i, unicode(full_path)))
+                    yield (full_path, is_dup, cached_tags)
 
                 except UnicodeDecodeError:
                     mylog.ERR('mp3scrub does not support unicode filenames: %s' % \
                                unicode(full_path, errors='replace'));
                     pass
 
+
+def MP3Finder(dir_str, mp3_list, callback):
+    ''' search for mp3 files in directory dir_str. populates list mp3_list 
+
+        returns -> list of dup groups (see dupfind.DupFinder.getGroups), -1 on error
+    '''
+
+    if not os.path.exists(dir_str):
+        mylog.ERR('directory %s doesn\'t exist' % (dir_str))
+        return -1
+
+    dup_finder = dupfind.DupFinder()
+  
+    for i, (full_path, is_dup, _) in enumerate(iterMusicFiles(dir_str, dup_finder), 1):
+
+        mp3_list.append(MP3File(is_dup_flag=is_dup, my_path=full_path))
+
+        callback('adding: %s' % (full_path))
+
+        mylog.DBG1(3, 'adding to list len: %d file: %s' % (i, unicode(full_path)))
+
+    return dup_finder.getGroups()
+
+
+def readTagEntry(entry):
+    ''' read the tags FindMusic cares about for one (path, is_dup, cached_tags) 
+        entry from iterMusicFiles. top level so it can run in a multiprocessing worker.
+        if the entry has cached tags the file isn't opened at all.
+
+        returns -> (path, is_dup, (artist, title, album, tracknumber)), or 
+                   (path, is_dup, None) if the tags can't be read
+    '''
+
+    (fn, is_dup, cached_tags) = entry
+
+    if cached_tags:
+        return (fn, is_dup, cached_tags)
+
+    try:
+        id3_reader = Id3tool(fn)
+
+        tags = (id3_reader.readTag('artist'), id3_reader.readTag('title'),
+                id3_reader.readTag('album'), id3_reader.readTag('tracknumber'))
+    except:
+        tags = None
+
+    return (fn, is_dup, tags)
+
+
 class Id3tool:
     ''' class to read/write mp3 tags '''
 
@@ -84,25 +133,46 @@ class Id3tool:
         self.tag_obj[unicode(tag)] = unicode(val)
 
 
-def importMP3s(mp3_list, file_name): 
-    ''' load an xml file into an MP3File list '''
+# the tags readTagEntry reads and writeTagEntry writes, in that order
+TAG_NAMES = ('artist', 'title', 'album', 'tracknumber')
+
+def writeTagEntry(fn, tags):
+    ''' write (artist, title, album, tracknumber) to fn, unless it already has exactly
+        those tags. allow throw if the file can't be read or written.
+
+        returns -> True if the file was written, False if it was already up to date
+    '''
+
+    id3_writer = Id3tool(fn)
+
+    new_tags = [ unicode(val) for val in tags ]
 
-    tag_reader = findxml.XMLReader(xmlFile=file_name)
+    if [ id3_writer.readTag(tag) for tag in TAG_NAMES ] == new_tags:
+        return False
 
-    mp3_nodes = tag_reader.getTheseNodes('mp3')
+    for tag, val in zip(TAG_NAMES, new_tags):
+        id3_writer.writeTag(tag, val)
 
-    tmp_sort = []
-    
-    for node in mp3_nodes:
-        orig_artist = findxml.safeChildGet(node, 'originalartist').strip()
-        clean_artist = findxml.safeChildGet(node, 'cleanartist').strip()
-        orig_track = findxml.safeChildGet(node, 'originaltrack').strip()
-        clean_track = findxml.safeChildGet(node, 'cleantrack').strip()
-        orig_album = findxml.safeChildGet(node, 'originalalbum').strip()
-        clean_album = findxml.safeChildGet(node, 'cleanalbum').strip()
-        orig_tracknum = findxml.safeChildGet(node, 'originaltracknum').strip()
-        clean_tracknum = findxml.safeChildGet(node, 'cleantracknum').strip()
-        path = findxml.safeChildGet(node, 'path').strip()
+    id3_writer.save()
+
+    return True
+
+
+# the children of an <mp3> node that importMP3s reads
+IMPORT_FIELDS = ('originalartist', 'cleanartist', 'originaltrack', 'cleantrack',
+                 'originalalbum', 'cleanalbum', 'originaltracknum', 'cleantracknum', 'path')
+
+def iterImportMP3s(file_name):
+    ''' read an xml file saved by exportMP3s an MP3File at a time.
+        the file is streamed, so memory doesn't grow with the size of it.
+
+        yields -> MP3File
+    '''
+
+    for fields in findxml.iterNodes(file_name, 'mp3', IMPORT_FIELDS):
+
+        (orig_artist, clean_artist, orig_track, clean_track, orig_album, clean_album,
+         orig_tracknum, clean_tracknum, path) = [ x.strip() for x in fields ]
 
         artist = clean_artist if clean_artist else orig_artist
         track = clean_track if clean_track else orig_track
@@ -115,25 +185,28 @@ def importMP3s(mp3_list, file_name):
         orig_mp3 = Track(_artist=artist, _name=track, _album=album, 
                          _track_num=tracknum, _path=path)
 
-        mp3_list.append(MP3File(orig_track=orig_mp3.copy(), my_path=path))
-
+        yield MP3File(orig_track=orig_mp3, my_path=path)
 
-    tag_reader.close()
 
+def importMP3s(mp3_list, file_name): 
+    ''' load an xml file into an MP3File list '''
 
-def exportMP3s(mp3_list, file_name): 
-    ''' given an mp3_list, export their tags and paths to an xml file '''
+    mp3_list.extend(iterImportMP3s(file_name))
 
-    tag_writer = findxml.XMLWriter(file_name)
 
-    for mp3_file in mp3_list:
+def exportMP3s(mp3_list, file_name): 
+    ''' given an mp3_list, export their tags and paths to an xml file.
+        written an MP3File at a time, see findxml.XMLStreamWriter.
+    '''
 
-        tmp_node = findxml.MP3FileNode(mp3_file) 
+    tag_writer = findxml.XMLStreamWriter(file_name)
 
-        if tmp_node:
-            tag_writer.addNode(tmp_node)
+    try:
+        for mp3_file in mp3_list:
+            tag_writer.addMP3(mp3_file)
 
-    tag_writer.close()
+    finally:
+        tag_writer.close()
 
 
 def doXtoMP3s(x,*args):
@@ -2,6 +2,7 @@
 
 from xml.dom.minidom import parse, parseString, getDOMImplementation, Element, Node, Document
 import xml.parsers.expat
+import xml.etree.cElementTree as ElementTree
 import os.path
 from mp3scrub import globalz
 from mp3scrub.util import mylog, strtool
@@ -23,6 +24,23 @@ def safeChildGet(parent_node, child_name):
     return ''
 
 
+def mp3Fields(mp3_file_obj):
+    ''' returns -> [(node name, utf-8 str)] of the fields saved for one MP3File '''
+
+    field_list = mp3_file_obj.getFieldList()
+
+    return [ (strtool.sanitizeTrackStr(node_name), 
+              unicode(field_list[i]).encode('utf-8').strip())
+             for i,node_name in enumerate(MP3File.getFieldLabels()) ]
+
+
+def escapeText(data):
+    ''' escape text the same way minidom's writexml does '''
+
+    return data.replace("&", "&amp;").replace("<", "&lt;"). \
+                replace("\"", "&quot;").replace(">", "&gt;")
+
+
 class AbsXMLNode(object):
     '''Abstract Node representation. Makes a tiny 1node-xmldoc that can be
     added to a larger xml doc.
@@ -78,9 +96,8 @@ class MP3FileNode(AbsXMLNode):
         # setup a tiny XML doc of one node that will be appended to bigger one later 
         mp3_node = self.elm.createElement('mp3')
 
-        for i,node_name in enumerate(MP3File.getFieldLabels()): 
-            node_obj = self.elm.createElement(strtool.sanitizeTrackStr(node_name))
-            txt = unicode(mp3_file_obj.getFieldList()[i]).encode('utf-8').strip()
+        for (node_name, txt) in mp3Fields(mp3_file_obj): 
+            node_obj = self.elm.createElement(node_name)
 
             node_val_txt = self.elm.createTextNode(txt)
             node_obj.appendChild(node_val_txt)
@@ -141,6 +158,97 @@ class XMLWriter(object):
 
 
 
+class XMLStreamWriter(object):
+    '''writes the same file XMLWriter does, byte for byte, one node at a time
+    instead of building the whole DOM first. only handles what XMLWriter gets
+    used for: a 'list' of nodes that each have text-only children.
+    '''
+
+    def __init__(self, _config_path, root_name='list'):
+        self.config_file = open(_config_path, 'w')
+        self.root_name = root_name
+        self.empty = True
+
+        self.config_file.write('<?xml version="1.0" encoding="utf-8"?>\n')
+
+    def __str__(self):
+        s = self.__class__.__name__ 
+        return s
+
+    def addFields(self, node_name, fields):
+        ''' node_name -> name of the node to add
+            fields -> [(child name, utf-8 str)]
+        '''
+
+        if self.empty:
+            self.config_file.write('  <%s>\n' % self.root_name)
+            self.empty = False
+
+        if not fields:
+            self.config_file.write('    <%s/>\n' % node_name)
+            return
+
+        lines = [ '    <%s>\n' % node_name ]
+
+        for (child_name, txt) in fields:
+            lines.append('      <%s>%s</%s>\n' % (child_name, escapeText(txt), child_name))
+
+        lines.append('    </%s>\n' % node_name)
+
+        self.config_file.write(''.join(lines))
+
+    def addMP3(self, mp3_file_obj):
+        self.addFields('mp3', mp3Fields(mp3_file_obj))
+
+    def close(self):
+        if self.empty:
+            self.config_file.write('  <%s/>\n' % self.root_name)
+        else:
+            self.config_file.write('  </%s>\n' % self.root_name)
+
+        self.config_file.close()
+
+
+def iterNodes(file_name, node_name, child_names):
+    '''read an xml file a node at a time, without loading the whole thing.
+
+       yields -> a tuple for every node_name node, the text of each of child_names 
+                 (like safeChildGet, u'' if it's not there)
+    '''
+
+    with open(file_name, 'rb') as config_file:
+        try:
+            context = iter(ElementTree.iterparse(config_file, events=('start', 'end')))
+            (_, root) = context.next()
+
+            for (event, elem) in context:
+                if event != 'end' or elem.tag != node_name: continue
+
+                vals = []
+
+                for child_name in child_names:
+                    txt = u''
+
+                    for child in elem:
+                        if child.tag != child_name: continue
+
+                        if child.text:
+                            txt = unicode(child.text)
+                            break
+
+                    vals.append(txt)
+
+                yield tuple(vals)
+
+                # done with it, don't keep it (or its empty shell) around
+                elem.clear()
+                root.clear()
+
+        except SyntaxError:
+            mylog.ERR('failed to load XML file %s' % file_name)
+            raise
+
+
 class XMLReader(object):
     '''Helper to sort through XML files.
 
@@ -0,0 +1,120 @@
+'''per-artist index of track names, so matching an id3 track name against every
+   album of an artist doesn't mean regex-cleaning and string-diffing every track
+   on every album for every mp3.
+
+   built once per Artist. each album keeps its track names already cleaned (see
+   strtool.removeTrackJunk, strtool.sanitizeTrackStr), plus:
+
+   1. exact: clean name => first track with it. most id3 names match exactly, and
+      a distance of 0 can't be beaten, so that's the whole lookup.
+   2. by_len: clean name length => tracks. strtool.trackCompare never accepts a
+      distance over max_dist, and two strings that differ in length by more than
+      that can't be within it, so only the buckets near the id3 name's length
+      get string-diffed.
+
+   match() gives the same answer as comparing against every track with
+   trackCompare and taking the lowest distance (first track wins ties). the
+   answer only depends on the cleaned name, so it's remembered per cleaned name:
+   the same title shows up on lots of files, and again when IdentifyMusic's PASS 3 
+   redoes the matching for files PASS 2 didn't change.
+'''
+
+from mp3scrub import globalz
+from mp3scrub.util import strtool
+
+
+class ArtistMatchIndex(object):
+    '''see module doc.
+
+       artist_obj -> Artist to index
+       album_limit -> only index the first album_limit+1 albums,
+                      defaults to globalz.ALBUM_GUESS_LIMIT
+    '''
+
+    def __init__(self, artist_obj, album_limit=None):
+        if album_limit is None:
+            album_limit = globalz.ALBUM_GUESS_LIMIT
+
+        # [(album_obj, targ_strs, exact, by_len)]
+        self.albums = []
+
+        # clean name => match() result. cleared at strtool.MEMO_MAX
+        self.memo = {}
+
+        for i, album_obj in enumerate(artist_obj.albums):
+
+            if i > album_limit: break
+
+            if not album_obj.name: continue
+
+            targ_strs = []
+            exact = {}
+            by_len = {}
+
+            for pos, track_obj in enumerate(album_obj.tracks):
+                targ_str = strtool.removeTrackJunk(track_obj.name)
+                clean_str = strtool.sanitizeTrackStr(targ_str)
+
+                targ_strs.append(targ_str)
+                exact.setdefault(clean_str, pos)
+                by_len.setdefault(len(clean_str), []).append((pos, clean_str))
+
+            self.albums.append((album_obj, targ_strs, exact, by_len))
+
+    def _bestTrack(self, clean_str, max_dist, exact, by_len):
+        ''' returns -> (dist, pos) of the closest track in one album, None if none match '''
+
+        pos = exact.get(clean_str)
+
+        if pos is not None: return (0, pos)
+
+        best = None
+        str_len = len(clean_str)
+
+        for targ_len in xrange(str_len - max_dist, str_len + max_dist + 1):
+
+            for (pos, targ_str) in by_len.get(targ_len, ()):
+
+                # can't beat what we've got
+                if best and best[0] == 1 and pos > best[1]: continue
+
+                dist = strtool.boundedStrDist(clean_str, targ_str, max_dist)
+
+                if dist <= max_dist and (not best or (dist, pos) < best):
+                    best = (dist, pos)
+
+        return best
+
+    def match(self, id3_track_str):
+        ''' returns -> [(album_obj, track_obj, targ_track_str, dist)], the best matching
+                       track of every album that has one, in album order. targ_track_str
+                       is the track name with the junk removed. the list is shared 
+                       with later calls, don't change it.
+        '''
+
+        clean_str = strtool.sanitizeTrackStr(strtool.removeTrackJunk(id3_track_str))
+
+        matches = self.memo.get(clean_str)
+
+        if matches is not None: return matches
+
+        # the most trackCompare would allow, see there
+        max_dist = min(globalz.MAX_STR_DIST - 1, int(len(clean_str)/globalz.DIV_STR_DIST))
+
+        matches = []
+
+        if max_dist >= 0:
+            for (album_obj, targ_strs, exact, by_len) in self.albums:
+
+                best = self._bestTrack(clean_str, max_dist, exact, by_len)
+
+                if best:
+                    (dist, pos) = best
+                    matches.append((album_obj, album_obj.tracks[pos], targ_strs[pos], dist))
+
+        if len(self.memo) >= strtool.MEMO_MAX:
+            self.memo.clear()
+
+        self.memo[clean_str] = matches
+
+        return matches
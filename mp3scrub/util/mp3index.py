@@ -0,0 +1,300 @@
+'''secondary indexes over the mp3 list, for the GUI grid's filters, search and
+   column sorts. the list is indexed once, then kept up to date a file at a time
+   with update() as a job changes them, instead of rescanning/resorting the whole
+   list every time the view changes.
+
+   1. filters: for each of FILTER_KINDS, key => set of files. a filter switch is
+      a dict lookup, several filters are a set intersection (smallest first).
+   2. search: each file's text columns, lowercased and joined, so a substring
+      search is one 'in' per file and nothing gets rebuilt per keystroke.
+   3. sorts: per column, a sorted list of (value, then value, position, id). it's
+      only built the first time a column is sorted, after that update() moves a
+      changed file with a bisect instead of resorting.
+
+   files are told apart by id(), the MP3Files change but stay the same objects.
+   not thread safe, the GUI only uses it from the GUI thread.
+'''
+
+import sys
+import time
+import bisect
+from mp3scrub.util.musicTypes import MP3File
+
+# what select() can filter on: clean artist initial, original artist initial,
+# QRY_RESULT, lowercased clean album
+FILTER_KINDS = ('artist', 'orig_artist', 'result', 'album')
+
+_KIND_POS = dict([ (kind, i) for (i, kind) in enumerate(FILTER_KINDS) ])
+
+# MP3File.getFieldList columns the search looks in: the artists, albums, track
+# names and the path
+SEARCH_COLS = (0, 1, 2, 3, 4, 5, 8)
+
+# column => column that breaks its ties. the artists sort by album within artist
+SORT_THEN = {0: 2, 1: 3}
+
+_EMPTY = frozenset()
+
+
+def _text(val):
+    ''' returns -> val as unicode, for searching and sorting (mixing str and
+        unicode in a sort blows up on non ascii str) '''
+
+    if isinstance(val, unicode): return val
+
+    if isinstance(val, str): return val.decode('utf-8', 'replace')
+
+    if val is None: return u''
+
+    return unicode(val)
+
+
+def _sortVal(val):
+    if isinstance(val, str): return val.decode('utf-8', 'replace')
+
+    return val
+
+
+def _initial(name):
+    return name[0].lower() if name else None
+
+
+def filterKeys(mp3_obj):
+    ''' returns -> mp3_obj's key for each of FILTER_KINDS '''
+
+    album = mp3_obj.clean_track.album
+
+    return (_initial(mp3_obj.clean_track.artist), _initial(mp3_obj.orig_track.artist),
+            mp3_obj.result, _text(album).lower() if album else None)
+
+
+def searchText(mp3_obj):
+    fields = mp3_obj.getFieldList()
+
+    return u'\0'.join([ _text(fields[col]) for col in SEARCH_COLS ]).lower()
+
+
+def sortKey(mp3_obj, col, pos):
+    ''' returns -> where mp3_obj (at position pos in the list) goes sorted by col '''
+
+    fields = mp3_obj.getFieldList()
+    then_col = SORT_THEN.get(col)
+
+    return (_sortVal(fields[col]),
+            _sortVal(fields[then_col]) if then_col is not None else None,
+            pos, id(mp3_obj))
+
+
+class MP3Index(object):
+    '''see module doc. mp3_list -> the files to index, in their unsorted order'''
+
+    def __init__(self, mp3_list=()):
+        self.reset(mp3_list)
+
+    def reset(self, mp3_list):
+        ''' throw everything away and index mp3_list '''
+
+        self.rows = list(mp3_list)
+
+        # id => position in rows
+        self.pos = {}
+
+        # id => filterKeys(), searchText(), as of the last update
+        self.keys = {}
+        self.texts = {}
+
+        # one per FILTER_KINDS, key => set of ids
+        self.buckets = [ {} for kind in FILTER_KINDS ]
+
+        # column => sorted [sortKey()], column => {id => sortKey()}. built on demand
+        self.orders = {}
+        self.sort_keys = {}
+
+        for (i, mp3_obj) in enumerate(self.rows):
+            oid = id(mp3_obj)
+            keys = filterKeys(mp3_obj)
+
+            self.pos[oid] = i
+            self.keys[oid] = keys
+            self.texts[oid] = searchText(mp3_obj)
+
+            for (bucket, key) in zip(self.buckets, keys):
+                bucket.setdefault(key, set()).add(oid)
+
+    def __len__(self):
+        return len(self.rows)
+
+    def __contains__(self, mp3_obj):
+        return id(mp3_obj) in self.pos
+
+    def _order(self, col):
+        order = self.orders.get(col)
+
+        if order is None:
+            col_keys = dict([ (id(o), sortKey(o, col, i)) for (i, o) in enumerate(self.rows) ])
+
+            order = sorted(col_keys.itervalues())
+
+            self.orders[col] = order
+            self.sort_keys[col] = col_keys
+
+        return order
+
+    def update(self, mp3_obj):
+        ''' re-index mp3_obj after it's changed.
+
+            returns -> True if it changed anything a view could depend on (a filter
+                       key, its search text, or where it sorts)
+        '''
+
+        oid = id(mp3_obj)
+
+        if oid not in self.pos: return False
+
+        moved = False
+
+        keys = filterKeys(mp3_obj)
+        old_keys = self.keys[oid]
+
+        if keys != old_keys:
+            for (bucket, key, old_key) in zip(self.buckets, keys, old_keys):
+                if key == old_key: continue
+
+                old_bucket = bucket[old_key]
+                old_bucket.discard(oid)
+
+                if not old_bucket:
+                    del bucket[old_key]
+
+                bucket.setdefault(key, set()).add(oid)
+
+            self.keys[oid] = keys
+            moved = True
+
+        text = searchText(mp3_obj)
+
+        if text != self.texts[oid]:
+            self.texts[oid] = text
+            moved = True
+
+        for (col, order) in self.orders.iteritems():
+            col_keys = self.sort_keys[col]
+
+            old_key = col_keys[oid]
+            key = sortKey(mp3_obj, col, self.pos[oid])
+
+            if key == old_key: continue
+
+            del order[bisect.bisect_left(order, old_key)]
+            bisect.insort(order, key)
+
+            col_keys[oid] = key
+            moved = True
+
+        return moved
+
+    def keysOf(self, kind):
+        ''' returns -> every key there is for kind (i.e. the albums), with how many
+            files have it, as a dict '''
+
+        return dict([ (key, len(ids)) for (key, ids) in self.buckets[_KIND_POS[kind]].iteritems() ])
+
+    def select(self, filters=None, search=None, sort_col=None, reverse=False):
+        ''' filters -> {kind : key} (see FILTER_KINDS), the files have to match all
+            search -> substring to look for in the text columns (case insensitive)
+            sort_col -> MP3File.getFieldList column to sort on, None for list order
+            reverse -> sort backwards
+
+            returns -> list of the MP3Files that match
+        '''
+
+        ids = None
+
+        if filters:
+            sets = [ self.buckets[_KIND_POS[kind]].get(key, _EMPTY)
+                     for (kind, key) in filters.iteritems() ]
+            sets.sort(key=len)
+
+            ids = sets[0].intersection(*sets[1:])
+
+        if search:
+            needle = _text(search).lower()
+            texts = self.texts
+
+            ids = set([ oid for oid in (self.pos if ids is None else ids)
+                        if needle in texts[oid] ])
+
+        rows = self.rows
+
+        if ids is not None and len(ids) == len(rows):
+            ids = None
+
+        if sort_col is None:
+            if ids is None:
+                ret = rows[:]
+            else:
+                ret = [ rows[i] for i in sorted([ self.pos[oid] for oid in ids ]) ]
+
+        else:
+            pos = self.pos
+
+            if ids is None:
+                ret = [ rows[pos[key[-1]]] for key in self._order(sort_col) ]
+            else:
+                ret = [ rows[pos[key[-1]]] for key in self._order(sort_col) if key[-1] in ids ]
+
+        if reverse:
+            ret.reverse()
+
+        return ret
+
+
+def benchIndex(num_files=50000):
+    ''' time the grid's view changes over a made up library, against a rescan '''
+
+    from mp3scrub.util import musicTypes
+
+    mp3_list = [ o for o in musicTypes._buildLibrary(num_files) if isinstance(o, MP3File) ]
+
+    def timeit(name, fn, *args):
+        start = time.time()
+        ret = fn(*args)
+        print '%-32s %8.1f ms  %d rows' % (name, (time.time() - start) * 1000, len(ret))
+        return ret
+
+    index = timeit('build index', MP3Index, mp3_list)
+
+    timeit('rescan for initial a', lambda: [ o for o in mp3_list if o.clean_track.artist and
+                                            o.clean_track.artist[0].lower() == 'a' ])
+    timeit('filter initial a', index.select, {'artist' : u'a'})
+    timeit('filter initial a + result', index.select,
+           {'artist' : u'a', 'result' : MP3File.QRY_RESULT.NO_CHANGE})
+    timeit('tuple sort (the old way)', lambda: [ o for (_, _, o) in sorted([ (o.clean_track.artist,
+                                                 o.clean_track.album, o) for o in mp3_list ]) ])
+    timeit('sort CleanArtist (first)', index.select, None, None, 1)
+    timeit('sort CleanArtist (again)', index.select, None, None, 1)
+    timeit('search "track 49"', index.select, None, u'track 49')
+    timeit('search + sort', index.select, {'artist' : u'a'}, u'album 1', 1, True)
+
+    start = time.time()
+
+    for (i, mp3_obj) in enumerate(mp3_list[:1000]):
+        mp3_obj.clean_track.artist = u'zz renamed %d' % i
+        mp3_obj.result = MP3File.QRY_RESULT.FIELDS_CHANGED
+        index.update(mp3_obj)
+
+    print '%-32s %8.1f ms' % ('update 1000 files', (time.time() - start) * 1000)
+
+    fresh = MP3Index(mp3_list)
+
+    for (filters, search, col) in (({'artist' : u'z'}, None, 1), (None, u'renamed', 1),
+                                   ({'result' : MP3File.QRY_RESULT.FIELDS_CHANGED}, None, None)):
+        same = index.select(filters, search, col) == fresh.select(filters, search, col)
+        print 'updated index matches a fresh one %s: %s' % ((filters, search, col), same)
+
+
+if __name__ == '__main__':
+    if len(sys.argv) > 2 and sys.argv[1] == 'BENCH':
+        benchIndex(int(sys.argv[2]))
+    else:
+        exit('usage: %s BENCH num_files' % sys.argv[0])
@@ -16,14 +16,63 @@
     MP3File [path]
         Track #respresents the file b4 tag cleaning
         Track #respresents the file after tag cleaning
+
+   there can be a lot of these (50k MP3Files, plus every album of every artist 
+   from last.fm), so they use __slots__ instead of a __dict__ each, and the 
+   artist/album names, which repeat a lot, are interned (see internUni).
 '''
 
+import sys
 from mp3scrub import globalz
 from mp3scrub.util import mylog
 
-class Artist(object):
+# turn off to compare, see benchMemory
+INTERN_ON = True
+
+_INTERN_POOL = {}
+
+def internUni(uni_str):
+    ''' the builtin intern() is str only. returns the one shared copy of uni_str,
+        anything that's not unicode is returned as is.
+    '''
+
+    if not INTERN_ON or type(uni_str) is not unicode: return uni_str
+
+    return _INTERN_POOL.setdefault(uni_str, uni_str)
+
+
+class _Slotted(object):
+    '''base for the __slots__ classes, so they still pickle/copy like they did.'''
+
+    __slots__ = ()
+
+    def __getstate__(self):
+        state = {}
+
+        for cls in type(self).__mro__:
+            for attr in cls.__dict__.get('__slots__', ()):
+                if hasattr(self, attr):
+                    state[attr] = getattr(self, attr)
+
+        return state
+
+    def __setstate__(self, state):
+        # pickles from before __slots__ (journals, the artist cache) hand us
+        # their old __dict__, which is the same thing
+        if isinstance(state, tuple):
+            (dict_state, slot_state) = state
+            state = dict(dict_state or {})
+            state.update(slot_state or {})
+
+        for attr, val in state.items():
+            setattr(self, attr, val)
+
+
+class Artist(_Slotted):
     '''Artist metadata. has a list of albums.'''
 
+    __slots__ = ('name', 'albums')
+
     def __init__(self):
         self.name = None
         self.albums = []
@@ -48,13 +97,17 @@ class Artist(object):
         return header_str + '\n' + album_str
 
        
-class Album(object):
+class Album(_Slotted):
     '''album metadata. has a list of Tracks.''' 
 
+    # pct_complete/pct_score are only there once tagGuessCache has ranked it
+    __slots__ = ('tracks', 'name', 'artist', 'mbid', '_total_tracks', '_rank',
+                 'pct_complete', 'pct_score')
+
     def __init__(self, _artist=None, _name=None, _mbid=None, _rank=0, _total_tracks=0):
         self.tracks = []
-        self.name = _name
-        self.artist = _artist 
+        self.name = internUni(_name)
+        self.artist = internUni(_artist)
         self.mbid = _mbid
         self.total_tracks = _total_tracks
         self.rank = _rank
@@ -74,13 +127,13 @@ class Album(object):
         else:
             return False
 
-    def copy(self):
-        trk_copy = []
-        for t in self.tracks:
-            trk_copy.append(t.copy())
+    def copy(self, with_tracks=True):
+        ''' with_tracks=False for just the album info, with an empty track list '''
 
         album_copy = Album(self.artist, self.name, self.mbid, self.rank, self.total_tracks)
-        album_copy.tracks = trk_copy
+
+        if with_tracks:
+            album_copy.tracks = [ t.copy() for t in self.tracks ]
 
         return album_copy
 
@@ -113,8 +166,10 @@ class Album(object):
         
 
 
-class Track(object):
+class Track(_Slotted):
     '''Track metadata.'''
+
+    __slots__ = ('_artist', 'name', 'albums', 'path', '_track_num_int')
      
     def __init__(self, _artist='', _album=None, _name='', _track_num='', _path=''):
 
@@ -141,6 +196,14 @@ class Track(object):
 
     track_num = property(getTrackNum, setTrackNum)
 
+    def setArtist(self, artist_str):
+        self._artist = internUni(artist_str)
+
+    def getArtist(self):
+        return self._artist
+
+    artist = property(getArtist, setArtist)
+
     def __eq__(self, other):
         # names can have minor differences; use 1 Track per 1 MP3 file
         if self.path == other.path:
@@ -152,7 +215,7 @@ class Track(object):
     # self.albums as a list of potential album names
     def setAlbum(self, album_str):
         del self.albums[:]
-        sarg = unicode(album_str)
+        sarg = internUni(unicode(album_str))
         self.albums.append(sarg)
 
     def getAlbum(self):
@@ -163,14 +226,16 @@ class Track(object):
 
     album = property(getAlbum, setAlbum)
 
-    def copy(self):
+    def copy(self, with_albums=True):
+        ''' with_albums=False for a copy with an empty album list '''
+
         trk = Track(_artist=self.artist, _name=self.name, _track_num=self.track_num, _path=self.path)
 
-        trk.albums = self.albums[:]
+        trk.albums = self.albums[:] if with_albums else []
         return trk
 
     def addAlbum(self, album_str):
-        sarg = unicode(album_str)
+        sarg = internUni(unicode(album_str))
         self.albums.append(sarg)
 
     def __unicode__(self):
@@ -182,10 +247,13 @@ class Track(object):
 
 
  
-class MP3File(object):
+class MP3File(_Slotted):
     '''MP3File is used in tracking the tag changes to an mp3 file, before and after
     a tag has been changed. It has 2 Track objects: track before changes, and track
     after changes.'''
+
+    __slots__ = ('orig_track', 'clean_track', 'result', 'fields_changed', 'method1',
+                 'method2', 'is_dup')
      
     @staticmethod
     def getFieldLabels():
@@ -278,3 +346,92 @@ class MP3File(object):
         else:
             self.result = MP3File.QRY_RESULT.NO_CHANGE
 
+
+
+def _memoryKB(build_fn, *args):
+    ''' returns -> how much RSS (KB) build_fn(*args) added, measured in a child so
+        the pools and freelists of other runs don't count '''
+
+    import os, resource, cPickle as pickle
+
+    (rd, wr) = os.pipe()
+    pid = os.fork()
+
+    if not pid:
+        os.close(rd)
+        before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        keep = build_fn(*args)
+        after = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        os.write(wr, pickle.dumps((after - before, len(keep))))
+        os._exit(0)
+
+    os.close(wr)
+    data = os.read(rd, 4096)
+    os.close(rd)
+    os.waitpid(pid, 0)
+
+    return pickle.loads(data)[0]
+
+
+def _buildLibrary(num_files, num_artists=500, files_per_album=12):
+    ''' a made up library: num_files MP3Files, plus an Artist catalog (as last.fm
+        would give it) for each artist. every string is built fresh, the way
+        mutagen and the xml parsers hand them to us.
+    '''
+
+    keep = []
+
+    for i in xrange(num_files):
+        artist = u''.join([u'artist ', unicode(i % num_artists)])
+        album = u''.join([u'album ', unicode(i / files_per_album)])
+        name = u'track %d' % i
+        path = u'/music/%s/%s/%d.mp3' % (artist, album, i)
+
+        mp3 = MP3File(my_path=path)
+        mp3.orig_track = Track(_artist=artist, _album=album, _name=name,
+                               _track_num=i % files_per_album, _path=path)
+        mp3.clean_track = mp3.orig_track.copy()
+        mp3.clean_track.artist = u''.join([u'artist ', unicode(i % num_artists)])
+        mp3.updateResults()
+
+        keep.append(mp3)
+
+    for i in xrange(num_artists):
+        artist_obj = Artist()
+        artist_obj.name = u'artist %d' % i
+
+        for j in xrange(20):
+            album_obj = Album(u''.join([u'artist ', unicode(i)]), u'album %d' % j, None, j, 12)
+
+            for k in xrange(12):
+                album_obj.addTrack(Track(_artist=u''.join([u'artist ', unicode(i)]),
+                                         _album=u'album %d' % j, _name=u'track %d' % k,
+                                         _track_num=k))
+            artist_obj.addAlbum(album_obj)
+
+        keep.append(artist_obj)
+
+    return keep
+
+
+def benchMemory(num_files=50000):
+    ''' print the memory a library of num_files takes, with and without interning '''
+
+    global INTERN_ON
+
+    save = INTERN_ON
+
+    try:
+        for INTERN_ON in (False, True):
+            kb = _memoryKB(_buildLibrary, num_files)
+            print 'intern %-5s %d files: %d KB (%d bytes/file)' % \
+                  (INTERN_ON, num_files, kb, kb * 1024 / num_files)
+    finally:
+        INTERN_ON = save
+
+
+if __name__ == '__main__':
+    if len(sys.argv) > 2 and sys.argv[1] == 'BENCH':
+        benchMemory(int(sys.argv[2]))
+    else:
+        exit('usage: %s BENCH num_files' % sys.argv[0])
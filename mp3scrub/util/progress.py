@@ -0,0 +1,241 @@
+'''progress reporting for the long jobs, coalesced and throttled.
+
+   the scrubCmds functions report progress with callback(str), once per file. a
+   Progress is that callback: a call only counts the file and keeps the message
+   (no formatting, no events), and a ProgressInfo snapshot goes to the publisher
+   at most globalz.PROGRESS_HZ times a second, plus at the start of each pass and
+   at finish(). a job that knows how many files a pass has says so with newPass(),
+   so there's a done/total, rate and ETA.
+
+   the same Progress drives the GUI's progress dialog (see guiThreads) and the
+   console when there's no GUI (ConsoleReporter).
+
+   callbacks only ever come from the thread running the job (the thread pools
+   hand their results back to it), so there's no locking.
+'''
+
+import sys
+import time
+from collections import namedtuple
+from mp3scrub import globalz
+from mp3scrub.util import mylog
+
+
+# pass_name -> what's being done, i.e. 'pass1'
+# pass_num, passes -> which pass it is (from 1), of how many the job has
+# done, total -> files finished in this pass, of how many (0 if not known)
+# rate -> files/sec this pass
+# eta -> secs until this pass is done, None if not known
+# fraction -> 0..1 of the whole job, None if not known
+# current -> the last message, what's being worked on
+ProgressInfo = namedtuple('ProgressInfo', 'pass_name pass_num passes done total '
+                                          'rate eta fraction current')
+
+
+def newPass(callback, name, total=0):
+    ''' tell callback a pass of total files is starting, if it's a Progress (a
+        plain funct(str) callback doesn't care) '''
+
+    new_pass = getattr(callback, 'newPass', None)
+
+    if new_pass:
+        new_pass(name, total)
+
+
+def _clock(secs):
+    secs = int(secs)
+
+    if secs >= 3600:
+        return '%d:%02d:%02d' % (secs / 3600, secs / 60 % 60, secs % 60)
+
+    return '%d:%02d' % (secs / 60, secs % 60)
+
+
+def describe(info):
+    ''' returns -> info as one line of unicode, for the dialog/console '''
+
+    parts = [ info.pass_name or u'working' ]
+
+    if info.total:
+        parts.append(u'%d/%d (%d%%)' % (info.done, info.total, min(info.done, info.total) * 100 / info.total))
+    else:
+        parts.append(u'%d' % info.done)
+
+    if info.rate:
+        parts.append(u'%.1f files/s' % info.rate)
+
+    if info.eta is not None:
+        parts.append(u'ETA %s' % _clock(info.eta))
+
+    line = u'  '.join(parts)
+
+    if info.current:
+        current = info.current
+
+        if isinstance(current, str):
+            current = current.decode('utf-8', 'replace')
+
+        line = u'%s\n%s' % (line, current)
+
+    return line
+
+
+class Progress(object):
+    '''see module doc.
+
+       publish -> funct(ProgressInfo), gets the snapshots
+       passes -> how many passes (newPass calls) the job has, for the fraction
+       check -> optional funct(), called on every file. raise from it to cancel
+                the job (see guiThreads.ThreadQuit)
+       hz -> most snapshots a second, defaults to globalz.PROGRESS_HZ
+    '''
+
+    def __init__(self, publish, passes=1, check=None, hz=None, clock=time.time):
+        if hz is None:
+            hz = globalz.PROGRESS_HZ
+
+        self.publish = publish
+        self.passes = passes
+        self.check = check
+        self.interval = 1.0 / hz
+        self.clock = clock
+
+        self.pass_name = ''
+        self.pass_num = 0
+        self.total = 0
+        self.done = 0
+        self.current = None
+
+        self.pass_start = self.clock()
+        self.last_publish = 0
+
+        # (pass name, files, secs) of each pass so far
+        self.counts = []
+
+    def newPass(self, name, total=0):
+        self._endPass()
+
+        self.pass_name = name
+        self.pass_num += 1
+        self.total = total
+        self.done = 0
+        self.current = None
+        self.pass_start = self.clock()
+
+        self._publish(self.pass_start)
+
+    def __call__(self, msg=None):
+        if self.check:
+            self.check()
+
+        self.done += 1
+
+        if msg is not None:
+            self.current = msg
+
+        now = self.clock()
+
+        if now - self.last_publish >= self.interval:
+            self._publish(now)
+
+    def info(self, now=None):
+        ''' returns -> a ProgressInfo of where we are '''
+
+        if now is None:
+            now = self.clock()
+
+        elapsed = now - self.pass_start
+        rate = self.done / elapsed if elapsed > 0 else 0.0
+
+        eta = None
+        fraction = None
+
+        if self.total:
+            left = max(self.total - self.done, 0)
+
+            if rate:
+                eta = left / rate
+
+            pass_frac = min(self.done, self.total) / float(self.total)
+            fraction = min((max(self.pass_num, 1) - 1 + pass_frac) / max(self.passes, 1), 1.0)
+
+        return ProgressInfo(self.pass_name, self.pass_num, self.passes, self.done, self.total,
+                            rate, eta, fraction, self.current)
+
+    def _publish(self, now):
+        self.last_publish = now
+        self.publish(self.info(now))
+
+    def _endPass(self):
+        if not self.pass_num: return
+
+        self.counts.append((self.pass_name, self.done, self.clock() - self.pass_start))
+
+    def finish(self):
+        ''' publish the last snapshot, and log how long each pass took '''
+
+        self._publish(self.clock())
+        self._endPass()
+        self.pass_num = 0
+
+        for (name, files, secs) in self.counts:
+            mylog.INFO('progress: %s: %d files in %.1f secs' % (name or 'job', files, secs))
+
+
+class ConsoleReporter(object):
+    '''a Progress publisher for running without the GUI. on a terminal it keeps
+       redrawing one status line, otherwise (a log file) it writes a line per pass
+       and then one every line_secs.
+    '''
+
+    def __init__(self, stream=None, line_secs=10):
+        self.stream = stream or sys.stderr
+        self.line_secs = line_secs
+
+        try:
+            self.is_tty = self.stream.isatty()
+        except AttributeError:
+            self.is_tty = False
+
+        self.last_pass = None
+        self.last_line = 0
+        self.width = 0
+
+        # the last line we didn't write, so done() can
+        self.pending = None
+
+    def __call__(self, info):
+        line = describe(info).replace(u'\n', u'  ')
+
+        if self.is_tty:
+            # keep it on one line, the end of the message is the least important
+            line = line[:159].encode('utf-8')
+            self.stream.write('\r%s%s' % (line, ' ' * max(self.width - len(line), 0)))
+            self.width = len(line)
+
+        else:
+            now = time.time()
+
+            if info.pass_num == self.last_pass and now - self.last_line < self.line_secs:
+                self.pending = line
+                return
+
+            self.last_pass = info.pass_num
+            self.last_line = now
+            self.pending = None
+            self.stream.write(line.encode('utf-8') + '\n')
+
+        self.stream.flush()
+
+    def done(self):
+        ''' end the status line (or write the last one) '''
+
+        if self.is_tty and self.width:
+            self.stream.write('\n')
+            self.width = 0
+
+        if self.pending:
+            self.stream.write(self.pending.encode('utf-8') + '\n')
+            self.pending = None
+
+        self.stream.flush()
@@ -0,0 +1,115 @@
+'''persistent index of the last FindMusic scan, so a rescan only has to open the
+   files that are new or changed since last time.
+
+   one shelve record per path: (size, mtime, inode, tags, partial digest). if the
+   size/mtime/inode of a file still match its record, we trust the tags and dup
+   digest we saved and never open the file.
+'''
+
+import os
+import shelve
+import threading
+from mp3scrub.util import mylog
+
+
+class ScanIndex(object):
+    '''see module doc. lookup() every file found in the walk, update() the ones
+       lookup() didn't know about once their tags are read, then finish().
+    '''
+
+    def __init__(self, file_name):
+        self.file_name = file_name
+        self.lock = threading.Lock()
+
+        self.shelf = shelve.open(file_name, 'c', protocol=-1)
+
+        # path => stat key, for files that need their record rewritten
+        self.pending = {}
+        self.seen = set()
+
+        self.added = []
+        self.changed = []
+        self.removed = []
+
+    @staticmethod
+    def _key(path):
+        return unicode(path).encode('utf-8')
+
+    @staticmethod
+    def _statKey(st):
+        return (st.st_size, int(st.st_mtime), st.st_ino)
+
+    def lookup(self, path, st):
+        ''' path -> file found in the walk
+            st -> its os.stat()
+
+            returns -> (tags, partial) saved last scan if the file hasn't changed,
+                       None if it's new/modified and needs to be read
+        '''
+
+        key = ScanIndex._key(path)
+        stat_key = ScanIndex._statKey(st)
+
+        with self.lock:
+            self.seen.add(key)
+
+            rec = self.shelf.get(key)
+
+            if rec and rec[:3] == stat_key:
+                return rec[3:]
+
+            if rec:
+                self.changed.append(path)
+            else:
+                self.added.append(path)
+
+            self.pending[key] = stat_key
+
+        return None
+
+    def update(self, path, tags, partial=None):
+        ''' save the tags (and partial digest if known) we just read for path '''
+
+        key = ScanIndex._key(path)
+
+        with self.lock:
+            stat_key = self.pending.pop(key, None)
+
+            if not stat_key: return
+
+            self.shelf[key] = stat_key + (tags, partial)
+
+    def finish(self, dir_str, dup_finder=None):
+        ''' call once the walk of dir_str is complete. drops records for files under
+            dir_str that are gone, and saves any dup digests that got computed after
+            a file was updated. records for other dirs are left alone.
+
+            returns -> (added, removed, changed) lists of paths
+        '''
+
+        prefix = ScanIndex._key(os.path.join(str(dir_str), ''))
+
+        with self.lock:
+            for key in self.shelf.keys():
+                if key.startswith(prefix) and key not in self.seen:
+                    self.removed.append(key.decode('utf-8'))
+                    del self.shelf[key]
+
+            if dup_finder:
+                for path, partial in dup_finder.partials.items():
+                    key = ScanIndex._key(path)
+                    rec = self.shelf.get(key)
+
+                    if rec and rec[4] is None:
+                        self.shelf[key] = rec[:4] + (partial,)
+
+            self.shelf.sync()
+
+        mylog.INFO('scan index: %d added %d removed %d changed' %
+                   (len(self.added), len(self.removed), len(self.changed)))
+
+        return (self.added, self.removed, self.changed)
+
+    def close(self):
+        with self.lock:
+            self.shelf.close()
@@ -11,6 +11,23 @@ import unicodedata
 from mp3scrub import globalz
 from mp3scrub.util import mylog
 
+# the same few thousand track names get cleaned over and over while matching,
+# so remember the results. cleared when they get this big
+MEMO_MAX = 100000
+_TRACK_JUNK_MEMO = {}
+_TRACK_SANITIZE_MEMO = {}
+
+# see removeTrackJunk, in the order they're applied
+_TRACK_JUNK_RES = [ re.compile(r'\(.*explicit.*\)', re.IGNORECASE),
+                    re.compile(r'\(.*remaster.*\)', re.IGNORECASE),
+                    re.compile(r'\(.*edit.*\)', re.IGNORECASE),
+                    re.compile(r'\(.*live.*\)', re.IGNORECASE),
+                    re.compile(r'\(.*alternate.*\)', re.IGNORECASE),
+                    re.compile(r'\(.*version.*\)', re.IGNORECASE),
+                    re.compile(r'\(.*ft*\)', re.IGNORECASE),
+                    re.compile(r'\(.*mix.*\)', re.IGNORECASE),
+                    re.compile(r'\(\)') ]
+
 def safeUni(uni_str):
     return unicodedata.normalize('NFKD', unicode(uni_str)).encode('ascii','ignore')
 
@@ -48,12 +65,15 @@ def trackCompare(my_str, real_str):
     clean_my_str = sanitizeTrackStr(my_str)
     clean_real_str = sanitizeTrackStr(real_str)
 
-    dist = strDist(clean_my_str, clean_real_str)
+    # for longer strings, we allow more mistakes, up to MAX_STR_DIST
+    max_dist = min(globalz.MAX_STR_DIST - 1, int(len(clean_my_str)/globalz.DIV_STR_DIST))
+
+    dist = boundedStrDist(clean_my_str, clean_real_str, max_dist)
 
-    mylog.DBG1(10,'comparing clean track %s to %s: dist: %d' % (clean_my_str, clean_real_str, dist))
+    if globalz.LOG_DEBUG >= 10:
+        mylog.DBG1(10,'comparing clean track %s to %s: dist: %d' % (clean_my_str, clean_real_str, dist))
 
-    # for longer strings, we allow more mistakes, up to MAX_STR_DIST
-    if dist < globalz.MAX_STR_DIST and dist <= int(len(clean_my_str)/globalz.DIV_STR_DIST):
+    if dist <= max_dist:
         return dist
     else:
         return -1 
@@ -96,10 +116,10 @@ def artistCompare(my_str, real_str):
 
     else:
         # see how good the guess is
-        dist = strDist(clean_my_str, clean_real_str)
-
         # for longer strings, we allow more mistakes, up to MAX_STR_DIST
-        if dist < globalz.MAX_STR_DIST and dist <= int(len(clean_my_str)/globalz.DIV_STR_DIST):
+        max_dist = min(globalz.MAX_STR_DIST - 1, int(len(clean_my_str)/globalz.DIV_STR_DIST))
+
+        if boundedStrDist(clean_my_str, clean_real_str, max_dist) <= max_dist:
             matched = True
 
     return matched
@@ -113,35 +133,41 @@ def removeTrackJunk(a):
        Rape Me (explicit)
     '''
 
-    expl = re.compile(r'\(.*explicit.*\)', re.IGNORECASE)
-    alt = re.compile(r'\(.*alternate.*\)', re.IGNORECASE)
-    live = re.compile(r'\(.*live.*\)', re.IGNORECASE)
-    mix = re.compile(r'\(.*mix.*\)', re.IGNORECASE)
-    vers = re.compile(r'\(.*version.*\)', re.IGNORECASE)
-    remaster = re.compile(r'\(.*remaster.*\)', re.IGNORECASE)
-    feat = re.compile(r'\(.*ft*\)', re.IGNORECASE)
-    edit = re.compile(r'\(.*edit.*\)', re.IGNORECASE)
+    ret = _TRACK_JUNK_MEMO.get(a)
 
-    ret = re.sub(expl,'', a)
-    ret = re.sub(remaster,'', ret)
-    ret = re.sub(edit,'', ret)
+    if ret is not None: return ret
 
     # SPG 5/7/2010 playing with heuristics...
     #if not alt.search(ret) and not live.search(ret):
     #   ret = re.sub(vers,'', ret)
-    ret = re.sub(live,'', ret)
-    ret = re.sub(alt,'', ret)
-    ret = re.sub(vers,'', ret)
-    ret = re.sub(feat,'', ret)
-    ret = re.sub(mix,'', ret)
-    ret = re.sub('\(\)','', ret)
-    return ret.strip()
+    ret = a
+    for junk_re in _TRACK_JUNK_RES:
+        ret = junk_re.sub('', ret)
+
+    ret = ret.strip()
+
+    if len(_TRACK_JUNK_MEMO) >= MEMO_MAX:
+        _TRACK_JUNK_MEMO.clear()
+
+    _TRACK_JUNK_MEMO[a] = ret
+
+    return ret
 
 def sanitizeTrackStr(a):
     '''for track comparision, we don't want to consider things like capitalization'''
 
+    ret = _TRACK_SANITIZE_MEMO.get(a)
+
+    if ret is not None: return ret
+
     ret = a.lower()
     ret = ret.replace(' ','')
+
+    if len(_TRACK_SANITIZE_MEMO) >= MEMO_MAX:
+        _TRACK_SANITIZE_MEMO.clear()
+
+    _TRACK_SANITIZE_MEMO[a] = ret
+
     return ret
 
 def sanitizeArtistStr(a):
@@ -155,8 +181,79 @@ def sanitizeArtistStr(a):
     ret = re.sub(r'the','', ret)
     return ret
 
+def _myersDist(a, b, max_dist):
+    '''Myers/Hyyro bit-parallel Levenshtein. each column of the dp matrix is kept
+    as bit vectors of +1/-1 vertical deltas in python ints, so a whole column costs
+    a handful of int ops instead of a loop over the shorter string.
+    src: Hyyro, "Explaining and extending the bit-parallel approximate string
+         matching algorithm of Myers"
+
+    max_dist -> give up once the distance is sure to be over this, None for never
+    '''
+
+    n, m = len(a), len(b)
+
+    if n > m:
+        # a is the bit vector, keep it short
+        a, b = b, a
+        n, m = m, n
+
+    if not n: return m
+
+    peq = {}
+    for i, c in enumerate(a):
+        peq[c] = peq.get(c, 0) | (1 << i)
+
+    mask = (1 << n) - 1
+    high = 1 << (n - 1)
+    pv, mv = mask, 0
+    score = n
+    left = m
+
+    for c in b:
+        eq = peq.get(c, 0)
+        xv = eq | mv
+        xh = (((eq & pv) + pv) ^ pv) | eq
+        ph = mv | ~(xh | pv)
+        mh = pv & xh
+
+        if ph & high:
+            score += 1
+        elif mh & high:
+            score -= 1
+
+        left -= 1
+
+        # the distance can only drop by one per column left
+        if max_dist is not None and score - left > max_dist:
+            return max_dist + 1
+
+        ph = (ph << 1) | 1
+        mh = mh << 1
+        pv = (mh | ~(xv | ph)) & mask
+        mv = ph & xv & mask
+
+    return score
+
 def strDist(a, b):
-    '''Calculates the Levenshtein distance between a and b.
+    '''Calculates the Levenshtein distance between a and b.'''
+
+    return _myersDist(a, b, None)
+
+def boundedStrDist(a, b, max_dist):
+    '''strDist for when you only care if a and b are within max_dist of each other.
+
+    returns -> the distance, or max_dist+1 if it's more than max_dist
+    '''
+
+    if max_dist < 0: return 0 if a == b else max_dist + 1
+
+    if abs(len(a) - len(b)) > max_dist: return max_dist + 1
+
+    return _myersDist(a, b, max_dist)
+
+def _strDistDP(a, b):
+    '''the old row by row Levenshtein, kept to check/benchmark strDist against.
     src: http://hetland.org/coding/python/levenshtein.py
     '''
 
@@ -182,6 +279,46 @@ def strDist(a, b):
 
     return current[n]
 
+def benchStrDist(n_strs=300, loops=3):
+    ''' time the old dp strDist against the bit-parallel one (and the bounded one
+        trackCompare uses) on random track-name-ish strings, checking they agree.
+    '''
+
+    import random, time
+
+    random.seed(0)
+
+    words = [ 'love', 'the', 'song', 'of', 'night', 'blue', 'heart', 'dream', 
+              'remix', 'rain', 'fire', 'girl', 'time', 'away', 'home', 'road' ]
+
+    strs = [ ''.join(random.sample(words, random.randint(1, 5))) for i in xrange(n_strs) ]
+    pairs = [ (x, y) for x in strs[:n_strs/10] for y in strs ]
+
+    max_dist = globalz.MAX_STR_DIST - 1
+
+    for (x, y) in pairs:
+        d = _strDistDP(x, y)
+        assert strDist(x, y) == d, (x, y)
+        assert boundedStrDist(x, y, max_dist) == min(d, max_dist + 1), (x, y)
+
+    results = []
+
+    for (name, fn) in [ ('dp', _strDistDP), 
+                        ('bitparallel', strDist),
+                        ('bounded', lambda x, y: boundedStrDist(x, y, max_dist)) ]:
+        best = None
+
+        for i in xrange(loops):
+            start = time.time()
+            for (x, y) in pairs: fn(x, y)
+            secs = time.time() - start
+            best = secs if best is None else min(best, secs)
+
+        results.append((name, best))
+
+    for (name, secs) in results:
+        print '%-12s %d pairs: %.3fs (%.1fx)' % (name, len(pairs), secs, results[0][1] / secs)
+
 
 # (field1, val1), (field2, val2)...
 def printNice(*args):
@@ -194,7 +331,7 @@ if __name__ == '__main__':
       arg1 = sys.argv[2]
    except IndexError:
       exit('usage: %s [TRACKJUNK|TESTARTIST|TESTTRACK|CLEANARTIST|TRACKMATCH|CLEANTRACK|'
-           'UNESCAPE] str1 [str2]' % sys.argv[0])
+           'UNESCAPE|BENCH] str1 [str2]' % sys.argv[0])
 
 
    if type == 'TESTARTIST':
@@ -226,3 +363,7 @@ if __name__ == '__main__':
 
    elif type == 'TRACKJUNK':
       print removeTrackJunk(arg1)
+
+   elif type == 'BENCH':
+      # arg1 is the number of strings
+      benchStrDist(int(arg1))